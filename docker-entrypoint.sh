@@ -1,6 +1,9 @@
 #!/bin/bash
 set -e
 
+# Startup timing: /readyz and the first request log count from here
+export STARTUP_STARTED_AT=$(date +%s.%N)
+
 # Wait for database if using PostgreSQL
 if [ "$DATABASE" = "postgres" ] || [ -n "$POSTGRES_DB" ]; then
     echo "Waiting for database..."
@@ -14,9 +17,10 @@ python manage.py collectstatic --noinput || true
 # Run migrations only (catalog loading and image downloading moved to background jobs)
 echo "Running migrations..."
 python manage.py migrate --noinput
+echo "Startup steps done at ${SECONDS}s"
 
-# Background jobs (catalog loading, image downloading) will run automatically
-# after the server starts via Django's AppConfig.ready() method
+# Background jobs (catalog loading, image downloading) are run by the
+# separate worker service (python manage.py run_background_jobs --all)
 
 # Execute command
 exec "$@"
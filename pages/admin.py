@@ -1,22 +1,96 @@
 from django.contrib import admin
-from .models import Category, Product
+from django.db import transaction
+from .catalog import touch_catalog
+from .catalog_snapshot import discard_snapshot
+from .models import Cart, CartItem, CatalogVersion, Category, Job, Product, ProductImage
+
+
+class CatalogSnapshotAdminMixin:
+    """
+    Edits here change what the catalog snapshot holds: drop it and queue a new
+    export, and bump the catalog version so every process refreshes its caches.
+    """
+
+    def save_related(self, request, form, formsets, change):
+        # Runs after save_model(), inlines included, also for list_editable changes
+        super().save_related(request, form, formsets, change)
+        touch_catalog()
+        transaction.on_commit(discard_snapshot)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        touch_catalog()
+        transaction.on_commit(discard_snapshot)
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        touch_catalog()
+        transaction.on_commit(discard_snapshot)
 
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
-    list_display = ['full_path', 'name', 'product_count']
+class CategoryAdmin(CatalogSnapshotAdminMixin, admin.ModelAdmin):
+    list_display = ['full_path', 'name', 'depth', 'product_count', 'active_count']
+    list_filter = ['depth']
     search_fields = ['name', 'full_path']
-    
-    def product_count(self, obj):
-        return obj.products.count()
-    product_count.short_description = 'Products'
+
+
+class ProductImageInline(admin.TabularInline):
+    model = ProductImage
+    fields = ['position', 'url', 'blob']
+    raw_id_fields = ['blob']
+    extra = 0
 
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(CatalogSnapshotAdminMixin, admin.ModelAdmin):
     list_display = ['product_code', 'name', 'category', 'price', 'stock', 'active']
     list_filter = ['active', 'category', 'producer']
     search_fields = ['product_code', 'name', 'description']
     list_editable = ['active']
+    inlines = [ProductImageInline]
+
+
+@admin.register(CatalogVersion)
+class CatalogVersionAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'source', 'is_active', 'product_count', 'category_count', 'activated_at']
+    list_filter = ['is_active']
+    readonly_fields = ['source', 'is_active', 'activated_at', 'product_count', 'category_count']
+
+    def has_add_permission(self, request):
+        # Versions are created by load_catalog
+        return False
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'status', 'progress', 'message', 'attempts', 'created_at', 'heartbeat_at', 'finished_at']
+    list_filter = ['status', 'command']
+    readonly_fields = [
+        'command', 'arguments', 'key', 'after', 'status', 'attempts', 'locked_by', 'locked_until', 'heartbeat_at',
+        'progress', 'message', 'output', 'error', 'created_at', 'started_at', 'finished_at',
+    ]
+
+    def has_add_permission(self, request):
+        # Jobs are queued by run_background_jobs and the code that needs them
+        return False
+
+
+class CartItemInline(admin.TabularInline):
+    model = CartItem
+    fields = ['product', 'quantity']
+    raw_id_fields = ['product']
+    extra = 0
+
 
+@admin.register(Cart)
+class CartAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'user', 'session_key', 'created_at']
+    search_fields = ['session_key', 'user__username', 'user__email']
+    raw_id_fields = ['user']
+    readonly_fields = ['session_key', 'created_at']
+    inlines = [CartItemInline]
 
+    def has_add_permission(self, request):
+        # Carts are created by the first cart change of a visitor
+        return False
@@ -0,0 +1,313 @@
+"""
+Shopping cart.
+
+Carts are Cart rows owned by the signed-in customer or, for anonymous
+visitors, by their session key; each line is a CartItem row, so a change
+writes one row instead of the whole session, and quantities are changed
+with single UPDATE ... SET quantity = quantity + n statements, which
+concurrent requests cannot overwrite.
+
+Reading the cart never creates a session, so crawlers and visitors who only
+browse cost no session row and no Set-Cookie. A session is created on the
+first cart change. The item count shown in the header is kept in a signed
+cookie, so pages render it without loading the session.
+
+Lines refer to products by code. A line whose product is missing, e.g.
+while load_catalog --clear reloads the catalog, is hidden until the product
+is back.
+"""
+from decimal import Decimal
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, F, Sum, Value, When
+from django.db.models.functions import Least
+from .models import Cart, CartItem
+
+CART_COUNT_COOKIE = 'cart_count'
+CART_COUNT_SALT = 'pages.cart.count'
+# Most items of one product in a cart, well inside the quantity column's range
+MAX_ITEM_QUANTITY = 10000
+# Product columns the cart, checkout and order summary pages read
+CART_PRODUCT_FIELDS = ('product_code', 'name', 'price', 'currency', 'image_url')
+
+
+def cart_lines(cart):
+    """The lines of cart whose product exists."""
+    return CartItem.objects.filter(cart=cart, product__id__isnull=False)
+
+
+def cart_owner(request):
+    """Filter selecting the request's cart: the signed-in customer's, else the session's; None without either."""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return {'user': user}
+    if request.session.session_key:
+        return {'session_key': request.session.session_key}
+    return None
+
+
+def get_cart(request):
+    """Return the request's Cart, or None, without creating a cart or a session."""
+    if not hasattr(request, '_cart'):
+        owner = cart_owner(request)
+        request._cart = Cart.objects.filter(**owner).first() if owner else None
+    return request._cart
+
+
+def get_cart_for_update(request):
+    """Return the request's Cart for changing it, creating the cart (and the visitor's session) if needed."""
+    cart = get_cart(request)
+    if cart is None:
+        owner = cart_owner(request)
+        if owner is None:
+            request.session.create()
+            owner = {'session_key': request.session.session_key}
+        cart, _ = Cart.objects.get_or_create(**owner)
+        request._cart = cart
+    return cart
+
+
+def cart_changed(request):
+    """Forget the request's memoized cart contents and refresh the count cookie with the response."""
+    request.cart_changed = True
+    request.__dict__.pop('_cart_context', None)
+    request.__dict__.pop('_cart_count', None)
+
+
+def check_quantity(quantity):
+    """Raise ValueError unless quantity is a positive number of items to add."""
+    if quantity <= 0:
+        raise ValueError('La cantidad debe ser mayor que 0')
+    if quantity > MAX_ITEM_QUANTITY:
+        raise ValueError(f'La cantidad máxima es {MAX_ITEM_QUANTITY}')
+
+
+def add_item(request, product, quantity):
+    """Add quantity of product to the cart; raise ValueError for a quantity below 1."""
+    check_quantity(quantity)
+    cart = get_cart_for_update(request)
+    items = CartItem.objects.filter(cart=cart, product=product)
+    # Repeated adds stop at MAX_ITEM_QUANTITY
+    added = Least(F('quantity') + quantity, MAX_ITEM_QUANTITY)
+    if not items.update(quantity=added):
+        try:
+            with transaction.atomic():
+                CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        except IntegrityError:
+            # A concurrent request added the line first; any other
+            # integrity error leaves no line to update
+            if not items.update(quantity=added):
+                raise
+    cart_changed(request)
+
+
+def add_items(request, quantities):
+    """
+    Add {product: quantity} to the cart with one INSERT ... ON CONFLICT statement.
+
+    Existing lines are increased in the same statement (the database adds to
+    the stored quantity), so the merge is atomic like add_item() and stops
+    at MAX_ITEM_QUANTITY like it.
+    """
+    if not quantities:
+        return
+    for quantity in quantities.values():
+        check_quantity(quantity)
+    cart = get_cart_for_update(request)
+    quote = connection.ops.quote_name
+    table = quote(CartItem._meta.db_table)
+    fields = [CartItem._meta.get_field(name) for name in ('cart', 'product', 'quantity')]
+    cart_column, product_column, quantity_column = (quote(field.column) for field in fields)
+    rows = [(cart.pk, product.product_code, quantity) for product, quantity in quantities.items()]
+    # SQLite limits the number of query parameters (one row fewer leaves room
+    # for the cap), and has MIN() where others have LEAST()
+    batch_size = max(1, (connection.ops.bulk_batch_size(fields, rows) or len(rows)) - 1)
+    least = 'MIN' if connection.vendor == 'sqlite' else 'LEAST'
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cursor.execute(
+                f'INSERT INTO {table} ({cart_column}, {product_column}, {quantity_column}) '
+                f'VALUES {", ".join(["(%s, %s, %s)"] * len(batch))} '
+                f'ON CONFLICT ({cart_column}, {product_column}) DO UPDATE '
+                f'SET {quantity_column} = {least}({table}.{quantity_column} + excluded.{quantity_column}, %s)',
+                [value for row in batch for value in row] + [MAX_ITEM_QUANTITY],
+            )
+    cart_changed(request)
+
+
+def cart_quantities(request, product_codes):
+    """{product code: quantity} of those products already in the request's cart."""
+    cart = get_cart(request)
+    if cart is None:
+        return {}
+    return dict(CartItem.objects.filter(cart=cart, product_id__in=product_codes).values_list('product_id', 'quantity'))
+
+
+def set_item_quantity(request, product_code, quantity):
+    """Set the quantity of a cart line, removing it for 0; return whether the line exists."""
+    cart = get_cart(request)
+    if cart is None:
+        return False
+    items = CartItem.objects.filter(cart=cart, product_id=product_code)
+    changed = items.update(quantity=quantity) if quantity > 0 else items.delete()[0]
+    if changed:
+        cart_changed(request)
+    return bool(changed)
+
+
+def apply_operations(request, operations):
+    """
+    Apply a list of cart operations atomically.
+
+    Operations are {"op": "set", "code": ..., "quantity": n} (0 removes the
+    line, at most MAX_ITEM_QUANTITY) and {"op": "remove", "code": ...}, on lines that are in the cart;
+    a later operation on the same code wins. Either all are applied, with
+    one UPDATE and one DELETE, or none: the result is the list of errors
+    ({'index', 'code', 'error'}), empty on success.
+    """
+    if not isinstance(operations, list):
+        return [{'index': None, 'code': '', 'error': 'ops debe ser una lista'}]
+    cart = get_cart(request)
+    # Line ids by product code, to update them by primary key
+    lines = dict(
+        cart_lines(cart).values_list('product_id', 'id')
+    ) if cart is not None else {}
+
+    quantities = {}
+    errors = []
+    for index, operation in enumerate(operations):
+        operation = operation if isinstance(operation, dict) else {}
+        code = str(operation.get('code', ''))
+        if operation.get('op') == 'remove':
+            quantity = 0
+        elif operation.get('op') == 'set':
+            quantity = operation.get('quantity')
+            if isinstance(quantity, str) and quantity.strip().isdigit():
+                quantity = int(quantity)
+            if (
+                not isinstance(quantity, int) or isinstance(quantity, bool)
+                or not 0 <= quantity <= MAX_ITEM_QUANTITY
+            ):
+                errors.append({'index': index, 'code': code, 'error': 'Cantidad inválida'})
+                continue
+        else:
+            errors.append({'index': index, 'code': code, 'error': 'Operación desconocida, use set o remove'})
+            continue
+        if code not in lines:
+            errors.append({'index': index, 'code': code, 'error': 'El producto no está en el carrito'})
+            continue
+        quantities[lines[code]] = quantity
+    if errors or not quantities:
+        return errors
+
+    updates = {pk: quantity for pk, quantity in quantities.items() if quantity > 0}
+    removals = [pk for pk, quantity in quantities.items() if quantity == 0]
+    with transaction.atomic():
+        if updates:
+            CartItem.objects.filter(pk__in=updates).update(
+                quantity=Case(*(When(pk=pk, then=Value(quantity)) for pk, quantity in updates.items())),
+            )
+        if removals:
+            CartItem.objects.filter(pk__in=removals).delete()
+    cart_changed(request)
+    return []
+
+
+def remove_item(request, product_code):
+    """Remove a line from the cart."""
+    return set_item_quantity(request, product_code, 0)
+
+
+def clear_cart(request):
+    """Empty the cart."""
+    cart = get_cart(request)
+    if cart is not None:
+        cart.delete()
+        request._cart = None
+        cart_changed(request)
+
+
+def count_items(request):
+    """Total number of items in the request's cart, with one query, memoized until the cart changes."""
+    if hasattr(request, '_cart_context'):
+        return request._cart_context['cart_count']
+    if not hasattr(request, '_cart_count'):
+        cart = get_cart(request)
+        request._cart_count = 0 if cart is None else (
+            cart_lines(cart).aggregate(count=Sum('quantity'))['count'] or 0
+        )
+    return request._cart_count
+
+
+def get_cart_count(request):
+    """
+    Get total number of items in cart.
+
+    Visitors without a session have an empty cart. Otherwise the count comes
+    from the signed cookie; the cart is read only when the cookie is missing
+    or invalid.
+    """
+    if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+        return 0
+    count = request.get_signed_cookie(CART_COUNT_COOKIE, default='', salt=CART_COUNT_SALT)
+    if count.isdigit():
+        return int(count)
+    return count_items(request)
+
+
+def set_cart_count_cookie(request, response):
+    """Store the item count of the request's cart in the signed cookie."""
+    response.set_signed_cookie(
+        CART_COUNT_COOKIE,
+        str(count_items(request)),
+        salt=CART_COUNT_SALT,
+        max_age=settings.SESSION_COOKIE_AGE,
+        secure=settings.SESSION_COOKIE_SECURE,
+        httponly=True,
+        samesite=settings.SESSION_COOKIE_SAMESITE,
+    )
+
+
+def get_cart_context(request):
+    """
+    Get cart items with product details.
+
+    All lines are loaded with one query, with only CART_PRODUCT_FIELDS of
+    their products. The result is memoized on the request until the cart
+    changes. A count cookie that disagrees with the lines is refreshed with
+    the response.
+    """
+    if hasattr(request, '_cart_context'):
+        return request._cart_context
+
+    cart = get_cart(request)
+    items = []
+    if cart is not None:
+        items = cart_lines(cart).select_related('product').only(
+            'quantity', *(f'product__{field}' for field in CART_PRODUCT_FIELDS),
+        )
+    cart_items = []
+    grand_total = Decimal('0.00')
+    cart_count = 0
+    for item in items:
+        unit_price = item.product.price
+        item_total = unit_price * item.quantity
+        grand_total += item_total
+        cart_count += item.quantity
+        cart_items.append({
+            'product': item.product,
+            'quantity': item.quantity,
+            'unit_price': unit_price,
+            'item_total': item_total,
+        })
+
+    request._cart_context = {
+        'cart_items': cart_items,
+        'grand_total': grand_total,
+        'cart_count': cart_count,
+    }
+    if get_cart_count(request) != cart_count:
+        # Lines disappeared with their products: correct the header count
+        request.cart_changed = True
+    return request._cart_context
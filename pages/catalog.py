@@ -0,0 +1,483 @@
+"""
+Process-level caches for read-mostly catalog data.
+
+Every cached value is tagged with the catalog version it was built from.
+The version itself is re-read from the database at most once every
+CATALOG_VERSION_CHECK_INTERVAL seconds, so on the hot path the cached
+values cost zero queries. load_catalog activates a new version in the same
+transaction as the import, which makes every process rebuild its caches
+exactly once, on the next check after the commit.
+"""
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+from django.utils.text import slugify
+
+
+_lock = threading.Lock()
+_version = {'value': None, 'checked_at': 0.0}
+_cache = {}
+# CatalogVersion columns that make up the live catalog version
+VERSION_FIELDS = ('pk', 'images_updated_at', 'edited_at')
+# max_length of the slug fields
+SLUG_MAX_LENGTH = 255
+
+
+def split_path(full_path):
+    """Split a category full path into its stripped parts."""
+    return [part.strip() for part in full_path.split('>') if part.strip()]
+
+
+def top_level_name(full_path):
+    """Return the top-level category name of a full path."""
+    parts = split_path(full_path)
+    return parts[0] if parts else ''
+
+
+def slug_variant(base_slug, counter, max_length=SLUG_MAX_LENGTH):
+    """Return base_slug-counter, shortening base_slug so the result fits in max_length."""
+    suffix = f"-{counter}"
+    return base_slug[:max_length - len(suffix)].rstrip('-') + suffix
+
+
+def unique_slug(base_slug, taken, max_length=SLUG_MAX_LENGTH):
+    """Return base_slug, or base_slug-N if it is already in the taken set, at most max_length long."""
+    base_slug = base_slug[:max_length].rstrip('-')
+    slug = base_slug
+    counter = 1
+    while slug in taken:
+        slug = slug_variant(base_slug, counter, max_length)
+        counter += 1
+    taken.add(slug)
+    return slug
+
+
+def get_catalog_version():
+    """
+    Return the live catalog version, re-checking the database periodically.
+
+    The version is a (version id, images updated at, edited at) triple, so an
+    image sync or an admin edit also refreshes the cached values.
+    """
+    interval = getattr(settings, 'CATALOG_VERSION_CHECK_INTERVAL', 30)
+    now = time.monotonic()
+    if _version['value'] is None or now - _version['checked_at'] >= interval:
+        from .models import CatalogVersion
+        active = CatalogVersion.objects.filter(is_active=True).values_list(*VERSION_FIELDS).first()
+        _version['value'] = active or (0, None, None)
+        _version['checked_at'] = now
+    return _version['value']
+
+
+def _reset_catalog_version():
+    """Drop this process's caches and re-read the version on next use."""
+    with _lock:
+        _version['value'] = None
+        _cache.clear()
+
+
+def activate_catalog_version(version):
+    """
+    Make version the live catalog version.
+
+    Meant to run inside the import transaction, so readers switch to the new
+    rows and the new version in one commit; this process's caches are
+    dropped once that commit succeeds.
+    """
+    from .models import CatalogVersion
+    CatalogVersion.objects.filter(is_active=True).exclude(pk=version.pk).update(is_active=False)
+    version.is_active = True
+    version.activated_at = timezone.now()
+    version.save(update_fields=['is_active', 'activated_at'])
+    transaction.on_commit(_reset_catalog_version)
+    return version
+
+
+def touch_catalog_images():
+    """Record that stored images changed, so every process rebuilds its cached pages."""
+    from .models import CatalogVersion
+    CatalogVersion.objects.filter(is_active=True).update(images_updated_at=timezone.now())
+    transaction.on_commit(_reset_catalog_version)
+
+
+class _CatalogTouch:
+    """
+    on_commit callback of touch_catalog().
+
+    The connection only holds a weak reference to it: Django drops the
+    callbacks of a rolled-back transaction or savepoint, which frees it, so
+    the next edit schedules a new one.
+    """
+
+    def __call__(self):
+        from .models import CatalogVersion
+        transaction.get_connection().catalog_touch = None
+        CatalogVersion.objects.filter(is_active=True).update(edited_at=timezone.now())
+        _reset_catalog_version()
+
+
+def touch_catalog():
+    """
+    Record that categories or products were edited outside an import, so
+    every process rebuilds its caches and stops using the snapshot.
+
+    Runs once, after the current transaction commits, however many rows the
+    transaction changed.
+    """
+    connection = transaction.get_connection()
+    pending = getattr(connection, 'catalog_touch', None)
+    if pending is None or pending() is None:
+        touch = _CatalogTouch()
+        connection.catalog_touch = weakref.ref(touch)
+        transaction.on_commit(touch)
+
+
+def cached(key, builder):
+    """Return builder() for the current catalog version, building it once per version."""
+    version = get_catalog_version()
+    entry = _cache.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None or entry[0] != version:
+            entry = (version, builder())
+            _cache[key] = entry
+    return entry[1]
+
+
+def invalidate_catalog_caches():
+    """Drop this process's cached catalog data so it is rebuilt on next use."""
+    with _lock:
+        _cache.clear()
+
+
+def _build_menu_categories():
+    from .image_proxy import proxied_image
+    from .models import Category, TopLevelCategory, blobs_by_file
+
+    # Downloaded images of the top-level categories, for responsive markup
+    root_images = dict(Category.objects.filter(depth=0).exclude(image='').values_list('name', 'image'))
+    blobs = blobs_by_file(root_images.values())
+    return [
+        {
+            'name': category.name,
+            'slug': category.slug,
+            'count': category.product_count,
+            'image_url': category.image_url,
+            'image': blobs.get(root_images.get(category.name)) or proxied_image(category.image_url),
+        }
+        for category in TopLevelCategory.objects.filter(product_count__gt=0)
+    ]
+
+
+def get_menu_categories():
+    """Return the top-level categories shown in the menu."""
+    return cached('menu_categories', _build_menu_categories)
+
+
+def aggregate_category_paths():
+    """
+    Compute product aggregates for every category path prefix.
+
+    Returns a dict mapping each path (joined with ' > ') to its rolled-up
+    product_count, active_count and first_image_url, covering the category
+    itself and everything below it in the tree.
+    """
+    from .models import Category, Product
+
+    # One grouped query for the counts of each leaf category
+    own = {
+        row['category_id']: row
+        for row in Product.objects.filter(category__isnull=False)
+        .order_by()
+        .values('category_id')
+        .annotate(total=Count('id'), active=Count('id', filter=Q(active=True)))
+    }
+    # First product by name with an image, per category; the join on the main
+    # image (position 0) goes through the (product, position) unique index
+    first_images = {}
+    for category_id, name, image_url in (
+        Product.objects.filter(category__isnull=False, images__position=0)
+        .order_by('category_id', 'name', 'id')
+        .values_list('category_id', 'name', 'images__url')
+    ):
+        first_images.setdefault(category_id, (name, image_url))
+
+    aggregates = {}
+    for category_id, full_path in Category.objects.values_list('id', 'full_path'):
+        parts = split_path(full_path)
+        counts = own.get(category_id, {'total': 0, 'active': 0})
+        image = first_images.get(category_id)
+        # Roll the leaf numbers up into every ancestor path
+        for depth in range(1, len(parts) + 1):
+            entry = aggregates.setdefault(
+                ' > '.join(parts[:depth]),
+                {'product_count': 0, 'active_count': 0, 'first_image': None},
+            )
+            entry['product_count'] += counts['total']
+            entry['active_count'] += counts['active']
+            if image and (entry['first_image'] is None or image < entry['first_image']):
+                entry['first_image'] = image
+
+    for entry in aggregates.values():
+        first_image = entry.pop('first_image')
+        entry['first_image_url'] = first_image[1] if first_image else ''
+    return aggregates
+
+
+def _build_top_level_slugs():
+    from .catalog_snapshot import get_snapshot
+    from .models import TopLevelCategory
+
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.top_level_slugs()
+    return dict(TopLevelCategory.objects.values_list('name', 'slug'))
+
+
+def top_level_slug(full_path):
+    """Return the URL slug of the top-level category a full path belongs to."""
+    name = top_level_name(full_path)
+    return cached('top_level_slugs', _build_top_level_slugs).get(name) or slugify(name)
+
+
+def _build_category_resolver():
+    from .models import Category, TopLevelCategory
+
+    categories = list(Category.objects.order_by('full_path').values_list('full_path', 'name'))
+    resolver = {}
+    # Lowest priority first: full-path and leaf-name slugs, first category wins
+    for full_path, name in categories:
+        top_level = top_level_name(full_path)
+        resolver.setdefault(slugify(full_path), top_level)
+        resolver.setdefault(slugify(name), top_level)
+    # Top-level slugs override anything else that slugifies the same way
+    for full_path, name in categories:
+        top_level = top_level_name(full_path)
+        resolver[slugify(top_level)] = top_level
+    for name, slug in TopLevelCategory.objects.values_list('name', 'slug'):
+        resolver[slug] = name
+    resolver.pop('', None)
+    return resolver
+
+
+def _build_category_tree():
+    from .catalog_snapshot import get_snapshot
+    from .models import Category
+
+    snapshot = get_snapshot()
+    categories = snapshot.categories() if snapshot is not None else Category.objects.order_by('tree_id', 'lft')
+    tree = {'by_id': {}, 'by_slug': {}, 'roots': {}, 'children': {}}
+    for category in categories:
+        tree['by_id'][category.pk] = category
+        tree['by_slug'][category.slug] = category
+        if category.parent_id:
+            tree['children'].setdefault(category.parent_id, []).append(category)
+        else:
+            tree['roots'][category.name] = category
+    return tree
+
+
+def get_category_tree():
+    """Return the cached category tree: lookups by id and slug, roots by name, children by parent id."""
+    return cached('category_tree', _build_category_tree)
+
+
+def top_level_category(name):
+    """Return the top-level Category row with the given name, or None."""
+    return get_category_tree()['roots'].get(name)
+
+
+def category_ancestors(category):
+    """Return the ancestors of a category, top-level first."""
+    by_id = get_category_tree()['by_id']
+    ancestors = []
+    parent = by_id.get(category.parent_id)
+    while parent is not None:
+        ancestors.append(parent)
+        parent = by_id.get(parent.parent_id)
+    return ancestors[::-1]
+
+
+def resolve_category_slug(slug):
+    """Return the top-level category name a URL slug refers to, or None."""
+    from .catalog_snapshot import get_snapshot
+
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.resolve_category_slug(slug)
+    return cached('category_resolver', _build_category_resolver).get(slug)
+
+
+def rebuild_category_aggregates(aggregates):
+    """Store the rolled-up aggregates on the Category rows."""
+    from .models import Category
+
+    empty = {'product_count': 0, 'active_count': 0, 'first_image_url': ''}
+    categories = list(Category.objects.only('id', 'full_path', 'product_count', 'active_count', 'first_image_url'))
+    changed = []
+    for category in categories:
+        entry = aggregates.get(' > '.join(split_path(category.full_path)), empty)
+        if any(getattr(category, field) != value for field, value in entry.items()):
+            for field, value in entry.items():
+                setattr(category, field, value)
+            changed.append(category)
+    Category.objects.bulk_update(changed, ['product_count', 'active_count', 'first_image_url'], batch_size=500)
+    return len(changed)
+
+
+def rebuild_top_level_index(aggregates):
+    """Recompute the TopLevelCategory index from the rolled-up aggregates."""
+    from .models import TopLevelCategory
+
+    taken = set()
+    rows = [
+        TopLevelCategory(
+            name=path,
+            slug=unique_slug(slugify(path) or 'categoria', taken),
+            product_count=entry['product_count'],
+            active_count=entry['active_count'],
+            image_url=entry['first_image_url'],
+        )
+        for path, entry in sorted(aggregates.items())
+        if ' > ' not in path
+    ]
+    with transaction.atomic():
+        TopLevelCategory.objects.all().delete()
+        TopLevelCategory.objects.bulk_create(rows)
+    return len(rows)
+
+
+def rebuild_category_tree():
+    """
+    Materialize the category tree from the full paths.
+
+    Creates missing ancestor categories (e.g. "Glass" for "Glass > Round"),
+    then sets parent, depth and nested-set bounds, with siblings ordered by
+    name and one tree_id per top-level category.
+    """
+    from .models import Category
+
+    categories = {' > '.join(split_path(c.full_path)): c for c in Category.objects.all()}
+    categories.pop('', None)
+    taken = {c.slug for c in categories.values()}
+
+    missing = []
+    for path in list(categories):
+        parts = path.split(' > ')
+        for depth in range(1, len(parts)):
+            ancestor_path = ' > '.join(parts[:depth])
+            if ancestor_path not in categories:
+                ancestor = Category(
+                    full_path=ancestor_path,
+                    name=parts[depth - 1],
+                    parent_path=' > '.join(parts[:depth - 1]),
+                    slug=unique_slug(slugify(ancestor_path) or slugify(parts[depth - 1]) or 'categoria', taken),
+                )
+                categories[ancestor_path] = ancestor
+                missing.append(ancestor)
+    if missing:
+        Category.objects.bulk_create(missing)
+        created = Category.objects.in_bulk([c.full_path for c in missing], field_name='full_path')
+        for ancestor in missing:
+            categories[ancestor.full_path] = created[ancestor.full_path]
+
+    children = {}
+    roots = []
+    for path, category in categories.items():
+        parent_path, _, _ = path.rpartition(' > ')
+        parent = categories.get(parent_path) if parent_path else None
+        category._tree = {'parent_id': parent.pk if parent else None, 'depth': path.count(' > ')}
+        if parent:
+            children.setdefault(parent.pk, []).append(category)
+        else:
+            roots.append(category)
+
+    # Depth-first numbering of every tree
+    for tree_id, root in enumerate(sorted(roots, key=lambda c: c.name), start=1):
+        counter = 0
+        stack = [(root, False)]
+        while stack:
+            category, visited = stack.pop()
+            counter += 1
+            if visited:
+                category._tree['rgt'] = counter
+                continue
+            category._tree.update(tree_id=tree_id, lft=counter)
+            stack.append((category, True))
+            for child in sorted(children.get(category.pk, []), key=lambda c: c.name, reverse=True):
+                stack.append((child, False))
+
+    fields = ['parent_id', 'depth', 'tree_id', 'lft', 'rgt']
+    changed = []
+    for category in categories.values():
+        if any(getattr(category, field) != category._tree[field] for field in fields):
+            for field in fields:
+                setattr(category, field, category._tree[field])
+            changed.append(category)
+    Category.objects.bulk_update(changed, ['parent', 'depth', 'tree_id', 'lft', 'rgt'], batch_size=500)
+    return len(missing)
+
+
+def rebuild_catalog_indexes():
+    """Refresh the category tree, category aggregates and the top-level index after an import."""
+    rebuild_category_tree()
+    aggregates = aggregate_category_paths()
+    rebuild_category_aggregates(aggregates)
+    return rebuild_top_level_index(aggregates)
+
+
+def slug_matches(slug, base_slug):
+    """Return True if slug is base_slug or a collision variant of it (base_slug-N)."""
+    if slug == base_slug:
+        return True
+    _, _, counter = slug.rpartition('-')
+    return counter.isdigit() and slug == slug_variant(base_slug, int(counter))
+
+
+def product_base_slug(name, product_code):
+    """Return the slug a product's URL is derived from, cut to fit Product.slug."""
+    slug = slugify(name) or slugify(product_code) or 'producto'
+    return slug[:SLUG_MAX_LENGTH].rstrip('-')
+
+
+def rebuild_legacy_slug_redirects():
+    """
+    Keep pre-slug product URLs working.
+
+    Old URLs were /categoria/<slugify(top level)>/<slugify(name)>/ and resolved
+    to the first product by name in that top-level category. Wherever that
+    product's stored slug differs from the old one, record a redirect scoped
+    to the old category slug.
+    """
+    from .models import Product, ProductRedirect
+
+    redirects = {}
+    for product_id, name, slug, full_path in (
+        Product.objects.filter(category__isnull=False)
+        .order_by('name', 'id')
+        .values_list('id', 'name', 'slug', 'category__full_path')
+    ):
+        key = (slugify(top_level_name(full_path)), slugify(name))
+        if not key[0] or not key[1] or key in redirects:
+            continue
+        if len(key[0]) > SLUG_MAX_LENGTH or len(key[1]) > SLUG_MAX_LENGTH:
+            # Longer than the ProductRedirect slug columns, cannot be recorded
+            continue
+        redirects[key] = product_id if slug != key[1] else None
+
+    rows = [
+        ProductRedirect(category_slug=category_slug, old_slug=old_slug, product_id=product_id)
+        for (category_slug, old_slug), product_id in redirects.items()
+        if product_id is not None
+    ]
+    with transaction.atomic():
+        ProductRedirect.objects.exclude(category_slug='').delete()
+        ProductRedirect.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
@@ -0,0 +1,140 @@
+"""
+PostgreSQL fast path for catalog imports.
+
+Planning (content hashes, slugs, deactivations) is shared with the ORM
+importer; only the writes differ. Changed categories and products are
+streamed into temporary staging tables with COPY FROM STDIN and merged
+into the real tables with one set-based INSERT ... ON CONFLICT each.
+"""
+from django.db import connection
+
+from .catalog_import import PRODUCT_FIELDS, CatalogImporter
+from .models import Category, Product
+
+
+# Category columns refreshed when a changed category is already in the table
+CATEGORY_UPDATE_FIELDS = ['slug', 'image_url', 'content_hash']
+
+
+def supports_copy():
+    """Whether the default database can take the COPY fast path."""
+    return connection.vendor == 'postgresql'
+
+
+def _copy_value(value):
+    """Render a value as a COPY CSV field: NULL unquoted, everything else quoted."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = 't' if value else 'f'
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+class _LineReader:
+    """Read-only file object over an iterator of text lines, for psycopg2's copy_expert."""
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            length += len(line)
+        data = ''.join(parts)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Stream rows (sequences of Python values) into table with COPY FROM STDIN."""
+    quote = connection.ops.quote_name
+    sql = f'COPY {quote(table)} ({", ".join(quote(c) for c in columns)}) FROM STDIN WITH (FORMAT csv)'
+    lines = (','.join(_copy_value(value) for value in row) + '\n' for row in rows)
+    if hasattr(cursor, 'copy_expert'):  # psycopg2
+        cursor.copy_expert(sql, _LineReader(lines))
+    else:  # psycopg 3
+        with cursor.copy(sql) as copy:
+            for line in lines:
+                copy.write(line)
+
+
+class CopyCatalogImporter(CatalogImporter):
+    """CatalogImporter that writes through COPY and staging tables (PostgreSQL only)."""
+
+    def create_staging_table(self, cursor, name, model, fields, extra_columns):
+        """Create an empty temp table with the columns of fields plus extra (name, type) columns."""
+        quote = connection.ops.quote_name
+        columns = ', '.join(quote(field.column) for field in fields)
+        # Qualified with pg_temp so this can never drop a real table of the same name
+        cursor.execute(f'DROP TABLE IF EXISTS pg_temp.{quote(name)}')
+        cursor.execute(
+            f'CREATE TEMP TABLE {quote(name)} ON COMMIT DROP AS '
+            f'SELECT {columns} FROM {quote(model._meta.db_table)} WITH NO DATA'
+        )
+        cursor.execute(
+            f'ALTER TABLE {quote(name)} '
+            + ', '.join(f'ADD COLUMN {quote(column)} {column_type}' for column, column_type in extra_columns)
+        )
+
+    def write_categories(self, plan):
+        categories = plan.categories_to_create + plan.categories_to_update
+        if not categories:
+            return
+        quote = connection.ops.quote_name
+        fields = [field for field in Category._meta.concrete_fields if not field.primary_key]
+        columns = [field.column for field in fields]
+        rows = (
+            [field.get_db_prep_save(getattr(category, field.attname), connection) for field in fields] + [position]
+            for position, category in enumerate(categories)
+        )
+        with connection.cursor() as cursor:
+            self.create_staging_table(cursor, 'catalog_category_staging', Category, fields, [('position', 'integer')])
+            copy_rows(cursor, 'catalog_category_staging', columns + ['position'], rows)
+            # New categories are staged first, so they get the same ids as with the ORM path
+            cursor.execute(
+                f'INSERT INTO {quote(Category._meta.db_table)} ({", ".join(quote(c) for c in columns)}) '
+                f'SELECT {", ".join(quote(c) for c in columns)} FROM catalog_category_staging ORDER BY {quote("position")} '
+                f'ON CONFLICT ({quote("full_path")}) DO UPDATE SET '
+                + ', '.join(f'{quote(c)} = EXCLUDED.{quote(c)}' for c in CATEGORY_UPDATE_FIELDS)
+            )
+
+    def write_products(self, plan):
+        products = plan.products_to_create + plan.products_to_update
+        if not products:
+            return
+        quote = connection.ops.quote_name
+        # Category ids are resolved by joining on the path, so new categories
+        # never need to be read back
+        fields = [field for field in Product._meta.concrete_fields if not field.primary_key and field.name != 'category']
+        columns = [field.column for field in fields]
+        category_column = Product._meta.get_field('category').column
+        rows = (
+            [field.get_db_prep_save(getattr(product, field.attname), connection) for field in fields]
+            + [position, product.category.full_path if product.category is not None else None]
+            for position, product in enumerate(products)
+        )
+        update_columns = [Product._meta.get_field(name).column for name in PRODUCT_FIELDS]
+        with connection.cursor() as cursor:
+            self.create_staging_table(
+                cursor, 'catalog_product_staging', Product, fields,
+                [('position', 'integer'), ('category_path', 'varchar(500)')],
+            )
+            copy_rows(cursor, 'catalog_product_staging', columns + ['position', 'category_path'], rows)
+            cursor.execute(
+                f'INSERT INTO {quote(Product._meta.db_table)} '
+                f'({", ".join(quote(c) for c in columns)}, {quote(category_column)}) '
+                f'SELECT {", ".join("s." + quote(c) for c in columns)}, c.{quote("id")} '
+                f'FROM catalog_product_staging s '
+                f'LEFT JOIN {quote(Category._meta.db_table)} c ON c.{quote("full_path")} = s.{quote("category_path")} '
+                f'ORDER BY s.{quote("position")} '
+                f'ON CONFLICT ({quote("product_code")}) DO UPDATE SET '
+                + ', '.join(f'{quote(c)} = EXCLUDED.{quote(c)}' for c in update_columns)
+            )
@@ -0,0 +1,225 @@
+"""
+Catalog CSV parsing and normalization.
+
+This module only depends on the standard library so that the parallel
+parser's worker processes can import it without setting up Django.
+"""
+import csv
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+
+DELIMITER = ';'
+# Plain text columns copied from the CSV as-is (stripped)
+TEXT_COLUMNS = [
+    'vat', 'unit', 'barcode', 'producer', 'description', 'short_description', 'availability', 'delivery',
+    'seo_url',
+]
+IMAGE_COLUMNS = [f'images {i}' for i in range(1, 16)]
+# Chunks smaller than this are not worth a worker round trip
+MIN_CHUNK_BYTES = 256 * 1024
+
+
+class ChunkingError(Exception):
+    """A chunk did not start and end on row boundaries."""
+
+
+def parse_decimal(value, default=None):
+    """Parse a decimal that may use a comma as separator."""
+    value = (value or '').strip().replace(',', '.')
+    if not value:
+        return default
+    try:
+        return Decimal(value)
+    except (InvalidOperation, ValueError):
+        return default
+
+
+def parse_int(value, default=0):
+    """Parse an integer, falling back to default."""
+    try:
+        return int((value or '').strip())
+    except (ValueError, TypeError):
+        return default
+
+
+def hash_values(values):
+    """Return a stable SHA-256 hex digest of a list of values."""
+    payload = json.dumps(values, default=str, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_text(row, column, default=''):
+    """Stripped value of a column; default if the file has no such column, '' for a short row."""
+    return (row.get(column, default) or '').strip()
+
+
+def normalize_row(row):
+    """
+    Turn a CSV row into a product record, or None if it has no product code.
+
+    The record holds the product field values plus 'product_code' and
+    'category_path'; the category and slug are resolved by the importer.
+    """
+    product_code = get_text(row, 'product_code')
+    if not product_code:
+        return None
+
+    image_urls = [url for url in (get_text(row, column) for column in IMAGE_COLUMNS) if url]
+
+    record = {
+        'product_code': product_code,
+        'category_path': get_text(row, 'category'),
+        # A missing column means the default, an empty cell means empty
+        'active': get_text(row, 'active', '1') == '1',
+        'name': get_text(row, 'name'),
+        'price': parse_decimal(row.get('price'), Decimal('0')),
+        'weight': parse_decimal(row.get('weight')),
+        'stock': parse_int(row.get('stock')),
+        'currency': get_text(row, 'currency', 'EUR'),
+        # First image URL for backwards compatibility, all images as JSON
+        'image_url': image_urls[0] if image_urls else '',
+        'images_json': json.dumps(image_urls) if image_urls else '',
+    }
+    for column in TEXT_COLUMNS:
+        record[column] = get_text(row, column)
+    # Hash of everything the feed says about the product, to detect changed rows
+    record['content_hash'] = hash_values([record[key] for key in sorted(record)])
+    return record
+
+
+def record_images(record):
+    """Return the list of image URLs of a normalized record."""
+    return json.loads(record['images_json']) if record['images_json'] else []
+
+
+def read_catalog(file_path, workers=1):
+    """Yield normalized product records from a catalog CSV file, in file order."""
+    if workers > 1:
+        try:
+            records = parse_catalog_parallel(file_path, workers)
+        except ChunkingError:
+            # Stray quotes defeated the row-boundary scan; parse serially instead
+            records = None
+        if records is not None:
+            yield from records
+            return
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f, delimiter=DELIMITER):
+            record = normalize_row(row)
+            if record is not None:
+                yield record
+
+
+def dump_records(records):
+    """Serialize normalized records to gzipped JSON bytes."""
+    payload = json.dumps(list(records), default=str, ensure_ascii=False, separators=(',', ':'))
+    return gzip.compress(payload.encode('utf-8'))
+
+
+def load_records(data):
+    """Inverse of dump_records: return the list of normalized records."""
+    records = json.loads(gzip.decompress(bytes(data)).decode('utf-8'))
+    for record in records:
+        record['price'] = Decimal(record['price'])
+        if record['weight'] is not None:
+            record['weight'] = Decimal(record['weight'])
+    return records
+
+
+def _next_row_boundary(data, start, target, quotes):
+    """
+    Return the offset just after the first newline at or after target that
+    ends a row, plus the number of quotes between start and that offset.
+
+    A newline ends a row when the number of quote characters before it is
+    even, i.e. it is not inside a quoted field. quotes is the count between
+    start (a known row boundary) and target.
+    """
+    position = target
+    while True:
+        newline = data.find(b'\n', position)
+        if newline == -1:
+            return len(data), quotes + data[position:].count(b'"')
+        quotes += data[position:newline].count(b'"')
+        if quotes % 2 == 0:
+            return newline + 1, quotes
+        position = newline + 1
+
+
+def find_chunks(file_path, count):
+    """
+    Split a CSV file into roughly equal byte ranges that start and end on
+    row boundaries.
+
+    Returns (header_line, [(start, end), ...]); the first range starts
+    right after the header.
+    """
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return b'', []
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        header_end, _ = _next_row_boundary(data, 0, 0, 0)
+        header = data[:header_end]
+        chunk_size = max(MIN_CHUNK_BYTES, (size - header_end) // max(1, count) + 1)
+
+        chunks = []
+        start = header_end
+        while start < size:
+            target = min(size, start + chunk_size)
+            quotes = data[start:target].count(b'"')
+            end, _ = _next_row_boundary(data, start, target, quotes) if target < size else (size, 0)
+            chunks.append((start, end))
+            start = end
+    return header, chunks
+
+
+def parse_chunk(file_path, header, start, end):
+    """Parse and normalize the rows in one byte range of a CSV file."""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        text = (header + f.read(end - start)).decode('utf-8')
+    records = []
+    try:
+        # strict=True so a range that ends inside a quoted field raises
+        # instead of being silently parsed differently from the serial path
+        for row in csv.DictReader(io.StringIO(text, newline=''), delimiter=DELIMITER, strict=True):
+            record = normalize_row(row)
+            if record is not None:
+                records.append(record)
+    except csv.Error as e:
+        raise ChunkingError(f'Bytes {start}-{end}: {e}') from e
+    return records
+
+
+def parse_catalog_parallel(file_path, workers):
+    """
+    Parse a catalog CSV in a process pool and return its records.
+
+    The file is split into byte ranges on row boundaries; each worker parses
+    and normalizes one range and the chunks are joined in file order, so the
+    result is identical to the serial parser. Returns None when the file is
+    too small to split or there is only one CPU, and raises ChunkingError
+    when a range turns out not to align with rows.
+
+    Every record is pickled back to this process, which costs about half
+    as much as parsing it, so workers only pay off with two or more spare
+    CPUs and files of tens of MB; on one CPU the pool is pure overhead.
+    """
+    workers = min(workers, os.cpu_count() or 1)
+    if workers < 2:
+        return None
+    header, chunks = find_chunks(file_path, workers * 4)
+    if len(chunks) <= 1:
+        return None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(parse_chunk, file_path, header, start, end) for start, end in chunks]
+        # Every chunk must succeed before any record is handed to the writer
+        chunk_records = [future.result() for future in futures]
+    return [record for records in chunk_records for record in records]
@@ -0,0 +1,412 @@
+"""
+Bulk catalog import used by the load_catalog command.
+
+The CSV is parsed once into normalized records, each carrying a hash of
+its content. Existing categories and products are preloaded into dicts,
+only rows whose hash changed are written, and all writes go through
+bulk_create / bulk_update in batches inside a single transaction.
+
+The same transaction checks the written rows against the feed and then
+activates a new CatalogVersion, so readers switch from the old catalog to
+the complete new one in a single commit.
+"""
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import DecimalValidator
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.utils.text import slugify
+
+from .catalog import (
+    activate_catalog_version, product_base_slug, rebuild_catalog_indexes, rebuild_legacy_slug_redirects, slug_matches, split_path,
+    unique_slug,
+)
+from .catalog_csv import dump_records, hash_values, record_images
+from .jobs import report_progress
+from .models import CatalogVersion, Category, Product, ProductImage, ProductRedirect, TopLevelCategory
+
+
+# Product fields written by the import, in model order
+PRODUCT_FIELDS = [
+    'active', 'name', 'slug', 'price', 'vat', 'unit', 'category', 'barcode', 'weight', 'producer',
+    'description', 'short_description', 'stock', 'availability', 'delivery', 'currency', 'seo_url',
+    'image_url', 'content_hash',
+]
+DEFAULT_BATCH_SIZE = 1000
+
+
+def batched(items, size):
+    """Yield successive lists of at most size items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def record_error(record):
+    """
+    Why a normalized record cannot be stored, or None.
+
+    Checks the values against the column sizes, which a batch write would
+    otherwise reject as a whole (PostgreSQL does not truncate like SQLite).
+    """
+    for name in ('product_code', *PRODUCT_FIELDS):
+        field = Product._meta.get_field(name)
+        value = record.get(name)
+        if isinstance(value, Decimal):
+            try:
+                DecimalValidator(field.max_digits, field.decimal_places)(value)
+            except ValidationError as e:
+                return f'{name} {value}: {" ".join(e.messages)}'
+        elif isinstance(value, str) and field.max_length and len(value) > field.max_length:
+            return f'{name} longer than {field.max_length} characters'
+    low, high = connection.ops.integer_field_range('IntegerField')
+    if not low <= record['stock'] <= high:
+        return f'stock {record["stock"]} out of range'
+    category_path = record['category_path']
+    if len(category_path) > Category._meta.get_field('full_path').max_length:
+        return 'category longer than the full_path column'
+    if len((split_path(category_path) or [''])[-1]) > Category._meta.get_field('name').max_length:
+        return 'category name longer than the name column'
+    if any(len(url) > ProductImage._meta.get_field('url').max_length for url in record_images(record)):
+        return 'image URL longer than the url column'
+    return None
+
+
+class CatalogValidationError(Exception):
+    """The imported rows did not match the feed; the import was rolled back."""
+
+
+class CatalogPlan:
+    """The changes an import would make, computed before anything is written."""
+
+    def __init__(self):
+        self.categories_to_create = []
+        self.categories_to_update = []
+        self.products_to_create = []
+        self.products_to_update = []
+        self.products_to_deactivate = []  # (pk, product code) of products missing from the feed
+        self.unchanged = []  # product codes whose content hash did not change
+        self.renamed_slugs = {}  # old slug -> product code
+
+    @property
+    def has_changes(self):
+        return bool(
+            self.categories_to_create or self.categories_to_update or self.products_to_create
+            or self.products_to_update or self.products_to_deactivate
+        )
+
+
+class CatalogImporter:
+    """
+    Write normalized catalog records to the database in bulk.
+
+    Only rows whose content hash changed are written; products that are
+    missing from the feed are deactivated. With max_shrink set, an import
+    that would cut the number of active products by more than that fraction
+    is refused.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, clear=False, source='', max_shrink=None):
+        self.batch_size = batch_size
+        self.clear = clear
+        self.source = str(source)
+        self.max_shrink = max_shrink
+        self.version = None  # CatalogVersion activated by run(), if anything changed
+        self.skipped = []  # (product code, reason) of rows that cannot be stored
+        self.stats = {
+            'rows': 0,
+            'rows_skipped': 0,
+            'categories_created': 0,
+            'categories_updated': 0,
+            'products_created': 0,
+            'products_updated': 0,
+            'products_unchanged': 0,
+            'products_removed': 0,
+            'images_written': 0,
+            'top_level_categories': 0,
+            'seconds': 0.0,
+        }
+
+    def collect(self, records):
+        """
+        Deduplicate records by product code; later rows win, as with sequential upserts.
+
+        Rows that cannot be stored are skipped and listed in self.skipped as
+        (product code, reason); their products count as missing from the feed.
+        """
+        products = {}
+        for record in records:
+            self.stats['rows'] += 1
+            error = record_error(record)
+            if error:
+                self.skipped.append((record['product_code'], error))
+                continue
+            products[record['product_code']] = record
+        self.stats['rows_skipped'] = len(self.skipped)
+        return list(products.values())
+
+    def plan(self, records):
+        """Compute the changes for the given records without writing anything."""
+        plan = CatalogPlan()
+        categories = self.plan_categories(records, plan)
+        self.plan_products(records, categories, plan)
+        self.stats.update(
+            categories_created=len(plan.categories_to_create),
+            categories_updated=len(plan.categories_to_update),
+            products_created=len(plan.products_to_create),
+            products_updated=len(plan.products_to_update),
+            products_unchanged=len(plan.unchanged),
+            products_removed=len(plan.products_to_deactivate),
+        )
+        return plan
+
+    def run(self, records, dry_run=False):
+        """Import all records in one transaction and return (plan, stats)."""
+        started = time.perf_counter()
+        records = self.collect(records)
+
+        with transaction.atomic():
+            # Lock the active version so concurrent imports run one after the other
+            previous = CatalogVersion.objects.select_for_update().filter(is_active=True).first()
+            plan = self.plan(records)
+            if not dry_run:
+                report_progress(20, message='Writing changes')
+                self.apply(plan)
+                if plan.has_changes or self.clear:
+                    report_progress(90, message='Validating and activating')
+                    self.version = self.publish(records, previous)
+
+        self.stats['seconds'] = time.perf_counter() - started
+        return plan, self.stats
+
+    def plan_categories(self, records, plan):
+        """Plan category inserts/updates; return a dict of full path -> Category."""
+        images = {}
+        for record in records:
+            if record['category_path'] and record['image_url']:
+                images.setdefault(record['category_path'], record['image_url'])
+
+        categories = {} if self.clear else {category.full_path: category for category in Category.objects.all()}
+        taken = {category.slug for category in categories.values()}
+
+        # Unique paths in order of first appearance, so slugs are assigned deterministically
+        for category_path in dict.fromkeys(r['category_path'] for r in records if r['category_path']):
+            parts = split_path(category_path)
+            category_name = parts[-1] if parts else category_path
+            slug = slugify(category_path) or slugify(category_name)
+            image_url = images.get(category_path, '')
+            content_hash = hash_values([category_path, image_url])
+            category = categories.get(category_path)
+            if category is None:
+                category = Category(
+                    full_path=category_path,
+                    name=category_name,
+                    parent_path=' > '.join(parts[:-1]),
+                    slug=unique_slug(slug, taken),
+                    image_url=image_url,
+                    content_hash=content_hash,
+                )
+                categories[category_path] = category
+                plan.categories_to_create.append(category)
+                continue
+            if category.content_hash == content_hash and category.slug:
+                continue
+            # The feed changed for this category: fill in a missing slug and
+            # take the new first product image
+            if not category.slug:
+                category.slug = unique_slug(slug, taken)
+            if image_url and (category.content_hash or not category.image_url):
+                category.image_url = image_url
+            category.content_hash = content_hash
+            plan.categories_to_update.append(category)
+        return categories
+
+    def plan_products(self, records, categories, plan):
+        """Plan product inserts, updates and deactivations by comparing content hashes."""
+        existing = {} if self.clear else {
+            product_code: (pk, slug, content_hash, active)
+            for pk, product_code, slug, content_hash, active in Product.objects.values_list(
+                'pk', 'product_code', 'slug', 'content_hash', 'active'
+            )
+        }
+        taken_slugs = {values[1] for values in existing.values()}
+
+        seen = set()
+        for record in records:
+            product_code = record['product_code']
+            seen.add(product_code)
+            pk, slug, content_hash, active = existing.get(product_code, (None, None, None, None))
+            if pk and content_hash == record['content_hash'] and active == record['active']:
+                plan.unchanged.append(product_code)
+                continue
+
+            # Keep the current slug unless the name no longer produces it
+            base_slug = product_base_slug(record['name'], product_code)
+            if not slug or not slug_matches(slug, base_slug):
+                if slug:
+                    plan.renamed_slugs[slug] = product_code
+                slug = unique_slug(base_slug, taken_slugs)
+
+            product = Product(
+                pk=pk,
+                product_code=product_code,
+                slug=slug,
+                category=categories.get(record['category_path']) if record['category_path'] else None,
+                **{field: record[field] for field in PRODUCT_FIELDS if field not in ('slug', 'category')},
+            )
+            product.feed_images = record_images(record)
+            (plan.products_to_update if pk else plan.products_to_create).append(product)
+
+        # Products that vanished from the feed are deactivated, not deleted
+        plan.products_to_deactivate = [
+            (pk, product_code)
+            for product_code, (pk, _, _, active) in existing.items()
+            if product_code not in seen and active
+        ]
+
+    def apply(self, plan):
+        """Write a plan to the database."""
+        if self.clear:
+            Product.objects.all().delete()
+            Category.objects.all().delete()
+
+        self.write_categories(plan)
+        self.write_products(plan)
+        self.write_images(plan)
+
+        # Clearing the hash makes a product that comes back to the feed count as updated
+        for batch in batched([pk for pk, _ in plan.products_to_deactivate], self.batch_size):
+            Product.objects.filter(pk__in=batch).update(active=False, content_hash='')
+
+        self.redirect_renamed_slugs(plan.renamed_slugs)
+        if plan.has_changes or self.clear:
+            rebuild_legacy_slug_redirects()
+            self.stats['top_level_categories'] = rebuild_catalog_indexes()
+        else:
+            self.stats['top_level_categories'] = TopLevelCategory.objects.count()
+
+    def write_categories(self, plan):
+        """Insert new categories and update changed ones."""
+        for batch in batched(plan.categories_to_create, self.batch_size):
+            Category.objects.bulk_create(batch)
+        Category.objects.bulk_update(
+            plan.categories_to_update, ['slug', 'image_url', 'content_hash'], batch_size=self.batch_size,
+        )
+        if any(category.pk is None for category in plan.categories_to_create):
+            # Backends without RETURNING: reload to get the new primary keys
+            created = Category.objects.in_bulk([c.full_path for c in plan.categories_to_create], field_name='full_path')
+            for product in plan.products_to_create + plan.products_to_update:
+                if product.category is not None and product.category.pk is None:
+                    product.category = created[product.category.full_path]
+
+    def write_products(self, plan):
+        """Insert new products and update changed ones."""
+        to_write = plan.products_to_create + plan.products_to_update
+        if connection.features.supports_update_conflicts_with_target:
+            # One INSERT ... ON CONFLICT (product_code) DO UPDATE per batch
+            for batch in batched(to_write, self.batch_size):
+                Product.objects.bulk_create(
+                    batch, update_conflicts=True, unique_fields=['product_code'], update_fields=PRODUCT_FIELDS,
+                )
+        else:
+            for batch in batched(plan.products_to_create, self.batch_size):
+                Product.objects.bulk_create(batch)
+            Product.objects.bulk_update(plan.products_to_update, PRODUCT_FIELDS, batch_size=self.batch_size)
+
+    def write_images(self, plan):
+        """
+        Replace the ProductImage rows of written products whose image list changed.
+
+        Downloaded copies are kept for URLs the product still uses.
+        """
+        products = plan.products_to_create + plan.products_to_update
+        # New products get their ids from the database (bulk inserts do not always return them)
+        new_codes = [product.product_code for product in products if product.pk is None]
+        ids = {}
+        for batch in batched(new_codes, self.batch_size):
+            ids.update(Product.objects.filter(product_code__in=batch).values_list('product_code', 'id'))
+        wanted = {product.pk or ids[product.product_code]: product.feed_images for product in products}
+
+        existing = {}
+        for batch in batched([product.pk for product in plan.products_to_update], self.batch_size):
+            for product_id, url, blob_id in (
+                ProductImage.objects.filter(product_id__in=batch)
+                .order_by('product_id', 'position')
+                .values_list('product_id', 'url', 'blob_id')
+            ):
+                existing.setdefault(product_id, []).append((url, blob_id))
+
+        changed = [
+            product_id for product_id, urls in wanted.items()
+            if [url for url, _ in existing.get(product_id, [])] != urls
+        ]
+        for batch in batched([product_id for product_id in changed if product_id in existing], self.batch_size):
+            ProductImage.objects.filter(product_id__in=batch).delete()
+        rows = []
+        for product_id in changed:
+            blobs = dict(existing.get(product_id, []))
+            rows.extend(
+                ProductImage(product_id=product_id, position=position, url=url, blob_id=blobs.get(url))
+                for position, url in enumerate(wanted[product_id])
+            )
+        ProductImage.objects.bulk_create(rows, batch_size=self.batch_size)
+        self.stats['images_written'] = len(rows)
+
+    def validate(self, records, previous=None):
+        """
+        Check the written catalog against the feed records.
+
+        Returns (active products, categories); raises CatalogValidationError
+        when they do not match the feed or the catalog shrank too much.
+        """
+        expected_active = sum(1 for record in records if record['active'])
+        counts = Product.objects.aggregate(total=Count('id'), active=Count('id', filter=Q(active=True)))
+        if counts['active'] != expected_active or counts['total'] < len(records):
+            raise CatalogValidationError(
+                f'Expected {expected_active} active of {len(records)} products, '
+                f'found {counts["active"]} active of {counts["total"]}'
+            )
+        paths = {record['category_path'] for record in records if record['category_path']}
+        missing = paths - set(Category.objects.values_list('full_path', flat=True))
+        if missing:
+            raise CatalogValidationError(f'{len(missing)} categories missing, e.g. {sorted(missing)[0]!r}')
+        if self.max_shrink is not None and previous is not None and previous.product_count:
+            if expected_active < previous.product_count * (1 - self.max_shrink):
+                raise CatalogValidationError(
+                    f'Active products would drop from {previous.product_count} to {expected_active} '
+                    f'(more than {self.max_shrink:.0%})'
+                )
+        return expected_active, Category.objects.count()
+
+    def publish(self, records, previous=None):
+        """Validate the written catalog and activate a new version for it."""
+        product_count, category_count = self.validate(records, previous)
+        version = CatalogVersion.objects.create(
+            source=self.source[:500],
+            product_count=product_count,
+            category_count=category_count,
+            records=dump_records(records),
+        )
+        activate_catalog_version(version)
+        # Only the newest versions keep their records for rollback
+        stale = list(
+            CatalogVersion.objects.exclude(records=None).values_list('pk', flat=True)[settings.CATALOG_VERSIONS_KEPT:]
+        )
+        CatalogVersion.objects.filter(pk__in=stale).update(records=None)
+        return version
+
+    def redirect_renamed_slugs(self, renamed_slugs):
+        """Point old slugs of renamed products at their new slug."""
+        if renamed_slugs:
+            product_ids = dict(
+                Product.objects.filter(product_code__in=set(renamed_slugs.values())).values_list('product_code', 'id')
+            )
+            for old_slug, product_code in renamed_slugs.items():
+                ProductRedirect.objects.update_or_create(
+                    category_slug='', old_slug=old_slug,
+                    defaults={'product_id': product_ids[product_code]},
+                )
+        # A slug that is live again no longer needs a redirect
+        ProductRedirect.objects.filter(category_slug='', old_slug__in=Product.objects.values('slug')).delete()
@@ -0,0 +1,621 @@
+"""
+Read-only binary snapshot of the catalog, shared by all web processes.
+
+export_snapshot() writes the categories, products, product images and
+their blobs, plus the slug and sort indexes the pages need, to a single
+file: one fixed-width column per model field (native machine types, as in
+the array module) and a string table every text value points into. Web
+processes map the file with mmap, so the operating system keeps one copy
+in memory however many Gunicorn workers read it, and category listings and
+product pages are served from it without a database round trip.
+
+A snapshot is only used while it was built from the live catalog version
+(see catalog.get_catalog_version()). Without a snapshot file, or while it
+lags behind the database, the views fall back to the ORM.
+"""
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+
+from .catalog import VERSION_FIELDS, _build_category_resolver, get_catalog_version, get_category_tree
+from .models import CatalogVersion, Category, ImageBlob, Product, ProductImage, ProductRedirect, TopLevelCategory
+from .pagination import DEFAULT_PAGE_SIZE, DEFAULT_SORT, SORT_OPTIONS, decode_cursor, encode_cursor
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RXCATSNP'
+FORMAT_VERSION = 1
+# Magic, format version, length of the JSON directory that follows
+HEADER = struct.Struct('<8sII')
+# Sections start at multiples of this, so every column is aligned for its type
+ALIGNMENT = 8
+# Stored for NULL in integer and decimal columns
+NULL_INT = -2 ** 63
+# Stored for "no row" in index columns
+NO_ROW = -1
+UNLISTED = 2 ** 32 - 1
+# Tables in the snapshot: name -> (model, ordering)
+TABLES = {
+    'category': (Category, ['tree_id', 'lft']),
+    'toplevel': (TopLevelCategory, ['name']),
+    'product': (Product, ['id']),
+    'image': (ProductImage, ['product_id', 'position']),
+    'blob': (ImageBlob, ['id']),
+    'redirect': (ProductRedirect, ['old_slug', 'category_slug']),
+}
+
+
+class SnapshotError(Exception):
+    """A snapshot file is missing, truncated or written by another format version."""
+
+
+def _field_kind(field):
+    """How a model field is stored: as an int, a bool, a scaled decimal or a string (JSON included)."""
+    if isinstance(field, models.DecimalField):
+        return 'decimal'
+    if isinstance(field, models.BooleanField):
+        return 'bool'
+    if isinstance(field, models.JSONField):
+        return 'json'
+    if isinstance(field, (models.CharField, models.TextField, models.FileField)):
+        return 'str'
+    if isinstance(field, (models.IntegerField, models.ForeignKey)):
+        return 'int'
+    # Dates are not shown on catalog pages; snapshot rows have them as None
+    return None
+
+
+TYPECODES = {'int': 'q', 'bool': 'B', 'decimal': 'q', 'str': 'I', 'json': 'I'}
+
+
+def _stored_fields(model):
+    return [(field, _field_kind(field)) for field in model._meta.concrete_fields]
+
+
+def _position(model, attname):
+    """Position of a field in the rows of a model's table."""
+    return [field.attname for field in model._meta.concrete_fields].index(attname)
+
+
+def _version_key(version):
+    """Comparable form of a get_catalog_version() value, as stored in the snapshot."""
+    pk, *timestamps = version
+    return [pk, *(timestamp.isoformat() if timestamp else '' for timestamp in timestamps)]
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class SnapshotWriter:
+    """Collects columns and the string table, then writes them out as a snapshot file."""
+
+    def __init__(self):
+        # String 0 is None
+        self.strings = {}
+        self.string_data = bytearray()
+        self.string_offsets = array('I', [0, 0])
+        self.sections = {}
+
+    def string(self, value):
+        if value is None:
+            return 0
+        ref = self.strings.get(value)
+        if ref is None:
+            ref = self.strings[value] = len(self.string_offsets) - 1
+            self.string_data += value.encode('utf-8')
+            self.string_offsets.append(len(self.string_data))
+        return ref
+
+    def encode(self, field, kind, value):
+        if kind == 'str':
+            return self.string(value)
+        if kind == 'json':
+            return self.string(None if value is None else json.dumps(value))
+        if value is None:
+            return NULL_INT
+        if kind == 'decimal':
+            return int(value.scaleb(field.decimal_places))
+        return int(value)
+
+    def table(self, name, model, rows):
+        """Store rows (tuples of every concrete field, in model order) as one column per field."""
+        for index, (field, kind) in enumerate(_stored_fields(model)):
+            if kind is not None:
+                self.sections[f'{name}.{field.attname}'] = array(
+                    TYPECODES[kind], (self.encode(field, kind, row[index]) for row in rows),
+                )
+
+    def write(self, path, directory):
+        """Write the snapshot atomically: readers see the old file or the complete new one."""
+        self.sections['strings'] = bytes(self.string_data)
+        self.sections['string_offsets'] = self.string_offsets
+        layout = {}
+        offset = 0
+        for name, data in self.sections.items():
+            typecode = data.typecode if isinstance(data, array) else 'B'
+            length = len(data) * (data.itemsize if isinstance(data, array) else 1)
+            layout[name] = [offset, length, typecode]
+            offset = _align(offset + length)
+        directory = dict(directory, byteorder=sys.byteorder, sections=layout)
+        encoded = json.dumps(directory).encode('utf-8')
+        data_start = _align(HEADER.size + len(encoded))
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+                f.write(encoded)
+                for name, data in self.sections.items():
+                    f.write(b'\0' * (data_start + layout[name][0] - f.tell()))
+                    f.write(data.tobytes() if isinstance(data, array) else data)
+            # Readable by web processes running as another user than the worker
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return data_start + offset
+
+
+def _active_version():
+    """The live catalog version, read from the database (not this process's cached value)."""
+    return CatalogVersion.objects.filter(is_active=True).values_list(*VERSION_FIELDS).first()
+
+
+def _collect(writer):
+    """Read the catalog into writer; return the row counts."""
+    rows = {}
+    for name, (model, ordering) in TABLES.items():
+        attnames = [field.attname for field, _ in _stored_fields(model)]
+        queryset = model.objects.order_by(*ordering)
+        if model is ImageBlob:
+            # Only the blobs shown on product pages
+            queryset = queryset.filter(pk__in=ProductImage.objects.exclude(blob=None).values('blob_id'))
+        rows[name] = list(queryset.values_list(*attnames))
+    # Python order, so lookups can binary search with Python comparisons
+    name = _position(TopLevelCategory, 'name')
+    rows['toplevel'].sort(key=lambda row: row[name])
+    old_slug, category_slug = _position(ProductRedirect, 'old_slug'), _position(ProductRedirect, 'category_slug')
+    rows['redirect'].sort(key=lambda row: (row[old_slug], row[category_slug]))
+    for name, (model, _) in TABLES.items():
+        writer.table(name, model, rows[name])
+
+    product_ids = [row[0] for row in rows['product']]
+    product_index = {pk: index for index, pk in enumerate(product_ids)}
+    lft = _position(Category, 'lft')
+    category_lft = {row[0]: row[lft] for row in rows['category']}
+
+    # Images of product i are rows images[i]:images[i + 1] of the image table
+    image_offsets = array('I', [0] * (len(product_ids) + 1))
+    image_product = _position(ProductImage, 'product_id')
+    for row in rows['image']:
+        image_offsets[product_index[row[image_product]] + 1] += 1
+    for index in range(len(product_ids)):
+        image_offsets[index + 1] += image_offsets[index]
+    writer.sections['product.images'] = image_offsets
+    blob_index = {row[0]: index for index, row in enumerate(rows['blob'])}
+    image_blob = _position(ProductImage, 'blob_id')
+    writer.sections['image.blob'] = array('i', (blob_index.get(row[image_blob], NO_ROW) for row in rows['image']))
+    redirect_product = _position(ProductRedirect, 'product_id')
+    writer.sections['redirect.product'] = array(
+        'i', (product_index.get(row[redirect_product], NO_ROW) for row in rows['redirect']),
+    )
+
+    # Slug indexes: products by slug, and URL slug -> top-level category name
+    slug = _position(Product, 'slug')
+    writer.sections['product.by_slug'] = array(
+        'I', sorted(range(len(product_ids)), key=lambda index: rows['product'][index][slug]),
+    )
+    resolver = sorted(_build_category_resolver().items())
+    writer.sections['resolver.slug'] = array('I', (writer.string(slug) for slug, _ in resolver))
+    writer.sections['resolver.name'] = array('I', (writer.string(name) for _, name in resolver))
+
+    # Listing order per sort option: products grouped by category tree, each
+    # tree sorted like paginate_products sorts it. Sorted here rather than by
+    # the database, whose collation may order names differently from the
+    # Python comparisons _seek binary searches with
+    category = _position(Product, 'category_id')
+    writer.sections['product.category_lft'] = array(
+        'I', (category_lft.get(row[category], 0) for row in rows['product']),
+    )
+    tree = _position(Category, 'tree_id')
+    category_tree = {row[0]: row[tree] for row in rows['category']}
+    listed = [index for index, row in enumerate(rows['product']) if row[category] is not None]
+    for sort, (field, descending) in SORT_OPTIONS.items():
+        value = _position(Product, field)
+        listing = sorted(
+            listed, key=lambda index: (rows['product'][index][value], product_ids[index]), reverse=descending,
+        )
+        # Stable, so each tree keeps the order above
+        listing.sort(key=lambda index: category_tree[rows['product'][index][category]])
+        order = array('I', listing)
+        rank = array('I', [UNLISTED] * len(product_ids))
+        for position, index in enumerate(order):
+            rank[index] = position
+        writer.sections[f'order.{sort}'] = order
+        writer.sections[f'rank.{sort}'] = rank
+        if 'tree.offsets' not in writer.sections:
+            # Products of tree t are positions offsets[t]:offsets[t + 1] of every order
+            tree_ids = [category_tree[rows['product'][index][category]] for index in listing]
+            offsets = array('I', [0] * ((max(tree_ids) if tree_ids else 0) + 2))
+            for tree_id in tree_ids:
+                offsets[tree_id + 1] += 1
+            for tree_id in range(len(offsets) - 1):
+                offsets[tree_id + 1] += offsets[tree_id]
+            writer.sections['tree.offsets'] = offsets
+    return {name: len(table_rows) for name, table_rows in rows.items()}
+
+
+def export_snapshot(path=None, force=False):
+    """
+    Write the snapshot of the live catalog version to path (CATALOG_SNAPSHOT_PATH).
+
+    Does nothing if the file already holds that version, unless force is
+    set. Returns a dict of stats, or None when there is no active catalog
+    or snapshots are disabled (no path).
+    """
+    path = path or settings.CATALOG_SNAPSHOT_PATH
+    if not path:
+        return None
+    started = time.monotonic()
+    version = _active_version()
+    if version is None:
+        return None
+    if not force and read_snapshot_version(path) == _version_key(version):
+        return {'skipped': True, 'version': version[0]}
+
+    # Each query sees the latest commit, so re-read if an import or image
+    # sync committed a new version while this one was being read
+    for _ in range(3):
+        writer = SnapshotWriter()
+        with transaction.atomic():
+            counts = _collect(writer)
+        current = _active_version()
+        if current == version:
+            break
+        version = current
+        if version is None:
+            return None
+    else:
+        raise SnapshotError('The catalog kept changing while the snapshot was exported')
+
+    size = writer.write(path, {'catalog_version': _version_key(version), 'counts': counts})
+    _reset()
+    return {
+        'skipped': False,
+        'version': version[0],
+        'products': counts['product'],
+        'categories': counts['category'],
+        'bytes': size,
+        'seconds': time.monotonic() - started,
+    }
+
+
+def read_snapshot_version(path):
+    """Return the catalog version key a snapshot file was built from, or None."""
+    try:
+        with open(path, 'rb') as f:
+            magic, format_version, directory_length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or format_version != FORMAT_VERSION:
+                return None
+            return json.loads(f.read(directory_length))['catalog_version']
+    except (OSError, ValueError, struct.error, KeyError):
+        return None
+
+
+class _Table:
+    """Rows of one model in the snapshot, turned back into model instances on demand."""
+
+    def __init__(self, snapshot, name, model):
+        self.snapshot = snapshot
+        self.model = model
+        self.fields = _stored_fields(model)
+        self.attnames = [field.attname for field, _ in self.fields]
+        self.by_attname = {field.attname: (field, kind) for field, kind in self.fields}
+        self.columns = {
+            field.attname: snapshot.column(f'{name}.{field.attname}')
+            for field, kind in self.fields if kind is not None
+        }
+        self.length = len(self.columns['id'])
+
+    def value(self, index, field, kind):
+        if kind is None:
+            return None
+        stored = self.columns[field.attname][index]
+        if kind == 'str':
+            return self.snapshot.string(stored)
+        if kind == 'json':
+            text = self.snapshot.string(stored)
+            return None if text is None else json.loads(text)
+        if stored == NULL_INT:
+            return None
+        if kind == 'decimal':
+            return Decimal(stored).scaleb(-field.decimal_places)
+        if kind == 'bool':
+            return bool(stored)
+        return stored
+
+    def get(self, index, attname):
+        return self.value(index, *self.by_attname[attname])
+
+    def instance(self, index):
+        values = [self.value(index, field, kind) for field, kind in self.fields]
+        return self.model.from_db(DEFAULT_DB_ALIAS, self.attnames, values)
+
+
+class CatalogSnapshot:
+    """A snapshot file mapped into memory. Read-only, so threads share it freely."""
+
+    def __init__(self, path):
+        try:
+            with open(path, 'rb') as f:
+                self.stat = os.fstat(f.fileno())
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise SnapshotError(f'Cannot map {path}: {e}') from e
+        buffer = memoryview(self._mmap)
+        try:
+            magic, format_version, directory_length = HEADER.unpack_from(buffer)
+            if magic != MAGIC or format_version != FORMAT_VERSION:
+                raise SnapshotError(f'{path} is not a format {FORMAT_VERSION} catalog snapshot')
+            directory = json.loads(bytes(buffer[HEADER.size:HEADER.size + directory_length]))
+            if directory['byteorder'] != sys.byteorder:
+                raise SnapshotError(f'{path} was written on a {directory["byteorder"]}-endian machine')
+            data_start = _align(HEADER.size + directory_length)
+            self._columns = {
+                name: buffer[data_start + offset:data_start + offset + length].cast(typecode)
+                for name, (offset, length, typecode) in directory['sections'].items()
+            }
+            if data_start + max((offset + length for offset, length, _ in directory['sections'].values()), default=0) > len(buffer):
+                raise SnapshotError(f'{path} is truncated')
+        except (struct.error, ValueError, KeyError, TypeError) as e:
+            raise SnapshotError(f'{path} is not a valid catalog snapshot: {e}') from e
+        self.version = directory['catalog_version']
+        self.counts = directory['counts']
+        self._strings = self._columns['strings']
+        self._string_offsets = self._columns['string_offsets']
+        self.tables = {name: _Table(self, name, model) for name, (model, _) in TABLES.items()}
+
+    def column(self, name):
+        return self._columns[name]
+
+    def string(self, ref):
+        if ref == 0:
+            return None
+        return str(self._strings[self._string_offsets[ref]:self._string_offsets[ref + 1]], 'utf-8')
+
+    def _find(self, index_column, value, key):
+        """Binary search a column of row indexes sorted by key(row); return the first position with key == value."""
+        position = bisect.bisect_left(index_column, value, key=key)
+        return position if position < len(index_column) and key(index_column[position]) == value else None
+
+    # Categories
+
+    def categories(self):
+        """All categories as Category instances, in tree order (tree_id, lft)."""
+        table = self.tables['category']
+        return [table.instance(index) for index in range(table.length)]
+
+    def resolve_category_slug(self, slug):
+        """Return the top-level category name a URL slug refers to, or None."""
+        slugs = self.column('resolver.slug')
+        position = bisect.bisect_left(slugs, slug, key=self.string)
+        if position < len(slugs) and self.string(slugs[position]) == slug:
+            return self.string(self.column('resolver.name')[position])
+        return None
+
+    def top_level_slugs(self):
+        """Dict of top-level category name -> URL slug."""
+        table = self.tables['toplevel']
+        return {table.get(index, 'name'): table.get(index, 'slug') for index in range(table.length)}
+
+    # Products
+
+    def _product_index(self, pk):
+        ids = self.tables['product'].columns['id']
+        index = bisect.bisect_left(ids, pk)
+        return index if index < len(ids) and ids[index] == pk else None
+
+    def product(self, index):
+        """The product at index as a Product instance, with its images and category attached."""
+        product = self.tables['product'].instance(index)
+        images_table = self.tables['image']
+        blobs_table = self.tables['blob']
+        blob_column = self.column('image.blob')
+        offsets = self.column('product.images')
+        images = []
+        for image_index in range(offsets[index], offsets[index + 1]):
+            image = images_table.instance(image_index)
+            if blob_column[image_index] != NO_ROW:
+                image.blob = blobs_table.instance(blob_column[image_index])
+            image.product = product
+            images.append(image)
+        # Same cache prefetch_product_images() fills, so templates need no query
+        queryset = product.images.get_queryset()
+        queryset._result_cache = images
+        queryset._prefetch_done = True
+        product._prefetched_objects_cache = {'images': queryset}
+        if product.category_id is not None:
+            category = get_category_tree()['by_id'].get(product.category_id)
+            if category is not None:
+                product.category = category
+        return product
+
+    def product_by_slug(self, slug):
+        """Return the product with the given slug, or None."""
+        slugs = self.tables['product'].columns['slug']
+        position = self._find(self.column('product.by_slug'), slug, key=lambda index: self.string(slugs[index]))
+        return None if position is None else self.product(self.column('product.by_slug')[position])
+
+    def product_redirects(self, old_slug, category_slugs):
+        """Return a dict of category slug -> target Product of the redirects from old_slug."""
+        table = self.tables['redirect']
+        old_slugs = table.columns['old_slug']
+        rows = range(table.length)
+        start = bisect.bisect_left(rows, old_slug, key=lambda index: self.string(old_slugs[index]))
+        end = bisect.bisect_right(rows, old_slug, lo=start, key=lambda index: self.string(old_slugs[index]))
+        targets = self.column('redirect.product')
+        redirects = {}
+        for index in range(start, end):
+            category_slug = table.get(index, 'category_slug')
+            if category_slug in category_slugs and targets[index] != NO_ROW:
+                redirects[category_slug] = self.product(targets[index])
+        return redirects
+
+    # Listings
+
+    def _seek(self, sort, start, end, key, after):
+        """
+        Position in the listing of the cursor key: the first product after
+        it if after is set, else the first product not before it.
+        """
+        field, descending = SORT_OPTIONS[sort]
+        order = self.column(f'order.{sort}')
+        products = self.tables['product']
+        value, pk = key
+        index = self._product_index(pk)
+        if index is not None:
+            position = self.column(f'rank.{sort}')[index]
+            if start <= position < end and products.get(index, field) == value:
+                return position + 1 if after else position
+
+        # The cursor's product is gone or changed: search by its sort key
+        ids = products.columns['id']
+
+        def precedes(position):
+            """Whether the product at position is shown before the next page starts."""
+            row_key = (products.get(order[position], field), ids[order[position]])
+            if row_key == key:
+                return after
+            return row_key > key if descending else row_key < key
+
+        low, high = start, end
+        while low < high:
+            middle = (low + high) // 2
+            if precedes(middle):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def paginate_products(self, category, sort=DEFAULT_SORT, per_page=DEFAULT_PAGE_SIZE, after=None, before=None):
+        """Like pagination.paginate_products() over the products in category's subtree."""
+        if sort not in SORT_OPTIONS:
+            sort = DEFAULT_SORT
+        field, _ = SORT_OPTIONS[sort]
+        order = self.column(f'order.{sort}')
+        tree_offsets = self.column('tree.offsets')
+        if 0 < category.tree_id < len(tree_offsets) - 1:
+            start, end = tree_offsets[category.tree_id], tree_offsets[category.tree_id + 1]
+        else:
+            start = end = 0
+        category_lft = self.column('product.category_lft')
+        lft, rgt = category.lft, category.rgt
+
+        after_key = decode_cursor(after, field) if after else None
+        before_key = decode_cursor(before, field) if before else None
+
+        indexes = []
+        if before_key:
+            # Walk backwards from the cursor, then restore display order
+            position = self._seek(sort, start, end, before_key, after=False)
+            while position > start and len(indexes) <= per_page:
+                position -= 1
+                if lft <= category_lft[order[position]] <= rgt:
+                    indexes.append(order[position])
+            has_more = len(indexes) > per_page
+            indexes = indexes[:per_page][::-1]
+            has_prev, has_next = has_more, True
+        else:
+            position = self._seek(sort, start, end, after_key, after=True) if after_key else start
+            while position < end and len(indexes) <= per_page:
+                if lft <= category_lft[order[position]] <= rgt:
+                    indexes.append(order[position])
+                position += 1
+            has_prev, has_next = after_key is not None, len(indexes) > per_page
+            indexes = indexes[:per_page]
+
+        products = [self.product(index) for index in indexes]
+        return {
+            'products': products,
+            'next_cursor': encode_cursor(products[-1], field) if products and has_next else None,
+            'prev_cursor': encode_cursor(products[0], field) if products and has_prev else None,
+        }
+
+
+_lock = threading.Lock()
+_state = {'snapshot': None, 'checked_at': 0.0}
+
+
+def _reset():
+    with _lock:
+        _state.update(snapshot=None, checked_at=0.0)
+
+
+def _load(path, current):
+    """Map the snapshot at path, reusing current if the file has not been replaced."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if current is not None and (current.stat.st_ino, current.stat.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns):
+        return current
+    try:
+        return CatalogSnapshot(path)
+    except SnapshotError as e:
+        logger.warning('Catalog snapshot not used: %s', e)
+        return None
+
+
+def get_snapshot():
+    """
+    Return the mapped snapshot if it matches the live catalog version, else None.
+
+    The file is looked at again when the catalog version changes and at
+    least every CATALOG_VERSION_CHECK_INTERVAL seconds, so a re-exported or
+    deleted snapshot is picked up by every process.
+    """
+    path = settings.CATALOG_SNAPSHOT_PATH
+    if not path:
+        return None
+    version = _version_key(get_catalog_version())
+    interval = getattr(settings, 'CATALOG_VERSION_CHECK_INTERVAL', 30)
+    snapshot = _state['snapshot']
+    if snapshot is None or snapshot.version != version or time.monotonic() - _state['checked_at'] >= interval:
+        with _lock:
+            snapshot = _state['snapshot'] = _load(path, _state['snapshot'])
+            _state['checked_at'] = time.monotonic()
+    return snapshot if snapshot is not None and snapshot.version == version else None
+
+
+def discard_snapshot():
+    """
+    Delete the snapshot after the catalog was edited outside an import and
+    queue a new export. Until it runs, pages are served through the ORM.
+    """
+    from .jobs import enqueue
+
+    path = settings.CATALOG_SNAPSHOT_PATH
+    if not path:
+        return
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    _reset()
+    enqueue('export_catalog_snapshot')
@@ -0,0 +1,123 @@
+"""
+Liveness and readiness checks.
+
+Liveness only says the process answers requests. Readiness also needs the
+database to answer, the migrations to be applied and a catalog version to
+be active; it never reads the product table. Startup scripts, the job
+worker and load balancers wait on these checks instead of sleeping for a
+fixed time.
+"""
+import logging
+import os
+import time
+
+from django.core.signals import request_started
+from django.db import DatabaseError, connection
+
+logger = logging.getLogger(__name__)
+
+# Seconds since the epoch when startup began: set by the start scripts so the
+# time spent before Python (waiting for the database, migrating) is counted too
+STARTUP_STARTED_AT = float(os.environ.get('STARTUP_STARTED_AT') or time.time())
+
+_migrated = False
+
+
+def check_database():
+    """Return True if the database accepts connections, raising DatabaseError otherwise."""
+    connection.ensure_connection()
+    return True
+
+
+def check_migrations():
+    """Return True once every migration is applied. Only checks until it is."""
+    global _migrated
+    if not _migrated:
+        from django.db.migrations.executor import MigrationExecutor
+
+        executor = MigrationExecutor(connection)
+        _migrated = not executor.migration_plan(executor.loader.graph.leaf_nodes())
+    return _migrated
+
+
+def active_catalog_version():
+    """Return (pk, product count) of the active catalog version, or None."""
+    from .models import CatalogVersion
+
+    return CatalogVersion.objects.filter(is_active=True).values_list('pk', 'product_count').first()
+
+
+def readiness():
+    """
+    Run the readiness checks and return (ready, checks).
+
+    Later checks are skipped once one fails, so an unreachable database
+    costs a single connection attempt.
+    """
+    checks = {'database': False, 'migrations': False, 'catalog': None}
+    try:
+        check_database()
+        checks['database'] = True
+        checks['migrations'] = check_migrations()
+        if checks['migrations']:
+            version = active_catalog_version()
+            if version is not None:
+                checks['catalog'] = {'version': version[0], 'products': version[1]}
+    except DatabaseError as e:
+        logger.warning('Readiness check failed: %s', e)
+        # Drop the broken connection so the next check reconnects
+        connection.close()
+    return checks['catalog'] is not None, checks
+
+
+def wait_for(check, timeout, label, write=print):
+    """
+    Call check() until it returns a true value and return that value, or
+    None after timeout seconds. DatabaseError counts as not ready.
+
+    Retries start after 50 ms and back off to one second, so a service that
+    is already up costs one call and one that comes up later is noticed
+    within a second.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    delay = 0.05
+    next_notice = started
+    while True:
+        try:
+            result = check()
+        except DatabaseError:
+            connection.close()
+            result = None
+        now = time.monotonic()
+        if result:
+            if now - started >= 0.1:
+                write(f'{label} ready after {now - started:.1f}s')
+            return result
+        if now >= deadline:
+            return None
+        if now >= next_notice:
+            write(f'Waiting for {label}...')
+            next_notice = now + 5
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, 1.0)
+
+
+def seconds_since_startup():
+    return time.time() - STARTUP_STARTED_AT
+
+
+def _log_first_request(sender, **kwargs):
+    request_started.disconnect(_log_first_request)
+    logger.info('First request %.2fs after startup began (pid %s)', seconds_since_startup(), os.getpid())
+
+
+def log_first_request():
+    """
+    Log the time to the first request of this process, then stop listening.
+
+    Only in processes started by the start scripts, which set
+    STARTUP_STARTED_AT; elsewhere (tests, manage.py shell) it means nothing.
+    """
+    if os.environ.get('STARTUP_STARTED_AT'):
+        request_started.connect(_log_first_request)
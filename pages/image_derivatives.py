@@ -0,0 +1,109 @@
+"""
+Responsive image derivatives.
+
+This module only depends on Pillow so that the process pool building
+derivatives can import it without setting up Django; storage reads and
+writes stay in the calling process.
+"""
+import base64
+import io
+
+from PIL import Image, ImageFilter, ImageOps
+
+
+# Widths (in pixels) of the resized copies offered in srcset
+DERIVATIVE_WIDTHS = (160, 320, 640, 1280)
+# Output formats as (file extension, Pillow format, save options)
+DERIVATIVE_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+PLACEHOLDER_WIDTH = 16
+# Background used when flattening transparent images for JPEG
+FLATTEN_COLOR = (255, 255, 255)
+
+
+def _flatten(image):
+    """Return image as RGB, compositing any transparency over FLATTEN_COLOR."""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, FLATTEN_COLOR)
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _encode(image, image_format, options):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def derivative_widths(width, widths=DERIVATIVE_WIDTHS):
+    """Widths worth rendering for an image width: never upscaled, and at least one."""
+    return [w for w in widths if w < width] or [width]
+
+
+def render_placeholder(image):
+    """Return a tiny blurred JPEG of image as a data: URI, shown while the real image loads."""
+    height = max(1, round(image.height * PLACEHOLDER_WIDTH / image.width))
+    small = image.resize((PLACEHOLDER_WIDTH, height), Image.Resampling.BILINEAR)
+    small = small.filter(ImageFilter.GaussianBlur(1))
+    data = _encode(small, 'JPEG', {'quality': 40})
+    return 'data:image/jpeg;base64,' + base64.b64encode(data).decode('ascii')
+
+
+def _open(content):
+    """Decode image bytes into an RGB image the right way up, or None if Pillow cannot read them."""
+    try:
+        with Image.open(io.BytesIO(content)) as source:
+            image = ImageOps.exif_transpose(source)
+            image.load()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return _flatten(image)
+
+
+def render_resized(content, width, extension):
+    """Return image bytes resized to width (never upscaled) in one of DERIVATIVE_FORMATS, or None."""
+    image = _open(content)
+    if image is None:
+        return None
+    if width < image.width:
+        image = image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS)
+    for format_extension, image_format, options in DERIVATIVE_FORMATS:
+        if format_extension == extension:
+            return _encode(image, image_format, options)
+    raise ValueError(f'Unknown derivative format: {extension}')
+
+
+def render_derivatives(content, widths=DERIVATIVE_WIDTHS):
+    """
+    Render the resized copies of an image.
+
+    Returns a dict with the original 'width' and 'height' (after EXIF
+    rotation), the 'placeholder' data URI and 'derivatives', a dict of
+    (width, extension) -> encoded bytes. Returns None if Pillow cannot
+    read the image (e.g. SVG or a truncated download).
+    """
+    image = _open(content)
+    if image is None:
+        return None
+
+    derivatives = {}
+    # Largest first, each step resized from the previous one: cheaper than
+    # going back to the original every time and just as sharp with LANCZOS
+    current = image
+    for width in sorted(derivative_widths(image.width, widths), reverse=True):
+        if width != current.width:
+            height = max(1, round(image.height * width / image.width))
+            current = current.resize((width, height), Image.Resampling.LANCZOS)
+        for extension, image_format, options in DERIVATIVE_FORMATS:
+            derivatives[(width, extension)] = _encode(current, image_format, options)
+
+    return {
+        'width': image.width,
+        'height': image.height,
+        'placeholder': render_placeholder(current),
+        'derivatives': derivatives,
+    }
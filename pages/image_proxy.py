@@ -0,0 +1,338 @@
+"""
+On-demand resizing of supplier images that have not been downloaded yet.
+
+/img/<width>/<key>[.webp] serves a supplier image resized to one of the
+derivative widths. The key is a hash of the image URL, resolved through an
+index of the URLs in the catalog, so the proxy only ever fetches images the
+catalog references. Results are kept in a disk cache with a byte budget:
+the least recently used files are evicted once it is exceeded.
+
+Concurrent requests for the same image wait for the first one instead of
+fetching it again: threads of a process share an event per file, and
+processes share a lock file next to the cache entry, kept fresh while the
+image is fetched. A failed fetch is remembered for a little while, so a
+broken supplier image does not cost a download on every page view.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.urls import reverse
+
+from .catalog import cached
+from .image_derivatives import DERIVATIVE_WIDTHS, render_resized
+from .images import DownloadError, ImageDownloader
+
+
+CONTENT_TYPES = {'webp': 'image/webp', 'jpg': 'image/jpeg'}
+# Width used as plain src, matching DEFAULT_DERIVATIVE_WIDTH of stored blobs
+DEFAULT_PROXY_WIDTH = 640
+# Supplier images larger than this are not resized on the fly
+MAX_SOURCE_BYTES = 20 * 1024 * 1024
+# A lock file not refreshed for this long belongs to a crashed request and may be taken over
+LOCK_TIMEOUT = 30
+# Seconds a failure to produce a file is raised again without retrying
+FAILURE_TTL = 60
+# Cache hits refresh the file's mtime (its LRU position) at most this often
+TOUCH_INTERVAL = 60
+# Eviction deletes down to this fraction of the budget, so it does not run on every write
+EVICT_TO = 0.9
+
+
+class ProxyError(Exception):
+    """An image could not be fetched or resized."""
+
+
+def url_key(url):
+    """Proxy key of a supplier image URL."""
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+
+def _build_url_index():
+    from .models import Category, ProductImage, TopLevelCategory
+
+    urls = set(Category.objects.exclude(image_url='').values_list('image_url', flat=True))
+    urls.update(TopLevelCategory.objects.exclude(image_url='').values_list('image_url', flat=True))
+    urls.update(ProductImage.objects.values_list('url', flat=True).distinct())
+    return {url_key(url): url for url in urls if url.startswith(('http://', 'https://'))}
+
+
+def source_url(key):
+    """Return the catalog image URL with the given key, or None."""
+    return cached('image_proxy_urls', _build_url_index).get(key)
+
+
+class ProxiedImage:
+    """
+    A supplier image served resized through the proxy.
+
+    Offers the same srcset attributes as ImageBlob, so templates render
+    both the same way; dimensions and placeholder are unknown until fetched.
+    """
+    width = height = 0
+    placeholder = ''
+    derivative_widths = DERIVATIVE_WIDTHS
+
+    def __init__(self, url):
+        self.url = url
+        self.key = url_key(url)
+
+    def get_url(self, width=DEFAULT_PROXY_WIDTH, extension='jpg'):
+        name = self.key if extension == 'jpg' else f'{self.key}.{extension}'
+        return reverse('image_proxy', args=[width, name])
+
+    def srcset(self, extension):
+        return ', '.join(f'{self.get_url(width, extension)} {width}w' for width in self.derivative_widths)
+
+    @property
+    def webp_srcset(self):
+        return self.srcset('webp')
+
+    @property
+    def jpeg_srcset(self):
+        return self.srcset('jpg')
+
+    @property
+    def src(self):
+        return self.get_url()
+
+
+def proxied_image(url):
+    """Return a ProxiedImage for a supplier URL, or None if there is nothing to proxy."""
+    if url and url.startswith(('http://', 'https://')):
+        return ProxiedImage(url)
+    return None
+
+
+def _refresh_lock(lock_path, done):
+    """Touch a lock file until done is set, so other processes don't take it for a crashed one."""
+    while not done.wait(LOCK_TIMEOUT / 3):
+        try:
+            os.utime(lock_path)
+        except FileNotFoundError:
+            return
+
+
+class DiskLRUCache:
+    """
+    Files on local disk, evicted least recently used first above max_bytes.
+
+    A file's mtime is its last use. The total size is tracked per process
+    from what it writes and corrected by a directory scan on each eviction,
+    so several processes can share the directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.size = None
+        self._lock = threading.Lock()  # Guards _inflight and _failures
+        self._size_lock = threading.Lock()
+        self._inflight = {}
+        self._failures = {}  # name -> (monotonic expiry, exception)
+
+    def path(self, name):
+        return os.path.join(self.directory, name[:2], name)
+
+    def _open_existing(self, path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            if time.time() - os.fstat(f.fileno()).st_mtime > TOUCH_INTERVAL:
+                os.utime(path)
+        except OSError:
+            pass
+        return f
+
+    def open(self, name, producer):
+        """
+        Return the cached file called name, opened for reading, calling
+        producer() for its bytes on a miss. Only one caller per name runs producer at
+        a time, across threads and processes; the others wait for its
+        result. Exceptions from producer propagate to the caller that ran it,
+        and are raised again to this process's callers for FAILURE_TTL seconds.
+        """
+        path = self.path(name)
+        while True:
+            f = self._open_existing(path)
+            if f is not None:
+                return f
+            with self._lock:
+                failure = self._failures.get(name)
+                if failure is not None and failure[0] < time.monotonic():
+                    del self._failures[name]
+                    failure = None
+                if failure is not None:
+                    raise failure[1].with_traceback(None)
+                event = self._inflight.get(name)
+                owner = event is None
+                if owner:
+                    event = self._inflight[name] = threading.Event()
+            if not owner:
+                event.wait(LOCK_TIMEOUT)
+                f = self._open_existing(path)
+                if f is not None:
+                    return f
+                # The other thread failed (and we raise its error) or is still at it
+                continue
+            try:
+                return self._produce(name, path, producer)
+            except Exception as e:
+                self._failed(name, e)
+                raise
+            finally:
+                with self._lock:
+                    del self._inflight[name]
+                event.set()
+
+    def _failed(self, name, error):
+        now = time.monotonic()
+        with self._lock:
+            # Drop expired entries so the map stays as small as the set of failing images
+            for expired in [key for key, (expiry, _) in self._failures.items() if expiry < now]:
+                del self._failures[expired]
+            self._failures[name] = (now + FAILURE_TTL, error)
+
+    def _produce(self, name, path, producer):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock_path = path + '.lock'
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                pass
+            # Another process is producing the file
+            f = self._open_existing(path)
+            if f is not None:
+                return f
+            try:
+                stale = time.time() - os.path.getmtime(lock_path) > LOCK_TIMEOUT
+            except FileNotFoundError:
+                continue
+            if stale:
+                try:
+                    os.unlink(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            time.sleep(0.05)
+
+        done = threading.Event()
+        threading.Thread(target=_refresh_lock, args=(lock_path, done), daemon=True).start()
+        try:
+            f = self._open_existing(path)
+            if f is not None:
+                return f
+            content = producer()
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as temp:
+                temp.write(content)
+            os.replace(temp_path, path)
+        finally:
+            done.set()
+            try:
+                os.unlink(lock_path)
+            except FileNotFoundError:
+                pass
+        self._added(len(content))
+        return open(path, 'rb')
+
+    def _files(self):
+        """(mtime, size, path) of every cached file."""
+        files = []
+        try:
+            directories = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return files
+        for directory in directories:
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(('.lock', '.tmp')):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _added(self, size):
+        with self._size_lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._files())
+            else:
+                self.size += size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Delete least recently used files until the cache is below its budget. Returns bytes freed."""
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * EVICT_TO
+        freed = 0
+        for _, size, path in files:
+            if total - freed <= target:
+                break
+            try:
+                # Readers that already opened the file keep reading it
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            freed += size
+        self.size = total - freed
+        return freed
+
+
+_cache = None
+_downloader = None
+_setup_lock = threading.Lock()
+
+
+def get_proxy_cache():
+    global _cache
+    with _setup_lock:
+        if _cache is None:
+            _cache = DiskLRUCache(settings.IMAGE_PROXY_CACHE_DIR, settings.IMAGE_PROXY_CACHE_BYTES)
+    return _cache
+
+
+def _get_downloader():
+    global _downloader
+    with _setup_lock:
+        if _downloader is None:
+            # Short timeout and a single retry: a page is waiting for this image
+            _downloader = ImageDownloader(retries=1, backoff=0.2, timeout=settings.IMAGE_PROXY_TIMEOUT)
+    return _downloader
+
+
+def fetch_resized(url, width, extension):
+    """Download a supplier image and return it resized, raising ProxyError on failure."""
+    try:
+        response = _get_downloader().fetch(url, max_bytes=MAX_SOURCE_BYTES)
+    except DownloadError as e:
+        raise ProxyError(str(e)) from e
+    content = render_resized(response.content, width, extension)
+    if content is None:
+        raise ProxyError('Not a raster image')
+    return content
+
+
+def open_resized(key, width, extension):
+    """
+    Return the resized image for a proxy key as an open file, fetching it on a cache miss.
+
+    Returns None for keys not in the catalog and raises ProxyError if the
+    supplier image cannot be fetched or resized.
+    """
+    url = source_url(key)
+    if url is None:
+        return None
+    return get_proxy_cache().open(f'{key}-{width}.{extension}', lambda: fetch_resized(url, width, extension))
@@ -0,0 +1,395 @@
+"""
+Concurrent downloads of category and product images.
+
+Worker threads share one requests.Session, so connections to each supplier
+host are pooled and reused, and a semaphore per host caps how many requests
+hit the same server at once. Connection errors, timeouts and 429/5xx
+responses are retried with exponential backoff. Only HTTP happens in the
+worker threads; files and rows are written in the calling thread as
+results come in.
+
+ImageSync keeps a RemoteImage manifest row per URL and revalidates local
+copies with conditional requests, so unchanged images cost a 304 and no
+transfer. The bytes themselves live in a content-addressed store
+(ImageBlob), keyed by their SHA-256.
+
+build_derivatives renders the resized WebP/JPEG copies used in srcset in a
+process pool; like the downloads, only the CPU work happens in the workers.
+"""
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+import requests
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from .image_derivatives import DERIVATIVE_WIDTHS, render_derivatives
+from .models import BLOB_DIR, Category, ImageBlob, ProductImage, RemoteImage
+
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PER_HOST = 4
+DEFAULT_RETRIES = 3
+DEFAULT_TIMEOUT = 10
+DEFAULT_DERIVATIVE_WORKERS = min(4, os.cpu_count() or 1)
+# Responses worth retrying: rate limiting and server-side errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRY_AFTER = 60
+
+
+class DownloadError(Exception):
+    """An image could not be downloaded."""
+
+
+class UnsupportedImage(DownloadError):
+    """A download that is not one of the raster image types the store accepts."""
+
+
+def _read_limited(response, max_bytes):
+    """Read a streamed response's body into response.content, raising DownloadError past max_bytes."""
+    length = response.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) > max_bytes:
+        response.close()
+        raise DownloadError(f'Image too large ({length} bytes)')
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(64 * 1024):
+        size += len(chunk)
+        if size > max_bytes:
+            response.close()
+            raise DownloadError(f'Image too large (over {max_bytes} bytes)')
+        chunks.append(chunk)
+    response._content = b''.join(chunks)
+
+
+def _retry_after(response):
+    """Seconds to wait from a Retry-After header, or None."""
+    try:
+        return min(MAX_RETRY_AFTER, max(0.0, float(response.headers.get('Retry-After', ''))))
+    except ValueError:
+        return None
+
+
+class ImageDownloader:
+    """Download many URLs concurrently over pooled connections."""
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, per_host=DEFAULT_PER_HOST, retries=DEFAULT_RETRIES,
+                 backoff=0.5, timeout=DEFAULT_TIMEOUT):
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'rxinox-image-sync/1.0'
+        adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def _host_slot(self, url):
+        """Semaphore limiting concurrent requests to the host of url."""
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+        return slot
+
+    def fetch(self, url, headers=None, max_bytes=None):
+        """
+        Download url and return the response (200 or 304), retrying transient failures.
+
+        With max_bytes, the body is streamed and the download abandoned
+        (DownloadError) as soon as it is larger.
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            delay = None
+            try:
+                with self._host_slot(url):
+                    stream = max_bytes is not None
+                    response = self.session.get(url, headers=headers, timeout=self.timeout, stream=stream)
+                    if stream:
+                        _read_limited(response, max_bytes)
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response
+                error = DownloadError(f'HTTP {response.status_code}')
+                delay = _retry_after(response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except requests.RequestException as e:
+                # Client errors such as 404 will not get better by retrying
+                raise DownloadError(str(e)) from e
+            if attempt < self.retries:
+                # Exponential backoff with jitter, outside the host slot
+                time.sleep(delay if delay is not None else self.backoff * 2 ** attempt * (1 + random.random()))
+        raise DownloadError(f'{error} (after {self.retries + 1} attempts)')
+
+    def download(self, urls, headers=None):
+        """
+        Fetch urls concurrently, each distinct URL once.
+
+        headers optionally maps a URL to extra request headers. Yields
+        (url, response, error) in completion order; exactly one of response
+        and error is None. At most twice as many downloads as threads are in
+        flight or waiting to be consumed, so memory does not grow with the
+        number of URLs.
+        """
+        headers = headers or {}
+        jobs = ((url, headers.get(url)) for url in dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            yield from _imap_bounded(pool, self._fetch_result, jobs, self.concurrency * 2)
+
+    def _fetch_result(self, url, headers=None):
+        try:
+            return url, self.fetch(url, headers), None
+        except DownloadError as e:
+            return url, None, e
+
+    def close(self):
+        self.session.close()
+
+
+# File extensions for the raster image types the store accepts. Anything
+# else is refused: SVG in particular can carry scripts that would run on
+# our origin when the blob is opened
+CONTENT_TYPE_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/avif': '.avif',
+}
+# Content types that say nothing about the bytes; the URL's extension decides
+GENERIC_CONTENT_TYPES = {'', 'application/octet-stream', 'binary/octet-stream'}
+
+
+def blob_extension(content_type, url=''):
+    """File extension for a download of content_type from url; UnsupportedImage unless a raster image."""
+    extension = CONTENT_TYPE_EXTENSIONS.get(content_type)
+    if extension is None and content_type in GENERIC_CONTENT_TYPES:
+        extension = os.path.splitext(urlparse(url).path)[1].lower() or '.jpg'
+        extension = '.jpg' if extension == '.jpeg' else extension
+    if extension not in CONTENT_TYPE_EXTENSIONS.values():
+        raise UnsupportedImage(f'Not a raster image: {content_type or extension}')
+    return extension
+
+
+def blob_storage_name(sha256, extension):
+    """Storage name of a content-addressed blob."""
+    return f'{BLOB_DIR}/{sha256[:2]}/{sha256}{extension}'
+
+
+def store_blob(content, content_type='', url=''):
+    """
+    Store content in the content-addressed image store and return its ImageBlob.
+
+    Identical bytes are stored once, whichever URL they came from. Raises
+    UnsupportedImage for anything but a raster image type.
+    """
+    content_type = content_type.split(';')[0].strip().lower()
+    extension = blob_extension(content_type, url)
+    sha256 = hashlib.sha256(content).hexdigest()
+    blob = ImageBlob.objects.filter(sha256=sha256).first()
+    if blob is not None and default_storage.exists(blob.file):
+        return blob
+    name = blob_storage_name(sha256, extension)
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(content))
+    if blob is None:
+        blob = ImageBlob.objects.create(sha256=sha256, file=name, size=len(content), content_type=content_type)
+    else:
+        blob.file = name
+        blob.save(update_fields=['file'])
+    return blob
+
+
+def _render_blob(blob_id, content, widths):
+    """Worker entry point: render derivatives, keeping the blob id with the result."""
+    return blob_id, render_derivatives(content, widths)
+
+
+def _imap_bounded(pool, function, jobs, window):
+    """Submit jobs (argument tuples) to pool, at most window at a time, yielding results as they finish."""
+    jobs = iter(jobs)
+    pending = set()
+    while True:
+        for args in jobs:
+            pending.add(pool.submit(function, *args))
+            if len(pending) >= window:
+                break
+        if not pending:
+            return
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def save_derivatives(blob, result):
+    """Store rendered derivatives (or note that the blob is not a raster image) and update the blob."""
+    for name in blob.derivative_files():
+        default_storage.delete(name)
+    if result is None:
+        blob.width = blob.height = 0
+        blob.derivative_widths = []
+        blob.placeholder = ''
+    else:
+        for (width, extension), content in result['derivatives'].items():
+            default_storage.save(blob.derivative_name(width, extension), ContentFile(content))
+        blob.width = result['width']
+        blob.height = result['height']
+        blob.derivative_widths = sorted({width for width, _ in result['derivatives']})
+        blob.placeholder = result['placeholder']
+    blob.derivatives_built_at = timezone.now()
+    blob.save(update_fields=['width', 'height', 'derivative_widths', 'placeholder', 'derivatives_built_at'])
+
+
+def build_derivatives(blobs, workers=DEFAULT_DERIVATIVE_WORKERS, widths=DERIVATIVE_WIDTHS):
+    """
+    Render and store the resized copies of blobs.
+
+    Resizing and encoding run in a pool of worker processes; reading the
+    originals and writing the results happen here, a bounded number of
+    images ahead so memory stays flat. Returns (built, unreadable) counts.
+    """
+    blobs = {blob.pk: blob for blob in blobs}
+
+    def jobs():
+        for blob in blobs.values():
+            try:
+                with default_storage.open(blob.file, 'rb') as f:
+                    content = f.read()
+            except FileNotFoundError:
+                continue
+            yield blob.pk, content, widths
+
+    built = unreadable = 0
+    if workers > 1 and len(blobs) > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = _imap_bounded(pool, _render_blob, jobs(), workers * 2)
+    else:
+        pool = None
+        results = (_render_blob(*job) for job in jobs())
+    try:
+        for blob_id, result in results:
+            save_derivatives(blobs[blob_id], result)
+            built += 1
+            unreadable += result is None
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return built, unreadable
+
+
+def recount_blob_references():
+    """
+    Recompute ImageBlob.ref_count from the categories and product images using each blob.
+
+    Returns the number of blobs whose count changed.
+    """
+    counts = Counter(Category.objects.exclude(image='').exclude(image=None).values_list('image', flat=True))
+    counts.update(ProductImage.objects.exclude(blob=None).values_list('blob__file', flat=True))
+    changed = []
+    for blob in ImageBlob.objects.only('id', 'file', 'ref_count'):
+        ref_count = counts.get(blob.file, 0)
+        if blob.ref_count != ref_count:
+            blob.ref_count = ref_count
+            changed.append(blob)
+    ImageBlob.objects.bulk_update(changed, ['ref_count'], batch_size=500)
+    return len(changed)
+
+
+class ImageSync:
+    """
+    Bring the local copies of image URLs up to date.
+
+    URLs with a local copy are revalidated with If-None-Match /
+    If-Modified-Since (unless force). New bytes go to the content-addressed
+    store, so an image shared by several URLs is stored once. Counts of
+    downloaded, not_modified, unchanged and failed URLs are kept in stats.
+    """
+
+    def __init__(self, downloader, force=False):
+        self.downloader = downloader
+        self.force = force
+        self.stats = {'downloaded': 0, 'not_modified': 0, 'unchanged': 0, 'failed': 0}
+
+    def conditional_headers(self, manifest):
+        if self.force or manifest.blob is None or not default_storage.exists(manifest.blob.file):
+            return None
+        headers = {}
+        if manifest.etag:
+            headers['If-None-Match'] = manifest.etag
+        if manifest.last_modified:
+            headers['If-Modified-Since'] = manifest.last_modified
+        return headers or None
+
+    def sync(self, urls):
+        """
+        Sync urls and yield (url, manifest, error) as each finishes.
+
+        manifest is the saved RemoteImage, with its blob (None on a failed
+        first download); error is None on success.
+        """
+        urls = list(dict.fromkeys(urls))
+        manifests = RemoteImage.objects.select_related('blob').in_bulk(urls, field_name='url')
+        headers = {url: self.conditional_headers(manifest) for url, manifest in manifests.items()}
+
+        for url, response, error in self.downloader.download(urls, headers):
+            manifest = manifests.get(url)
+            if error is not None:
+                self.stats['failed'] += 1
+                yield url, manifest, error
+                continue
+            if manifest is None:
+                manifest = RemoteImage(url=url)
+            try:
+                self.apply_response(manifest, response)
+            except UnsupportedImage as e:
+                # The manifest is left as it was, so a good copy stays in use
+                self.stats['failed'] += 1
+                yield url, manifests.get(url), e
+                continue
+            manifest.save()
+            yield url, manifest, None
+
+    def apply_response(self, manifest, response):
+        """
+        Update a manifest (and the stored blob) from a 200 or 304 response.
+
+        Raises UnsupportedImage, leaving the manifest untouched, when the
+        response is not a raster image.
+        """
+        now = timezone.now()
+        if response.status_code == 304:
+            manifest.checked_at = now
+            self.stats['not_modified'] += 1
+            return
+        content = response.content
+        content_hash = hashlib.sha256(content).hexdigest()
+        blob = manifest.blob
+        unchanged = content_hash == manifest.content_hash and blob is not None and default_storage.exists(blob.file)
+        if not unchanged:
+            blob = store_blob(content, response.headers.get('Content-Type', ''), manifest.url)
+        manifest.checked_at = now
+        manifest.etag = response.headers.get('ETag', '')[:255]
+        manifest.last_modified = response.headers.get('Last-Modified', '')[:64]
+        if unchanged:
+            self.stats['unchanged'] += 1
+            return
+        manifest.blob = blob
+        manifest.size = len(content)
+        manifest.content_hash = content_hash
+        manifest.changed_at = now
+        self.stats['downloaded'] += 1
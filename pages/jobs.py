@@ -0,0 +1,271 @@
+"""
+Database-backed queue of background jobs.
+
+A job is a management command from JOB_COMMANDS plus its arguments. The
+run_background_jobs worker claims one job at a time: with SELECT ... FOR
+UPDATE SKIP LOCKED where the database supports it (PostgreSQL), otherwise
+with a conditional UPDATE that only one worker can win (SQLite). A claim
+is a lease that a heartbeat thread keeps extending while the command runs;
+if the worker dies the lease lapses and another worker picks the job up
+again. A lapsed lease whose worker is still alive on the same host is not
+taken over: on SQLite the heartbeat cannot write while the command holds
+the database's write lock, e.g. during a long catalog import. Failed attempts are retried with exponential backoff until
+max_attempts.
+
+Commands report progress with report_progress(); the heartbeat writes it
+to the job row from its own connection, so it is visible while the command
+is still inside its transaction.
+"""
+import io
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from .models import Job
+
+
+logger = logging.getLogger(__name__)
+
+# Commands the queue may run
+JOB_COMMANDS = {'load_catalog', 'download_category_images', 'export_catalog_snapshot', 'gc_images', 'collectstatic'}
+# Default of settings.JOB_LEASE_SECONDS
+LEASE_SECONDS = 300
+HEARTBEAT_SECONDS = 15
+# Seconds before retrying a heartbeat that failed
+HEARTBEAT_RETRY_SECONDS = 1
+RETRY_BACKOFF_SECONDS = 60
+# Characters of command output kept on the job
+OUTPUT_LIMIT = 10000
+
+_progress_lock = threading.Lock()
+_progress = {'job_id': None, 'progress': None, 'message': ''}
+
+
+def worker_name():
+    """Identify this worker process in Job.locked_by."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def lease_seconds():
+    return getattr(settings, 'JOB_LEASE_SECONDS', LEASE_SECONDS)
+
+
+def worker_alive(worker):
+    """Whether worker names a process still running on this host; False when it can't be told."""
+    host, _, pid = worker.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, under another user
+        return True
+    return True
+
+
+def _lapsed_workers_alive(now):
+    """Workers holding a lapsed lease that are still running, so their jobs are not taken over."""
+    workers = (
+        Job.objects.filter(status=Job.RUNNING, locked_until__lt=now)
+        .values_list('locked_by', flat=True).distinct()
+    )
+    return [worker for worker in workers if worker_alive(worker)]
+
+
+def enqueue(command, *arguments, key=None, after='', max_attempts=3, run_after=None):
+    """
+    Queue a management command and return its Job.
+
+    key defaults to the command name; while a job with the same key is
+    queued or running, that job is returned instead of a new one, so
+    every process may enqueue the same startup job and it still runs once.
+    The job is not claimed while a job keyed after is queued or running,
+    and is claimed as soon as that one is done or has failed.
+    """
+    if command not in JOB_COMMANDS:
+        raise ValueError(f'Unknown job command: {command}')
+    key = command if key is None else key
+    if key:
+        pending = Job.objects.filter(key=key, status__in=[Job.QUEUED, Job.RUNNING]).first()
+        if pending is not None:
+            return pending
+    try:
+        with transaction.atomic():
+            return Job.objects.create(
+                command=command,
+                arguments=[str(argument) for argument in arguments],
+                key=key,
+                after=after,
+                max_attempts=max_attempts,
+                run_after=run_after or timezone.now(),
+            )
+    except IntegrityError:
+        # Another process queued the same key in the meantime
+        return Job.objects.get(key=key, status__in=[Job.QUEUED, Job.RUNNING])
+
+
+def _claimable(now, alive=()):
+    """
+    Jobs that are due, plus running jobs whose worker let the lease lapse,
+    unless they wait for another job. alive lists workers whose lapsed
+    leases are kept.
+    """
+    waited_for = Job.objects.filter(key=OuterRef('after'), status__in=[Job.QUEUED, Job.RUNNING]).exclude(key='')
+    lapsed = Q(status=Job.RUNNING, locked_until__lt=now) & ~Q(locked_by__in=alive)
+    due = Q(status=Job.QUEUED, run_after__lte=now) | lapsed
+    return due & ~Exists(waited_for)
+
+
+def _claim_values(worker, now):
+    return {
+        'status': Job.RUNNING,
+        'locked_by': worker,
+        'locked_until': now + timedelta(seconds=lease_seconds()),
+        'heartbeat_at': now,
+        'started_at': now,
+        'finished_at': None,
+        'progress': None,
+        'message': '',
+        'attempts': F('attempts') + 1,
+    }
+
+
+def claim_job(worker):
+    """Lease the next due job to worker and return it, or None if there is none."""
+    now = timezone.now()
+    claimable = _claimable(now, _lapsed_workers_alive(now))
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = (
+                Job.objects.select_for_update(skip_locked=True)
+                .filter(claimable)
+                .order_by('run_after', 'id')
+                .first()
+            )
+            if job is None:
+                return None
+            Job.objects.filter(pk=job.pk).update(**_claim_values(worker, now))
+        job.refresh_from_db()
+        return job
+
+    # Lease locking: the UPDATE re-checks the claim condition, so when two
+    # workers race for the same row only one of them updates it
+    candidates = Job.objects.filter(claimable).order_by('run_after', 'id').values_list('pk', flat=True)[:10]
+    for pk in candidates:
+        if Job.objects.filter(claimable, pk=pk).update(**_claim_values(worker, now)):
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def report_progress(done, total=None, message=''):
+    """
+    Record the progress of the job running in this process, if any.
+
+    done is a percentage, or a count out of total. Cheap enough to call
+    in loops: the heartbeat writes the latest value every few seconds.
+    """
+    with _progress_lock:
+        if _progress['job_id'] is None:
+            return
+        if total is not None:
+            done = 100.0 * done / total if total else 100.0
+        _progress['progress'] = min(100.0, max(0.0, float(done)))
+        if message:
+            _progress['message'] = message[:255]
+
+
+class Heartbeat(threading.Thread):
+    """Extend a running job's lease and store its progress until stopped."""
+
+    def __init__(self, job, worker):
+        super().__init__(name=f'job-{job.pk}-heartbeat', daemon=True)
+        self.job = job
+        self.worker = worker
+        self.stopped = threading.Event()
+
+    def beat(self):
+        now = timezone.now()
+        with _progress_lock:
+            values = {'progress': _progress['progress'], 'message': _progress['message']}
+        updated = Job.objects.filter(pk=self.job.pk, locked_by=self.worker, status=Job.RUNNING).update(
+            heartbeat_at=now, locked_until=now + timedelta(seconds=lease_seconds()), **values,
+        )
+        if not updated:
+            logger.warning('Job %s: lease lost', self.job.pk)
+
+    def run(self):
+        failures = 0
+        try:
+            while not self.stopped.wait(HEARTBEAT_RETRY_SECONDS if failures else HEARTBEAT_SECONDS):
+                try:
+                    self.beat()
+                except Exception:
+                    # e.g. SQLite locked by the job's own write transaction. The lease may
+                    # lapse meanwhile, but it is not taken over while this process is alive;
+                    # retry soon so it is extended right after the transaction ends
+                    if not failures:
+                        logger.warning('Job %s: heartbeat failed, retrying', self.job.pk, exc_info=True)
+                    failures += 1
+                else:
+                    if failures:
+                        logger.info('Job %s: heartbeat resumed after %d failed attempts', self.job.pk, failures)
+                    failures = 0
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(job, worker):
+    """Run a claimed job and record the outcome: done, queued for a retry, or failed."""
+    with _progress_lock:
+        _progress.update(job_id=job.pk, progress=None, message='')
+    heartbeat = Heartbeat(job, worker)
+    heartbeat.start()
+    output = io.StringIO()
+    error = None
+    try:
+        if job.command not in JOB_COMMANDS:
+            raise ValueError(f'Unknown job command: {job.command}')
+        call_command(job.command, *job.arguments, stdout=output, stderr=output)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    finally:
+        heartbeat.stop()
+        with _progress_lock:
+            _progress.update(job_id=None, progress=None, message='')
+        # The command may have left the connection broken or in a transaction
+        close_old_connections()
+
+    now = timezone.now()
+    values = {'output': output.getvalue()[-OUTPUT_LIMIT:], 'locked_until': None, 'heartbeat_at': now}
+    if error is None:
+        values.update(status=Job.DONE, finished_at=now, progress=100.0, error='')
+    elif job.attempts < job.max_attempts:
+        delay = RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+        values.update(status=Job.QUEUED, run_after=now + timedelta(seconds=delay), error=error, locked_by='')
+    else:
+        values.update(status=Job.FAILED, finished_at=now, error=error)
+    Job.objects.filter(pk=job.pk, locked_by=worker).update(**values)
+    job.refresh_from_db()
+    return job
+
+
+def fail_exhausted_jobs():
+    """Mark jobs whose worker died on their last attempt as failed instead of claiming them again."""
+    now = timezone.now()
+    return Job.objects.filter(
+        status=Job.RUNNING, locked_until__lt=now, attempts__gte=F('max_attempts'),
+    ).exclude(locked_by__in=_lapsed_workers_alive(now)).update(status=Job.FAILED, finished_at=now, locked_until=None, error='Worker lost (lease expired)')
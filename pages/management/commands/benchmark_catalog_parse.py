@@ -0,0 +1,62 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from pages.catalog_csv import read_catalog
+
+
+class Command(BaseCommand):
+    help = 'Compare serial and parallel parsing of a catalog CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file',
+            type=str,
+            default='catalog-2025.csv',
+            help='Path to the CSV file (default: catalog-2025.csv)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 2,
+            help='Number of processes for the parallel run (default: CPU count)'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Number of timed runs per mode; the best one is reported (default: 3)'
+        )
+
+    def time_parse(self, file_path, workers, repeat):
+        """Parse the file repeat times and return (records, best seconds)."""
+        best = None
+        for _ in range(max(1, repeat)):
+            started = time.perf_counter()
+            records = list(read_catalog(file_path, workers=workers))
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return records, best
+
+    def handle(self, *args, **options):
+        file_path = options['file']
+        if not os.path.isabs(file_path):
+            from django.conf import settings
+            file_path = os.path.join(settings.BASE_DIR, file_path)
+        if not os.path.exists(file_path):
+            raise CommandError(f'File not found: {file_path}')
+
+        workers = max(2, options['workers'])
+        serial, serial_seconds = self.time_parse(file_path, 1, options['repeat'])
+        parallel, parallel_seconds = self.time_parse(file_path, workers, options['repeat'])
+
+        if parallel != serial:
+            raise CommandError('Parallel parse does not match the serial parse')
+
+        size_mb = os.path.getsize(file_path) / (1024 * 1024)
+        for label, seconds in [('serial', serial_seconds), (f'{workers} workers', parallel_seconds)]:
+            self.stdout.write(
+                f'  {label:>12}: {seconds:.2f}s ({len(serial) / seconds:.0f} rows/s, {size_mb / seconds:.1f} MB/s)'
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(serial)} identical records, speedup x{serial_seconds / parallel_seconds:.2f}'
+        ))
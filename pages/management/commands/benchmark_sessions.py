@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from pages.catalog import top_level_slug
+from pages.models import Cart, Product
+
+SESSION_WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Command(BaseCommand):
+    help = 'Count session writes and session cookies per page view for browsing and shopping visitors'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--visitors',
+            type=int,
+            default=20,
+            help='Number of simulated visitors per scenario (default: 20)'
+        )
+
+    def page_urls(self):
+        """Landing, category and product page URLs for one active product."""
+        product = Product.objects.filter(active=True, category__isnull=False).select_related('category').first()
+        if product is None:
+            raise CommandError('No active product; load a catalog first')
+        category_slug = top_level_slug(product.category.full_path)
+        return product, [
+            reverse('landing_page'),
+            reverse('category_page', args=[category_slug]),
+            reverse('product_page', args=[category_slug, product.slug]),
+        ]
+
+    def visit(self, client, method, url, stats, **data):
+        """Request url and add its session writes and session cookies to stats."""
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, method)(url, data)
+        if response.status_code >= 400:
+            raise CommandError(f'{method.upper()} {url} answered {response.status_code}')
+        stats['requests'] += 1
+        stats['writes'] += sum(
+            1 for query in queries
+            if 'django_session' in query['sql'] and query['sql'].lstrip().upper().startswith(SESSION_WRITES)
+        )
+        stats['cookies'] += settings.SESSION_COOKIE_NAME in response.cookies
+
+    def run(self, label, visitors, steps):
+        """Run steps for each visitor with a fresh client and report the session cost."""
+        stats = {'requests': 0, 'writes': 0, 'cookies': 0}
+        session_keys = set()
+        for _ in range(visitors):
+            client = Client(HTTP_HOST=self.host)
+            for method, url, data in steps:
+                self.visit(client, method, url, stats, **data)
+            if settings.SESSION_COOKIE_NAME in client.cookies:
+                session_keys.add(client.cookies[settings.SESSION_COOKIE_NAME].value)
+        # Don't leave the benchmark's sessions and carts behind
+        Cart.objects.filter(session_key__in=session_keys).delete()
+        Session.objects.filter(session_key__in=session_keys).delete()
+
+        self.stdout.write(
+            f'  {label:>10}: {stats["requests"]} requests, {len(session_keys)} sessions created, '
+            f'{stats["writes"] / stats["requests"]:.2f} session writes and '
+            f'{stats["cookies"] / stats["requests"]:.2f} session cookies per request'
+        )
+
+    def handle(self, *args, **options):
+        visitors = max(1, options['visitors'])
+        hosts = [host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*']
+        self.host = hosts[0] if hosts else 'localhost'
+
+        product, urls = self.page_urls()
+        browse = [('get', url, {}) for url in urls]
+        add = ('post', reverse('add_to_cart'), {'product_code': product.product_code, 'quantity': 1})
+
+        self.stdout.write(f'{visitors} visitors per scenario, pages: {", ".join(urls)}')
+        self.run('browsing', visitors, browse * 2)
+        self.run('shopping', visitors, browse + [add] + browse)
@@ -0,0 +1,79 @@
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from pages.models import Cart
+
+
+def is_empty(data):
+    """True for session data that holds nothing but an empty cart, as created by browsing before lazy carts."""
+    return all(key == 'cart' and not value for key, value in data.items())
+
+
+class Command(BaseCommand):
+    help = 'Delete expired sessions, sessions that hold nothing but an empty cart, and carts of deleted sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report what would be deleted'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=400,
+            help='Sessions deleted per query (default: 400)'
+        )
+
+    def delete_batch(self, batch):
+        """Delete the sessions in batch, unless they were written since they were read."""
+        condition = Q()
+        for session_key, session_data in batch:
+            condition |= Q(session_key=session_key, session_data=session_data)
+        return Session.objects.filter(condition).delete()[0]
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        batch_size = max(1, options['batch_size'])
+
+        expired = Session.objects.filter(expire_date__lt=timezone.now())
+        expired_count = expired.count() if dry_run else expired.delete()[0]
+
+        total = empty = deleted = 0
+        now = timezone.now()
+        last_key = ''
+        while True:
+            # Page by key rather than holding a cursor open while deleting from the same table
+            sessions = list(
+                Session.objects.filter(expire_date__gte=now, session_key__gt=last_key)
+                .order_by('session_key')[:batch_size]
+            )
+            if not sessions:
+                break
+            last_key = sessions[-1].session_key
+            total += len(sessions)
+            # Sessions of visitors with a cart hold no data; the Cart row refers to their key
+            with_cart = set(
+                Cart.objects.filter(session_key__in=[session.session_key for session in sessions])
+                .values_list('session_key', flat=True)
+            )
+            batch = [
+                (session.session_key, session.session_data)
+                for session in sessions
+                if session.session_key not in with_cart and is_empty(session.get_decoded())
+            ]
+            empty += len(batch)
+            if batch and not dry_run:
+                deleted += self.delete_batch(batch)
+
+        orphans = Cart.objects.filter(user__isnull=True).exclude(
+            session_key__in=Session.objects.values('session_key'),
+        )
+        orphan_count = orphans.count() if dry_run else orphans.delete()[1].get(Cart._meta.label, 0)
+
+        action = 'Would delete' if dry_run else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {expired_count} expired and {empty if dry_run else deleted} empty sessions '
+            f'({empty} of {total} active sessions were empty) and {orphan_count} carts of deleted sessions'
+        ))
@@ -1,91 +1,177 @@
-import os
-import requests
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage
-from pages.models import Category, Product
-from urllib.parse import urlparse
+from pages.catalog import touch_catalog_images
+from pages.jobs import report_progress
+from pages.images import (
+    DEFAULT_CONCURRENCY, DEFAULT_DERIVATIVE_WORKERS, DEFAULT_PER_HOST, DEFAULT_RETRIES, DEFAULT_TIMEOUT,
+    ImageDownloader, ImageSync, build_derivatives, recount_blob_references,
+)
+from pages.models import Category, ImageBlob, ProductImage
 
 
 class Command(BaseCommand):
-    help = 'Download category images from product image URLs'
+    help = 'Download and revalidate category and product images from their supplier URLs'
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--force',
             action='store_true',
-            help='Force re-download even if image already exists'
+            help='Download every image again instead of revalidating the local copies'
+        )
+        parser.add_argument(
+            '--categories-only',
+            action='store_true',
+            help='Skip product images'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=DEFAULT_CONCURRENCY,
+            help=f'Number of parallel downloads (default: {DEFAULT_CONCURRENCY})'
+        )
+        parser.add_argument(
+            '--per-host',
+            type=int,
+            default=DEFAULT_PER_HOST,
+            help=f'Maximum parallel downloads from one host (default: {DEFAULT_PER_HOST})'
+        )
+        parser.add_argument(
+            '--retries',
+            type=int,
+            default=DEFAULT_RETRIES,
+            help=f'Retries for connection errors, timeouts and 429/5xx responses (default: {DEFAULT_RETRIES})'
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=DEFAULT_TIMEOUT,
+            help=f'Timeout per request in seconds (default: {DEFAULT_TIMEOUT})'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=DEFAULT_DERIVATIVE_WORKERS,
+            help=f'Processes resizing images into responsive derivatives (default: {DEFAULT_DERIVATIVE_WORKERS})'
+        )
+        parser.add_argument(
+            '--skip-derivatives',
+            action='store_true',
+            help='Do not build the resized copies of new images'
+        )
+        parser.add_argument(
+            '--rebuild-derivatives',
+            action='store_true',
+            help='Build the resized copies of every image in use again'
         )
 
     def handle(self, *args, **options):
-        self.stdout.write('Downloading category images...')
-        
-        categories_updated = 0
-        categories_skipped = 0
-        categories_failed = 0
-        
-        # Get all categories
-        categories = Category.objects.all()
-        
-        for category in categories:
-            # Skip if image already exists and not forcing
-            if category.image and not options['force']:
-                categories_skipped += 1
-                continue
-            
-            # Get image URL from category or from first product in category
-            image_url = category.image_url
-            
-            if not image_url:
-                # Try to get image from first product in this category
-                first_product = Product.objects.filter(category=category, image_url__isnull=False).exclude(image_url='').first()
-                if first_product:
-                    image_url = first_product.image_url
-                    # Update category with this image URL
-                    category.image_url = image_url
-                    category.save()
-            
-            if not image_url:
+        self.stdout.write('Syncing images...')
+        self.verbosity = options['verbosity']
+        self.categories_failed = 0
+
+        # url -> categories / product images using it
+        category_jobs = self.collect_categories()
+        product_jobs = {} if options['categories_only'] else self.collect_products()
+
+        downloader = ImageDownloader(
+            concurrency=options['concurrency'],
+            per_host=options['per_host'],
+            retries=options['retries'],
+            timeout=options['timeout'],
+        )
+        sync = ImageSync(downloader, force=options['force'])
+        changed_categories = {}
+        changed_images = []
+        urls = list(dict.fromkeys(list(category_jobs) + list(product_jobs)))
+        try:
+            for done, (url, manifest, error) in enumerate(sync.sync(urls), start=1):
+                report_progress(done, len(urls), message=f'Synced {done} of {len(urls)} images')
+                if error is not None:
+                    self.report_failure(url, error, category_jobs.get(url, []))
+                    continue
+                # Point every user of the URL at its blob
+                name = manifest.blob.file
+                for category in category_jobs.get(url, []):
+                    if category.image.name != name:
+                        category.image.name = name
+                        changed_categories[category.pk] = category
+                for image in product_jobs.get(url, []):
+                    if image.blob_id != manifest.blob_id:
+                        image.blob_id = manifest.blob_id
+                        changed_images.append(image)
+        finally:
+            downloader.close()
+
+        Category.objects.bulk_update(list(changed_categories.values()), ['image'], batch_size=500)
+        ProductImage.objects.bulk_update(changed_images, ['blob'], batch_size=500)
+        recount_blob_references()
+
+        built = unreadable = 0
+        if not options['skip_derivatives']:
+            blobs = ImageBlob.objects.filter(ref_count__gt=0)
+            if not options['rebuild_derivatives']:
+                blobs = blobs.filter(derivatives_built_at__isnull=True)
+            self.stdout.write('Building responsive derivatives...')
+            report_progress(100, message='Building responsive derivatives')
+            built, unreadable = build_derivatives(blobs.iterator(), workers=options['workers'])
+
+        if changed_categories or changed_images or built:
+            # Cached pages embed image URLs; make every process rebuild them
+            touch_catalog_images()
+
+        stats = sync.stats
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'\nSync complete:\n'
+                f'  Images downloaded: {stats["downloaded"]}\n'
+                f'  Images not modified (304): {stats["not_modified"]}\n'
+                f'  Images unchanged (same content): {stats["unchanged"]}\n'
+                f'  Images failed: {stats["failed"]}\n'
+                f'  Categories updated: {len(changed_categories)}\n'
+                f'  Categories failed: {self.categories_failed}\n'
+                f'  Product images updated: {len(changed_images)}\n'
+                f'  Derivatives built: {built} images ({unreadable} not resizable)'
+            )
+        )
+
+        # The snapshot embeds image URLs, so it is written again for the touched version
+        call_command('export_catalog_snapshot', stdout=self.stdout, stderr=self.stderr)
+
+    def collect_categories(self):
+        """Return a dict of image URL -> categories that use it."""
+        jobs = {}
+        missing_urls = []
+        for category in Category.objects.all():
+            # The first product image of the subtree is precomputed by load_catalog,
+            # so categories without an image URL cost no extra query
+            if not category.image_url and category.first_image_url:
+                category.image_url = category.first_image_url
+                missing_urls.append(category)
+
+            if not category.image_url:
                 self.stdout.write(
                     self.style.WARNING(f'No image URL found for category: {category.full_path}')
                 )
-                categories_failed += 1
+                self.categories_failed += 1
                 continue
-            
-            try:
-                # Download the image
-                response = requests.get(image_url, timeout=10, stream=True)
-                response.raise_for_status()
-                
-                # Get file extension from URL
-                parsed_url = urlparse(image_url)
-                path = parsed_url.path
-                ext = os.path.splitext(path)[1] or '.jpg'
-                
-                # Generate filename
-                filename = f'categories/{category.slug or "category"}-{category.id}{ext}'
-                
-                # Save to Django storage
-                file_content = ContentFile(response.content)
-                category.image.save(filename, file_content, save=True)
-                
-                categories_updated += 1
-                self.stdout.write(
-                    self.style.SUCCESS(f'Downloaded image for: {category.full_path}')
-                )
-                
-            except Exception as e:
-                self.stdout.write(
-                    self.style.ERROR(f'Failed to download image for {category.full_path}: {e}')
-                )
-                categories_failed += 1
-                continue
-        
-        self.stdout.write(
-            self.style.SUCCESS(
-                f'\nDownload complete:\n'
-                f'  Categories updated: {categories_updated}\n'
-                f'  Categories skipped: {categories_skipped}\n'
-                f'  Categories failed: {categories_failed}'
+            jobs.setdefault(category.image_url, []).append(category)
+
+        # Update categories with the URL taken from their first product
+        Category.objects.bulk_update(missing_urls, ['image_url'], batch_size=500)
+        return jobs
+
+    def collect_products(self):
+        """Return a dict of image URL -> product images that use it."""
+        jobs = {}
+        for image in ProductImage.objects.only('id', 'url', 'blob').iterator(chunk_size=2000):
+            jobs.setdefault(image.url, []).append(image)
+        return jobs
+
+    def report_failure(self, url, error, categories):
+        for category in categories:
+            self.stdout.write(
+                self.style.ERROR(f'Failed to download image for {category.full_path}: {error}')
             )
-        )
+            self.categories_failed += 1
+        if not categories and self.verbosity >= 2:
+            self.stdout.write(self.style.ERROR(f'Failed to download {url}: {error}'))
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from pages.catalog_snapshot import export_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Write the binary catalog snapshot that web processes serve category and product pages from'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Write the snapshot even if the file already holds the live catalog version'
+        )
+
+    def handle(self, *args, **options):
+        if not settings.CATALOG_SNAPSHOT_PATH:
+            self.stdout.write('CATALOG_SNAPSHOT_PATH is empty, snapshots are disabled')
+            return
+        stats = export_snapshot(force=options['force'])
+        self.report(stats)
+
+    def report(self, stats):
+        if stats is None:
+            self.stdout.write(self.style.WARNING('No active catalog version, snapshot not written'))
+        elif stats['skipped']:
+            self.stdout.write(f'Catalog snapshot of version {stats["version"]} is up to date')
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Catalog snapshot of version {stats["version"]} written: '
+                    f'{stats["products"]} products, {stats["categories"]} categories, '
+                    f'{stats["bytes"] / 1024:.0f} KiB in {stats["seconds"]:.2f}s'
+                )
+            )
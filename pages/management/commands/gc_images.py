@@ -0,0 +1,77 @@
+from datetime import timedelta
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from pages.images import recount_blob_references
+from pages.models import BLOB_DIR, Category, ImageBlob
+
+# Directories of downloaded images, including the layouts used before the blob store
+IMAGE_DIRS = [BLOB_DIR, 'images', 'products', 'categories']
+
+
+def walk_storage(path):
+    """Yield the names of all files below path in default storage."""
+    try:
+        directories, files = default_storage.listdir(path)
+    except FileNotFoundError:
+        return
+    for name in files:
+        yield f'{path}/{name}'
+    for directory in directories:
+        yield from walk_storage(f'{path}/{directory}')
+
+
+class Command(BaseCommand):
+    help = 'Delete stored images no category or product uses any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report what would be deleted'
+        )
+        parser.add_argument(
+            '--grace-hours',
+            type=float,
+            default=24,
+            help='Keep unreferenced files younger than this, e.g. from a sync in progress (default: 24)'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        cutoff = timezone.now() - timedelta(hours=options['grace_hours'])
+
+        recount_blob_references()
+        blobs = list(ImageBlob.objects.filter(ref_count=0, created_at__lt=cutoff))
+        freed = sum(blob.size for blob in blobs)
+        if not dry_run:
+            for blob in blobs:
+                default_storage.delete(blob.file)
+                for name in blob.derivative_files():
+                    default_storage.delete(name)
+            # Manifests keep their URL and validators; the next sync downloads the image again if needed
+            ImageBlob.objects.filter(pk__in=[blob.pk for blob in blobs]).delete()
+
+        # Files on disk that nothing points at (interrupted syncs, old layouts)
+        referenced = set()
+        for blob in ImageBlob.objects.only('file', 'sha256', 'derivative_widths').iterator():
+            referenced.add(blob.file)
+            referenced.update(blob.derivative_files())
+        referenced.update(Category.objects.exclude(image='').exclude(image=None).values_list('image', flat=True))
+        stray = []
+        for directory in IMAGE_DIRS:
+            for name in walk_storage(directory):
+                if name not in referenced and default_storage.get_modified_time(name) < cutoff:
+                    stray.append(name)
+        for name in stray:
+            freed += default_storage.size(name)
+            if not dry_run:
+                default_storage.delete(name)
+
+        verb = 'Would delete' if dry_run else 'Deleted'
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'{verb} {len(blobs)} unreferenced blobs and {len(stray)} stray files '
+                f'({freed / (1024 * 1024):.1f} MB)'
+            )
+        )
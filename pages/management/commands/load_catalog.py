@@ -1,9 +1,11 @@
-import csv
 import os
-from django.core.management.base import BaseCommand
-from django.utils.text import slugify
-from pages.models import Category, Product
-from decimal import Decimal, InvalidOperation
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from pages.catalog_copy import CopyCatalogImporter, supports_copy
+from pages.catalog_csv import load_records, read_catalog
+from pages.catalog_import import DEFAULT_BATCH_SIZE, CatalogImporter, CatalogValidationError
+from pages.models import CatalogVersion
 
 
 class Command(BaseCommand):
@@ -21,186 +23,131 @@ class Command(BaseCommand):
             action='store_true',
             help='Clear existing categories and products before loading'
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help=f'Number of rows per bulk insert/update (default: {DEFAULT_BATCH_SIZE})'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show which rows would be inserted, updated or removed without applying the changes'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of processes used to parse the CSV file; helps with 3+ CPUs and large files (default: 1)'
+        )
+        parser.add_argument(
+            '--no-copy',
+            action='store_true',
+            help='On PostgreSQL, write through the ORM instead of COPY into staging tables'
+        )
+        parser.add_argument(
+            '--rollback',
+            type=int,
+            nargs='?',
+            const=0,
+            metavar='VERSION',
+            help='Restore the catalog of an earlier version (default: the one before the active version)'
+        )
+        parser.add_argument(
+            '--allow-shrink',
+            action='store_true',
+            help='Accept imports that deactivate more than CATALOG_MAX_SHRINK of the active products'
+        )
+
+    def rollback_target(self, version_id):
+        """Return the CatalogVersion to roll back to; it must still have its feed records."""
+        versions = CatalogVersion.objects.exclude(records=None)
+        if version_id:
+            version = versions.filter(pk=version_id).first()
+        else:
+            active = CatalogVersion.objects.filter(is_active=True).first()
+            version = versions.filter(pk__lt=active.pk).first() if active else None
+        if version is None:
+            raise CommandError('No catalog version with stored records to roll back to')
+        return version
 
     def handle(self, *args, **options):
-        file_path = options['file']
-        
-        # Use project root if relative path
-        if not os.path.isabs(file_path):
-            from django.conf import settings
-            file_path = os.path.join(settings.BASE_DIR, file_path)
-        
-        if not os.path.exists(file_path):
-            self.stdout.write(self.style.ERROR(f'File not found: {file_path}'))
-            return
+        if options['rollback'] is not None:
+            version = self.rollback_target(options['rollback'])
+            self.stdout.write(f'Rolling back to catalog version {version}...')
+            source = f'rollback to v{version.pk}'
+            records = load_records(version.records)
+        else:
+            file_path = options['file']
+            
+            # Use project root if relative path
+            if not os.path.isabs(file_path):
+                file_path = os.path.join(settings.BASE_DIR, file_path)
+            
+            if not os.path.exists(file_path):
+                self.stdout.write(self.style.ERROR(f'File not found: {file_path}'))
+                return
+            
+            if options['clear']:
+                self.stdout.write('Clearing existing data...')
+            
+            self.stdout.write(f'Loading catalog from {file_path}...')
+            source = file_path
+            records = read_catalog(file_path, workers=options['workers'])
         
-        if options['clear']:
-            self.stdout.write('Clearing existing data...')
-            Product.objects.all().delete()
-            Category.objects.all().delete()
-        
-        self.stdout.write(f'Loading catalog from {file_path}...')
+        # Parse the file once; only rows whose content hash changed are written,
+        # all inside one transaction (through COPY and staging tables on PostgreSQL)
+        # that also checks the row counts and activates the new catalog version
+        importer_class = CopyCatalogImporter if supports_copy() and not options['no_copy'] else CatalogImporter
+        importer = importer_class(
+            batch_size=max(1, options['batch_size']),
+            clear=options['clear'],
+            source=source,
+            max_shrink=None if options['allow_shrink'] else settings.CATALOG_MAX_SHRINK,
+        )
+        try:
+            plan, stats = importer.run(records, dry_run=options['dry_run'])
+        except CatalogValidationError as e:
+            raise CommandError(f'Catalog not activated, all changes rolled back: {e}')
         
-        categories_created = 0
-        products_created = 0
-        products_updated = 0
+        for product_code, error in importer.skipped:
+            self.stdout.write(self.style.WARNING(f'Error processing row {product_code}: {error}'))
         
-        # First pass: collect all unique categories and their image URLs
-        categories_dict = {}
-        category_images = {}  # Store image URL for each category
+        if options['dry_run'] or options['verbosity'] >= 2:
+            for product in plan.products_to_create:
+                self.stdout.write(f'+ {product.product_code}')
+            for product in plan.products_to_update:
+                self.stdout.write(f'~ {product.product_code}')
+            for _, product_code in plan.products_to_deactivate:
+                self.stdout.write(f'- {product_code}')
         
-        with open(file_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f, delimiter=';')
-            for row in reader:
-                category_path = row.get('category', '').strip()
-                if category_path:
-                    # Extract image 1 URL for this category
-                    image_url = row.get('images 1', '').strip()
-                    if image_url and category_path not in category_images:
-                        category_images[category_path] = image_url
-                    
-                    if category_path not in categories_dict:
-                        # Extract category name (last part of path)
-                        category_parts = [p.strip() for p in category_path.split('>')]
-                        category_name = category_parts[-1]
-                        parent_path = ' > '.join(category_parts[:-1]) if len(category_parts) > 1 else ''
-                        
-                        slug = slugify(category_path)
-                        if not slug:
-                            slug = slugify(category_name)
-                        
-                        # Make slug unique if needed
-                        base_slug = slug
-                        counter = 1
-                        while Category.objects.filter(slug=slug).exclude(full_path=category_path).exists():
-                            slug = f"{base_slug}-{counter}"
-                            counter += 1
-                        
-                        try:
-                            category = Category.objects.get(full_path=category_path)
-                            # Update slug if it's empty
-                            if not category.slug:
-                                category.slug = slug
-                                category.save()
-                            created = False
-                        except Category.DoesNotExist:
-                            category = Category.objects.create(
-                                full_path=category_path,
-                                name=category_name,
-                                parent_path=parent_path,
-                                slug=slug,
-                                image_url=category_images.get(category_path, ''),
-                            )
-                            created = True
-                            categories_created += 1
-                        else:
-                            # Update image_url if category exists but doesn't have one
-                            if image_url and not category.image_url:
-                                category.image_url = image_url
-                                category.save()
-                        
-                        categories_dict[category_path] = category
+        summary = (
+            f'  Categories created: {stats["categories_created"]}\n'
+            f'  Categories updated: {stats["categories_updated"]}\n'
+            f'  Products inserted: {stats["products_created"]}\n'
+            f'  Products updated: {stats["products_updated"]}\n'
+            f'  Products unchanged: {stats["products_unchanged"]}\n'
+            f'  Products removed (deactivated): {stats["products_removed"]}\n'
+            f'  Rows skipped: {stats["rows_skipped"]}'
+        )
         
-        self.stdout.write(f'Created/Found {len(categories_dict)} categories')
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'Dry run, no changes applied:\n{summary}'))
+            return
         
-        # Second pass: create products
-        with open(file_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f, delimiter=';')
-            for row in reader:
-                try:
-                    product_code = row.get('product_code', '').strip()
-                    if not product_code:
-                        continue
-                    
-                    category_path = row.get('category', '').strip()
-                    category = categories_dict.get(category_path) if category_path else None
-                    
-                    # Parse price
-                    price_str = row.get('price', '0').strip().replace(',', '.')
-                    try:
-                        price = Decimal(price_str)
-                    except (InvalidOperation, ValueError):
-                        price = Decimal('0')
-                    
-                    # Parse weight
-                    weight_str = row.get('weight', '').strip().replace(',', '.')
-                    weight = None
-                    if weight_str:
-                        try:
-                            weight = Decimal(weight_str)
-                        except (InvalidOperation, ValueError):
-                            weight = None
-                    
-                    # Parse stock
-                    stock_str = row.get('stock', '0').strip()
-                    try:
-                        stock = int(stock_str)
-                    except (ValueError, TypeError):
-                        stock = 0
-                    
-                    # Parse active
-                    active = row.get('active', '1').strip() == '1'
-                    
-                    # Extract all image URLs (images 1-15)
-                    import json
-                    image_urls = []
-                    for i in range(1, 16):
-                        img_url = row.get(f'images {i}', '').strip()
-                        if img_url:
-                            image_urls.append(img_url)
-                    
-                    # First image URL for backwards compatibility
-                    image_url = image_urls[0] if image_urls else ''
-                    
-                    # Store all images as JSON
-                    images_json = json.dumps(image_urls) if image_urls else ''
-                    
-                    product, created = Product.objects.update_or_create(
-                        product_code=product_code,
-                        defaults={
-                            'active': active,
-                            'name': row.get('name', '').strip(),
-                            'price': price,
-                            'vat': row.get('vat', '').strip(),
-                            'unit': row.get('unit', '').strip(),
-                            'category': category,
-                            'barcode': row.get('barcode', '').strip(),
-                            'weight': weight,
-                            'producer': row.get('producer', '').strip(),
-                            'description': row.get('description', '').strip(),
-                            'short_description': row.get('short_description', '').strip(),
-                            'stock': stock,
-                            'availability': row.get('availability', '').strip(),
-                            'delivery': row.get('delivery', '').strip(),
-                            'currency': row.get('currency', 'EUR').strip(),
-                            'seo_url': row.get('seo_url', '').strip(),
-                            'image_url': image_url,
-                            'images_json': images_json,
-                        }
-                    )
-                    
-                    # Update category image_url if it doesn't have one and this product has an image
-                    if category and image_url and not category.image_url:
-                        category.image_url = image_url
-                        category.save()
-                    
-                    if created:
-                        products_created += 1
-                    else:
-                        products_updated += 1
-                        
-                except Exception as e:
-                    self.stdout.write(
-                        self.style.WARNING(f'Error processing row: {e}')
-                    )
-                    continue
+        # A new catalog version is activated only if something changed
+        status = f'version {importer.version.pk} active' if importer.version else 'no changes'
         
+        rows_per_second = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
         self.stdout.write(
             self.style.SUCCESS(
-                f'Successfully loaded catalog:\n'
-                f'  Categories created: {categories_created}\n'
-                f'  Products created: {products_created}\n'
-                f'  Products updated: {products_updated}'
+                f'Successfully loaded catalog ({status}):\n'
+                f'{summary}\n'
+                f'  Product images written: {stats["images_written"]}\n'
+                f'  Top-level categories: {stats["top_level_categories"]}\n'
+                f'  Rows: {stats["rows"]} in {stats["seconds"]:.1f}s ({rows_per_second:.0f} rows/s)'
             )
         )
-
+        
+        # Web processes serve the catalog from the snapshot once it matches the new version
+        call_command('export_catalog_snapshot', stdout=self.stdout, stderr=self.stderr)
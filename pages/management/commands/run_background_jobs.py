@@ -1,96 +1,129 @@
 """
-Background jobs that run after server startup.
-This command can be called manually or triggered automatically.
+Background job worker.
+
+Runs the jobs queued in the database (catalog loading, image downloading,
+etc.) one at a time, outside the web server processes. Start one or more
+of these next to the web server; every job runs exactly once whichever
+worker claims it.
 """
 import os
-import sys
+import signal
 import threading
 import time
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.core.management import call_command
-from django.db import connection
+from pages.health import check_migrations, wait_for
+from pages.jobs import claim_job, enqueue, fail_exhausted_jobs, run_job, worker_name
+from pages.models import Job
+
+
+DEFAULT_CATALOG_FILE = 'catalog-2025.csv'
 
 
 class Command(BaseCommand):
-    help = 'Run background jobs (catalog loading, image downloading, etc.)'
+    help = 'Run queued background jobs (catalog loading, image downloading, etc.)'
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--load-catalog',
             action='store_true',
-            help='Load catalog data from CSV file'
+            help='Queue loading the catalog CSV file (if it exists)'
         )
         parser.add_argument(
             '--download-images',
             action='store_true',
-            help='Download category images'
+            help='Queue downloading category and product images'
         )
         parser.add_argument(
             '--collectstatic',
             action='store_true',
-            help='Collect static files'
+            help='Queue collecting static files'
         )
         parser.add_argument(
             '--all',
             action='store_true',
-            help='Run all background jobs'
+            help='Queue all of the above'
+        )
+        parser.add_argument(
+            '--enqueue-only',
+            action='store_true',
+            help='Queue the requested jobs and exit without running any'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once no job is due instead of waiting for new ones'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=5,
+            help='Seconds between checks for new jobs when the queue is empty (default: 5)'
         )
         parser.add_argument(
             '--wait-for-db',
             type=int,
-            default=5,
-            help='Wait N seconds for database to be ready (default: 5)'
+            default=120,
+            help='Wait up to N seconds for the database to be reachable and migrated (default: 120)'
         )
 
     def handle(self, *args, **options):
-        # Wait a bit for database to be fully ready
-        wait_time = options.get('wait_for_db', 5)
-        if wait_time > 0:
-            self.stdout.write(f'Waiting {wait_time} seconds for database to be ready...')
-            time.sleep(wait_time)
-        
-        # Ensure database connection is alive
-        try:
-            connection.ensure_connection()
-            self.stdout.write(self.style.SUCCESS('Database connection verified'))
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f'Database connection failed: {e}'))
+        # Start as soon as the database answers and the job table exists,
+        # e.g. while another container is still running migrate
+        if not wait_for(check_migrations, options['wait_for_db'], 'database migrations', self.stdout.write):
+            self.stdout.write(self.style.ERROR('Database not reachable or not migrated, worker not started'))
             return
+        self.stdout.write(self.style.SUCCESS('Database connection verified'))
 
-        run_all = options.get('all', False)
-        load_catalog = options.get('load_catalog', False) or run_all
-        download_images = options.get('download_images', False) or run_all
-        collectstatic = options.get('collectstatic', False) or run_all
-
-        if not load_catalog and not download_images and not collectstatic:
-            self.stdout.write(self.style.WARNING('No jobs specified. Use --all, --load-catalog, --download-images, or --collectstatic'))
+        run_all = options['all']
+        # Jobs are keyed by command, so several workers starting with --all queue them once
+        if options['load_catalog'] or run_all:
+            if os.path.exists(os.path.join(settings.BASE_DIR, DEFAULT_CATALOG_FILE)):
+                self.report_enqueued(enqueue('load_catalog', '--file', DEFAULT_CATALOG_FILE))
+            else:
+                self.stdout.write(self.style.WARNING(f'{DEFAULT_CATALOG_FILE} not found, catalog not queued'))
+        if options['download_images'] or run_all:
+            # Downloads the images of the catalog loaded above, so it waits for that job
+            self.report_enqueued(enqueue('download_category_images', after='load_catalog'))
+        if options['collectstatic'] or run_all:
+            self.report_enqueued(enqueue('collectstatic', '--noinput'))
+        if options['enqueue_only']:
             return
 
-        self.stdout.write('Starting background jobs...')
+        self.work(options['once'], options['poll_interval'])
 
-        # Run catalog loading if requested
-        if load_catalog:
-            self.stdout.write('\n--- Loading catalog data ---')
-            try:
-                call_command('load_catalog', verbosity=1)
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f'Failed to load catalog: {e}'))
+    def report_enqueued(self, job):
+        self.stdout.write(f'Queued {job}')
 
-        # Run image downloading if requested
-        if download_images:
-            self.stdout.write('\n--- Downloading category images ---')
-            try:
-                call_command('download_category_images', verbosity=1)
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f'Failed to download images: {e}'))
+    def work(self, once, poll_interval):
+        """Claim and run jobs until stopped (SIGTERM / SIGINT) or, with once, until none is due."""
+        worker = worker_name()
+        stopping = threading.Event()
 
-        # Run static files collection if requested
-        if collectstatic:
-            self.stdout.write('\n--- Collecting static files ---')
-            try:
-                call_command('collectstatic', '--noinput', verbosity=1)
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f'Failed to collect static files: {e}'))
+        def stop(signum, frame):
+            self.stdout.write('Stopping after the current job...')
+            stopping.set()
 
-        self.stdout.write(self.style.SUCCESS('\nBackground jobs completed'))
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
 
+        self.stdout.write(f'Worker {worker} started')
+        while not stopping.is_set():
+            fail_exhausted_jobs()
+            job = claim_job(worker)
+            if job is None:
+                if once:
+                    break
+                stopping.wait(poll_interval)
+                continue
+            self.stdout.write(f'\n--- Running {job.command} (job {job.pk}, attempt {job.attempts}/{job.max_attempts}) ---')
+            started = time.monotonic()
+            job = run_job(job, worker)
+            elapsed = time.monotonic() - started
+            if job.status == Job.DONE:
+                self.stdout.write(self.style.SUCCESS(f'Job {job.pk} done in {elapsed:.1f}s'))
+            elif job.status == Job.QUEUED:
+                self.stdout.write(self.style.WARNING(f'Job {job.pk} failed, retrying after {job.run_after:%H:%M:%S}: {job.error}'))
+            else:
+                self.stdout.write(self.style.ERROR(f'Job {job.pk} failed: {job.error}'))
+        self.stdout.write(self.style.SUCCESS('Worker stopped'))
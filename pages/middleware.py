@@ -0,0 +1,38 @@
+from . import views
+from .cart import set_cart_count_cookie
+
+
+class HealthCheckMiddleware:
+    """
+    Answer /healthz and /readyz before any other middleware.
+
+    Probes come from the platform with internal Host headers that are not in
+    ALLOWED_HOSTS, and need neither sessions nor authentication, so they
+    skip host validation and the rest of the middleware stack.
+    """
+    PROBES = {
+        '/healthz': views.liveness,
+        '/readyz': views.readiness_check,
+    }
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        probe = self.PROBES.get(request.path_info)
+        if probe is not None:
+            return probe(request)
+        return self.get_response(request)
+
+
+class CartCountCookieMiddleware:
+    """Refresh the signed cart count cookie on responses to requests that changed the cart."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if getattr(request, 'cart_changed', False):
+            set_cart_count_cookie(request, response)
+        return response
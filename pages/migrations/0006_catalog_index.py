@@ -0,0 +1,83 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:35
+
+from django.db import migrations, models
+from django.utils.text import slugify
+
+
+def build_top_level_index(apps, schema_editor):
+    """Build the index for catalogs that were loaded before it existed."""
+    Category = apps.get_model("pages", "Category")
+    TopLevelCategory = apps.get_model("pages", "TopLevelCategory")
+
+    index = {}
+    for category in Category.objects.all():
+        name = category.full_path.split(">")[0].strip()
+        if not name:
+            continue
+        entry = index.setdefault(name, {"product_count": 0, "image_url": ""})
+        entry["product_count"] += category.products.count()
+        if category.image_url and not entry["image_url"]:
+            entry["image_url"] = category.image_url
+
+    taken = set()
+    for name, entry in sorted(index.items()):
+        base_slug = slugify(name) or "categoria"
+        slug = base_slug
+        counter = 1
+        while slug in taken:
+            slug = f"{base_slug}-{counter}"
+            counter += 1
+        taken.add(slug)
+        TopLevelCategory.objects.create(name=name, slug=slug, **entry)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0005_product_images_json"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CatalogVersion",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("source", models.CharField(blank=True, max_length=500)),
+            ],
+            options={
+                "ordering": ["-id"],
+            },
+        ),
+        migrations.CreateModel(
+            name="TopLevelCategory",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255, unique=True)),
+                ("slug", models.SlugField(max_length=255, unique=True)),
+                ("product_count", models.IntegerField(default=0)),
+                ("image_url", models.URLField(blank=True, max_length=1000)),
+            ],
+            options={
+                "verbose_name_plural": "Top-level categories",
+                "ordering": ["name"],
+            },
+        ),
+        migrations.RunPython(build_top_level_index, migrations.RunPython.noop),
+    ]
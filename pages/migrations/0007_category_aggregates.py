@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0006_catalog_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="category",
+            name="active_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="first_image_url",
+            field=models.URLField(blank=True, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="product_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="toplevelcategory",
+            name="active_count",
+            field=models.IntegerField(default=0),
+        ),
+    ]
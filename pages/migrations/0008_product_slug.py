@@ -0,0 +1,92 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.text import slugify
+
+
+def backfill_product_slugs(apps, schema_editor):
+    """Give existing products unique slugs and keep their old URLs working."""
+    Product = apps.get_model("pages", "Product")
+    ProductRedirect = apps.get_model("pages", "ProductRedirect")
+
+    taken = set()
+    legacy = {}
+    for product in Product.objects.select_related("category").order_by("name", "id"):
+        base_slug = slugify(product.name) or slugify(product.product_code) or "producto"
+        # Fit the slug columns (max_length=255), suffix included
+        base_slug = base_slug[:255].rstrip("-")
+        slug = base_slug
+        counter = 1
+        while slug in taken:
+            suffix = f"-{counter}"
+            slug = base_slug[: 255 - len(suffix)].rstrip("-") + suffix
+            counter += 1
+        taken.add(slug)
+        product.slug = slug
+        product.save(update_fields=["slug"])
+
+        # Old URLs resolved to the first product by name in the top-level category
+        if product.category:
+            category_slug = slugify(product.category.full_path.split(">")[0].strip())
+            key = (category_slug, slugify(product.name))
+            if (
+                category_slug
+                and key[1]
+                and key not in legacy
+                and len(category_slug) <= 255
+                and len(key[1]) <= 255
+            ):
+                legacy[key] = product
+                if slug != key[1]:
+                    ProductRedirect.objects.create(
+                        category_slug=category_slug, old_slug=key[1], product=product
+                    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0007_category_aggregates"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="slug",
+            field=models.SlugField(max_length=255, null=True),
+        ),
+        migrations.CreateModel(
+            name="ProductRedirect",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("category_slug", models.SlugField(blank=True, max_length=255)),
+                ("old_slug", models.SlugField(max_length=255)),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="redirects",
+                        to="pages.product",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("old_slug", "category_slug")},
+            },
+        ),
+        migrations.RunPython(backfill_product_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="product",
+            name="slug",
+            field=models.SlugField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,122 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.text import slugify
+
+
+def build_category_tree(apps, schema_editor):
+    """Create ancestor categories and number the tree for already loaded catalogs."""
+    Category = apps.get_model("pages", "Category")
+
+    def key(full_path):
+        return " > ".join(p.strip() for p in full_path.split(">") if p.strip())
+
+    categories = {key(c.full_path): c for c in Category.objects.all()}
+    categories.pop("", None)
+    taken = {c.slug for c in categories.values()}
+    for path in list(categories):
+        parts = path.split(" > ")
+        for depth in range(1, len(parts)):
+            ancestor_path = " > ".join(parts[:depth])
+            if ancestor_path in categories:
+                continue
+            base_slug = slugify(ancestor_path) or "categoria"
+            slug = base_slug
+            counter = 1
+            while slug in taken:
+                slug = f"{base_slug}-{counter}"
+                counter += 1
+            taken.add(slug)
+            categories[ancestor_path] = Category.objects.create(
+                full_path=ancestor_path,
+                name=parts[depth - 1],
+                parent_path=" > ".join(parts[: depth - 1]),
+                slug=slug,
+            )
+
+    # Roll product aggregates up into the (possibly new) ancestors
+    totals = {}
+    for path, category in categories.items():
+        products = list(category.products.order_by("name", "id"))
+        image = next(((p.name, p.image_url) for p in products if p.image_url), None)
+        parts = path.split(" > ")
+        for depth in range(1, len(parts) + 1):
+            entry = totals.setdefault(" > ".join(parts[:depth]), [0, 0, None])
+            entry[0] += len(products)
+            entry[1] += sum(1 for p in products if p.active)
+            if image and (entry[2] is None or image < entry[2]):
+                entry[2] = image
+
+    children = {}
+    roots = []
+    for path, category in categories.items():
+        parent_path = path.rpartition(" > ")[0]
+        category.parent = categories.get(parent_path) if parent_path else None
+        category.depth = path.count(" > ")
+        product_count, active_count, image = totals.get(path, [0, 0, None])
+        category.product_count = product_count
+        category.active_count = active_count
+        category.first_image_url = image[1] if image else ""
+        if category.parent:
+            children.setdefault(category.parent.pk, []).append(category)
+        else:
+            roots.append(category)
+
+    def number(category, tree_id, counter):
+        category.tree_id = tree_id
+        category.lft = counter
+        for child in sorted(children.get(category.pk, []), key=lambda c: c.name):
+            counter = number(child, tree_id, counter + 1)
+        category.rgt = counter + 1
+        category.save()
+        return counter + 1
+
+    for tree_id, root in enumerate(sorted(roots, key=lambda c: c.name), start=1):
+        number(root, tree_id, 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0009_product_listing_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="category",
+            name="depth",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="lft",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="parent",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="children",
+                to="pages.category",
+            ),
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="rgt",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="tree_id",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="category",
+            index=models.Index(fields=["tree_id", "lft"], name="category_tree_lft_idx"),
+        ),
+        migrations.RunPython(build_category_tree, migrations.RunPython.noop),
+    ]
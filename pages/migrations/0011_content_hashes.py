@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0010_category_tree"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="category",
+            name="content_hash",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="content_hash",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
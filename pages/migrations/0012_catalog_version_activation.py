@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:51
+
+from django.db import migrations, models
+
+
+def activate_latest_version(apps, schema_editor):
+    """The newest version was the live one before versions had an active flag."""
+    CatalogVersion = apps.get_model("pages", "CatalogVersion")
+    Product = apps.get_model("pages", "Product")
+    Category = apps.get_model("pages", "Category")
+    latest = CatalogVersion.objects.order_by("-id").first()
+    if latest is not None:
+        latest.is_active = True
+        latest.activated_at = latest.created_at
+        latest.product_count = Product.objects.filter(active=True).count()
+        latest.category_count = Category.objects.count()
+        latest.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0011_content_hashes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="catalogversion",
+            name="activated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="catalogversion",
+            name="category_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="catalogversion",
+            name="is_active",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="catalogversion",
+            name="product_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="catalogversion",
+            name="records",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(activate_latest_version, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="catalogversion",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("is_active", True)),
+                fields=("is_active",),
+                name="catalog_version_single_active",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0012_catalog_version_activation"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="local_images_json",
+            field=models.TextField(blank=True),
+        ),
+    ]
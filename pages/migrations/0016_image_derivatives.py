@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0015_image_blobs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="catalogversion",
+            name="images_updated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="imageblob",
+            name="derivative_widths",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name="imageblob",
+            name="derivatives_built_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="imageblob",
+            name="height",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="imageblob",
+            name="placeholder",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="imageblob",
+            name="width",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,120 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:14
+
+import json
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def _load(value, default):
+    try:
+        return json.loads(value) if value else default
+    except json.JSONDecodeError:
+        return default
+
+
+def backfill_product_images(apps, schema_editor):
+    """Turn images_json / local_images_json into ProductImage rows."""
+    Product = apps.get_model("pages", "Product")
+    ProductImage = apps.get_model("pages", "ProductImage")
+    ImageBlob = apps.get_model("pages", "ImageBlob")
+
+    blobs = dict(ImageBlob.objects.values_list("file", "id"))
+    rows = []
+    products = Product.objects.only(
+        "id", "image_url", "images_json", "local_images_json"
+    )
+    for product in products.iterator(chunk_size=2000):
+        urls = _load(product.images_json, []) or (
+            [product.image_url] if product.image_url else []
+        )
+        local = _load(product.local_images_json, {})
+        rows.extend(
+            ProductImage(
+                product_id=product.id,
+                position=position,
+                url=url,
+                blob_id=blobs.get(local.get(url)),
+            )
+            for position, url in enumerate(urls)
+        )
+        if len(rows) >= 5000:
+            ProductImage.objects.bulk_create(rows)
+            rows = []
+    ProductImage.objects.bulk_create(rows)
+
+
+def restore_images_json(apps, schema_editor):
+    """Rebuild images_json / local_images_json from the ProductImage rows."""
+    Product = apps.get_model("pages", "Product")
+    ProductImage = apps.get_model("pages", "ProductImage")
+
+    images = {}
+    for product_id, url, blob_file in ProductImage.objects.order_by(
+        "product_id", "position"
+    ).values_list("product_id", "url", "blob__file"):
+        images.setdefault(product_id, []).append((url, blob_file))
+    products = []
+    for product in Product.objects.filter(id__in=images).only("id"):
+        product_images = images[product.id]
+        product.images_json = json.dumps([url for url, _ in product_images])
+        product.local_images_json = json.dumps(
+            {url: blob_file for url, blob_file in product_images if blob_file}
+        )
+        products.append(product)
+    Product.objects.bulk_update(
+        products, ["images_json", "local_images_json"], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0016_image_derivatives"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProductImage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("position", models.PositiveSmallIntegerField()),
+                ("url", models.URLField(max_length=1000)),
+                (
+                    "blob",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="product_images",
+                        to="pages.imageblob",
+                    ),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="images",
+                        to="pages.product",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["position"],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("product", "position"), name="product_image_position"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(backfill_product_images, restore_images_json),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:14
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0017_product_images"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="product",
+            name="images_json",
+        ),
+        migrations.RemoveField(
+            model_name="product",
+            name="local_images_json",
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0019_background_jobs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="after",
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
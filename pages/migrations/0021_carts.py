@@ -0,0 +1,140 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def move_session_carts(apps, schema_editor):
+    """Turn the carts stored in session data into Cart and CartItem rows."""
+    from django.contrib.sessions.backends.db import SessionStore
+
+    Session = apps.get_model("sessions", "Session")
+    Product = apps.get_model("pages", "Product")
+    Cart = apps.get_model("pages", "Cart")
+    CartItem = apps.get_model("pages", "CartItem")
+
+    store = SessionStore()
+    last_key = ""
+    while True:
+        # Page by key rather than holding a cursor open while updating the table
+        sessions = list(
+            Session.objects.filter(session_key__gt=last_key).order_by("session_key")[
+                :2000
+            ]
+        )
+        if not sessions:
+            break
+        last_key = sessions[-1].session_key
+        for session in sessions:
+            data = store.decode(session.session_data)
+            if "cart" not in data:
+                continue
+            lines = data.pop("cart") or {}
+            products = Product.objects.in_bulk(list(lines), field_name="product_code")
+            items = [
+                (products[product_code], line["quantity"])
+                for product_code, line in lines.items()
+                if product_code in products and line.get("quantity", 0) > 0
+            ]
+            if items:
+                cart = Cart.objects.create(session_key=session.session_key)
+                CartItem.objects.bulk_create(
+                    CartItem(cart=cart, product=product, quantity=quantity)
+                    for product, quantity in items
+                )
+            session.session_data = store.encode(data)
+            session.save(update_fields=["session_data"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0020_job_after"),
+        ("sessions", "0001_initial"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Cart",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "session_key",
+                    models.CharField(blank=True, max_length=40, null=True, unique=True),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.OneToOneField(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="cart",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="CartItem",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("quantity", models.PositiveIntegerField()),
+                (
+                    "cart",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="items",
+                        to="pages.cart",
+                    ),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="pages.product",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["id"],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="cart",
+            constraint=models.CheckConstraint(
+                condition=models.Q(
+                    ("session_key__isnull", False),
+                    ("user__isnull", False),
+                    _connector="OR",
+                ),
+                name="cart_has_owner",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="cartitem",
+            constraint=models.UniqueConstraint(
+                fields=("cart", "product"), name="cart_item_product"
+            ),
+        ),
+        migrations.RunPython(move_session_carts, migrations.RunPython.noop),
+    ]
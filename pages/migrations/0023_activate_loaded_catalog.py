@@ -0,0 +1,35 @@
+from django.db import migrations
+from django.utils import timezone
+
+
+def activate_loaded_catalog(apps, schema_editor):
+    """
+    Give a catalog loaded before catalog versions existed an active version,
+    so readiness passes without reloading the feed.
+    """
+    CatalogVersion = apps.get_model("pages", "CatalogVersion")
+    Category = apps.get_model("pages", "Category")
+    Product = apps.get_model("pages", "Product")
+
+    if CatalogVersion.objects.filter(is_active=True).exists():
+        return
+    if not Product.objects.exists():
+        return
+    CatalogVersion.objects.create(
+        source="existing catalog",
+        is_active=True,
+        activated_at=timezone.now(),
+        product_count=Product.objects.filter(active=True).count(),
+        category_count=Category.objects.count(),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0022_catalogversion_edited_at"),
+    ]
+
+    operations = [
+        migrations.RunPython(activate_loaded_catalog, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_product_codes(apps, schema_editor):
+    """Point each cart line at its product's code instead of its id."""
+    CartItem = apps.get_model("pages", "CartItem")
+    Product = apps.get_model("pages", "Product")
+    CartItem.objects.update(
+        product=Subquery(
+            Product.objects.filter(pk=OuterRef("old_product")).values("product_code")
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pages", "0023_activate_loaded_catalog"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="cartitem",
+            name="cart_item_product",
+        ),
+        migrations.RenameField(
+            model_name="cartitem",
+            old_name="product",
+            new_name="old_product",
+        ),
+        migrations.AddField(
+            model_name="cartitem",
+            name="product",
+            field=models.ForeignKey(
+                db_column="product_code",
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="+",
+                to="pages.product",
+                to_field="product_code",
+            ),
+        ),
+        migrations.RunPython(copy_product_codes, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="cartitem",
+            name="old_product",
+        ),
+        migrations.AlterField(
+            model_name="cartitem",
+            name="product",
+            field=models.ForeignKey(
+                db_column="product_code",
+                db_constraint=False,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="+",
+                to="pages.product",
+                to_field="product_code",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="cartitem",
+            constraint=models.UniqueConstraint(
+                fields=("cart", "product"), name="cart_item_product"
+            ),
+        ),
+    ]
@@ -1,5 +1,23 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.db import models
-import json
+from django.urls import reverse
+from django.utils import timezone
+import posixpath
+
+
+# Storage directory of the content-addressed image store
+BLOB_DIR = 'blobs'
+# Formats of the resized copies of each blob, and the width used as plain src
+DERIVATIVE_EXTENSIONS = ('webp', 'jpg')
+DEFAULT_DERIVATIVE_WIDTH = 640
+
+
+def stored_image_url(name):
+    """URL of a stored image file; content-addressed blobs are served with immutable caching."""
+    if name.startswith(BLOB_DIR + '/'):
+        return reverse('image_blob', args=[posixpath.basename(name)])
+    return default_storage.url(name)
 
 
 class Category(models.Model):
@@ -8,21 +26,55 @@ class Category(models.Model):
     full_path = models.CharField(max_length=500, unique=True)  # Full category path like "Glass clamps > GC For flat > Glass clamps 40 x 50 mm"
     slug = models.SlugField(max_length=255, blank=True)
     parent_path = models.CharField(max_length=500, blank=True)  # Parent category path if hierarchical
+    # Category tree (nested set), rebuilt by load_catalog: a category's subtree is
+    # every row of the same tree_id with lft between its lft and rgt
+    parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
+    depth = models.PositiveSmallIntegerField(default=0)  # 0 for top-level categories
+    tree_id = models.PositiveIntegerField(default=0)  # One tree per top-level category
+    lft = models.PositiveIntegerField(default=0)
+    rgt = models.PositiveIntegerField(default=0)
     image_url = models.URLField(max_length=1000, blank=True)  # URL to category image
     image = models.ImageField(upload_to='categories/', blank=True, null=True)  # Downloaded category image
+    # Denormalized aggregates over this category and its subcategories (rebuilt by load_catalog)
+    product_count = models.IntegerField(default=0)
+    active_count = models.IntegerField(default=0)
+    first_image_url = models.URLField(max_length=1000, blank=True)  # Image of the first product (by name) with one
+    content_hash = models.CharField(max_length=64, blank=True)  # Hash of the feed data, to skip unchanged rows on import
     
     class Meta:
         verbose_name_plural = "Categories"
         ordering = ['full_path']
+        indexes = [
+            models.Index(fields=['tree_id', 'lft'], name='category_tree_lft_idx'),
+        ]
     
     def __str__(self):
         return self.full_path
     
+    def subtree_q(self, field='category'):
+        """Q object matching rows whose `field` category is this category or below it."""
+        return models.Q(**{
+            f'{field}__tree_id': self.tree_id,
+            f'{field}__lft__gte': self.lft,
+            f'{field}__lft__lte': self.rgt,
+        })
+    
     def get_image_url(self):
         """Return the local image if available, otherwise the original URL."""
         if self.image:
-            return self.image.url
+            return stored_image_url(self.image.name)
         return self.image_url
+    
+    def get_image_blob(self):
+        """Return the ImageBlob of the downloaded image, or None."""
+        if not hasattr(self, '_image_blob'):
+            self._image_blob = blobs_by_file([self.image.name]).get(self.image.name) if self.image else None
+        return self._image_blob
+    
+    def get_responsive_image(self):
+        """Return the ImageBlob, or the supplier image through the resize proxy, or None."""
+        from .image_proxy import proxied_image
+        return self.get_image_blob() or proxied_image(self.image_url)
 
 
 class Product(models.Model):
@@ -30,6 +82,7 @@ class Product(models.Model):
     product_code = models.CharField(max_length=100, unique=True)
     active = models.BooleanField(default=True)
     name = models.CharField(max_length=500)
+    slug = models.SlugField(max_length=255, unique=True)  # URL slug, generated from the name by load_catalog
     price = models.DecimalField(max_digits=10, decimal_places=2)
     vat = models.CharField(max_length=20, blank=True)
     unit = models.CharField(max_length=50, blank=True)
@@ -45,28 +98,325 @@ class Product(models.Model):
     currency = models.CharField(max_length=10, default='EUR')
     seo_url = models.CharField(max_length=255, blank=True)
     image_url = models.URLField(max_length=500, blank=True)  # First product image URL
-    images_json = models.TextField(blank=True)  # JSON array of all image URLs (images 1-15)
+    content_hash = models.CharField(max_length=64, blank=True)  # Hash of the feed row, to skip unchanged rows on import
     
     class Meta:
         ordering = ['name']
+        indexes = [
+            # Keyset pagination of category listings, one per sort option
+            models.Index(fields=['name', 'id'], name='product_name_id_idx'),
+            models.Index(fields=['category', 'name', 'id'], name='product_cat_name_id_idx'),
+            models.Index(fields=['category', 'price', 'id'], name='product_cat_price_id_idx'),
+            models.Index(fields=['category', 'stock', 'id'], name='product_cat_stock_id_idx'),
+        ]
     
     def __str__(self):
         return self.name
     
+    def get_product_images(self):
+        """Return the ProductImage rows in order (prefetched by listings, one query otherwise)."""
+        return list(self.images.all())
+    
+    def get_source_images(self):
+        """Return list of the supplier's image URLs."""
+        return [image.url for image in self.get_product_images()]
+    
     def get_images(self):
-        """Return list of image URLs."""
-        if self.images_json:
-            try:
-                return json.loads(self.images_json)
-            except json.JSONDecodeError:
-                return []
-        # Fallback to image_url if images_json is empty
-        if self.image_url:
-            return [self.image_url]
-        return []
+        """Return list of image URLs, pointing at the downloaded copies where available."""
+        return [image.get_url() for image in self.get_product_images()]
+    
+    def get_image_url(self):
+        """Return the first image, the downloaded copy if available."""
+        images = self.get_product_images()
+        return images[0].get_url() if images else self.image_url
+    
+    def get_image_blob(self):
+        """Return the ImageBlob of the first image, or None if it is not downloaded."""
+        images = self.get_product_images()
+        return images[0].blob if images else None
+    
+    def get_responsive_image(self):
+        """Return the ImageBlob of the first image, or the supplier image through the resize proxy, or None."""
+        images = self.get_product_images()
+        return images[0].get_responsive_image() if images else None
+    
+    def get_gallery(self):
+        """
+        Return a list of (image URL, image) for every image.
+
+        image is the ImageBlob where downloaded, otherwise a ProxiedImage.
+        """
+        return [(image.get_url(), image.get_responsive_image()) for image in self.get_product_images()]
     
     def get_slug(self):
-        """Generate slug from product name."""
+        """Return the stored slug, falling back to the slugified name."""
+        if self.slug:
+            return self.slug
         from django.utils.text import slugify
         return slugify(self.name)
 
+
+class ProductRedirect(models.Model):
+    """Old product URL slug that now redirects to a product's current slug."""
+    # Top-level category slug the old URL was scoped to; blank matches any category
+    category_slug = models.SlugField(max_length=255, blank=True)
+    old_slug = models.SlugField(max_length=255)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='redirects')
+    
+    class Meta:
+        unique_together = [('old_slug', 'category_slug')]
+    
+    def __str__(self):
+        return f'{self.category_slug or "*"}/{self.old_slug} -> {self.product.slug}'
+
+
+class CatalogVersion(models.Model):
+    """A catalog import. The single active row is the live catalog version."""
+    created_at = models.DateTimeField(auto_now_add=True)
+    source = models.CharField(max_length=500, blank=True)  # CSV file the catalog was loaded from
+    is_active = models.BooleanField(default=False)
+    activated_at = models.DateTimeField(null=True, blank=True)
+    # Row counts checked before the version was activated
+    product_count = models.IntegerField(default=0)  # Active products
+    category_count = models.IntegerField(default=0)
+    # Gzipped JSON of the feed records this version was built from, kept for
+    # the most recent versions so load_catalog --rollback can restore them
+    records = models.BinaryField(null=True, editable=False)
+    # Last time download_category_images changed the stored images, so cached pages pick them up
+    images_updated_at = models.DateTimeField(null=True, blank=True)
+    # Last edit of categories or products outside an import (admin), likewise
+    edited_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['is_active'], condition=models.Q(is_active=True), name='catalog_version_single_active',
+            ),
+        ]
+
+    def __str__(self):
+        return f'v{self.pk} ({self.created_at:%Y-%m-%d %H:%M})'
+
+
+class ImageBlob(models.Model):
+    """An image file in the content-addressed store, stored once however many URLs serve it."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.CharField(max_length=255)  # Storage name, blobs/<first 2 hex digits>/<sha256><ext>
+    size = models.PositiveIntegerField(default=0)
+    content_type = models.CharField(max_length=100, blank=True)
+    # Categories and products using this blob, recounted by download_category_images and gc_images
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Resized copies, stored next to the blob as <sha256>-<width>w.webp/.jpg (download_category_images)
+    width = models.PositiveIntegerField(default=0)
+    height = models.PositiveIntegerField(default=0)
+    derivative_widths = models.JSONField(default=list, blank=True)
+    placeholder = models.TextField(blank=True)  # Tiny blurred JPEG as a data: URI
+    derivatives_built_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.sha256
+
+    def get_url(self):
+        return stored_image_url(self.file)
+
+    def derivative_name(self, width, extension):
+        """Storage name of the resized copy of this blob."""
+        return f'{posixpath.dirname(self.file)}/{self.sha256}-{width}w.{extension}'
+
+    def derivative_files(self):
+        """Storage names of all resized copies of this blob."""
+        return [
+            self.derivative_name(width, extension)
+            for width in self.derivative_widths
+            for extension in DERIVATIVE_EXTENSIONS
+        ]
+
+    def srcset(self, extension):
+        return ', '.join(
+            f'{stored_image_url(self.derivative_name(width, extension))} {width}w'
+            for width in self.derivative_widths
+        )
+
+    @property
+    def webp_srcset(self):
+        return self.srcset('webp')
+
+    @property
+    def jpeg_srcset(self):
+        return self.srcset('jpg')
+
+    @property
+    def src(self):
+        """Fallback src for browsers without srcset: a mid-sized JPEG, else the original."""
+        widths = [width for width in self.derivative_widths if width <= DEFAULT_DERIVATIVE_WIDTH]
+        if widths:
+            return stored_image_url(self.derivative_name(max(widths), 'jpg'))
+        if self.derivative_widths:
+            return stored_image_url(self.derivative_name(min(self.derivative_widths), 'jpg'))
+        return self.get_url()
+
+
+def blobs_by_file(names):
+    """Return a dict of storage name -> ImageBlob for the given names, in one query."""
+    names = {name for name in names if name}
+    if not names:
+        return {}
+    return {blob.file: blob for blob in ImageBlob.objects.filter(file__in=names)}
+
+
+def prefetch_product_images(products):
+    """Load the images of all products, with their blobs, in one query."""
+    models.prefetch_related_objects(
+        list(products), models.Prefetch('images', queryset=ProductImage.objects.select_related('blob')),
+    )
+    return products
+
+
+class RemoteImage(models.Model):
+    """Manifest entry for a supplier image URL and its local copy, used to revalidate it cheaply."""
+    url = models.URLField(max_length=1000, unique=True)
+    blob = models.ForeignKey(ImageBlob, on_delete=models.SET_NULL, null=True, blank=True, related_name='sources')
+    # Validators from the last 200 response, sent back as If-None-Match / If-Modified-Since
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    size = models.PositiveIntegerField(default=0)
+    content_hash = models.CharField(max_length=64, blank=True)  # SHA-256 of the downloaded bytes
+    checked_at = models.DateTimeField(null=True, blank=True)  # Last successful request (200 or 304)
+    changed_at = models.DateTimeField(null=True, blank=True)  # Last time the bytes changed
+
+    def __str__(self):
+        return self.url
+
+
+class ProductImage(models.Model):
+    """A product image from the feed (images 1-15), with its downloaded copy."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
+    position = models.PositiveSmallIntegerField()  # 0 for the main image
+    url = models.URLField(max_length=1000)  # Supplier URL
+    # Downloaded copy, set by download_category_images; dimensions are on the blob
+    blob = models.ForeignKey(
+        ImageBlob, on_delete=models.SET_NULL, null=True, blank=True, related_name='product_images',
+    )
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            # Also the index behind image lookups and "has an image" filters (position 0)
+            models.UniqueConstraint(fields=['product', 'position'], name='product_image_position'),
+        ]
+
+    def __str__(self):
+        return self.url
+
+    def get_url(self):
+        """URL of the downloaded copy if available, otherwise the supplier URL."""
+        return self.blob.get_url() if self.blob_id else self.url
+
+    def get_responsive_image(self):
+        """The ImageBlob, or the supplier image through the resize proxy."""
+        from .image_proxy import proxied_image
+        return self.blob if self.blob_id else proxied_image(self.url)
+
+
+class TopLevelCategory(models.Model):
+    """Materialized index of top-level categories, rebuilt by load_catalog."""
+    name = models.CharField(max_length=255, unique=True)  # First part of Category.full_path
+    slug = models.SlugField(max_length=255, unique=True)
+    product_count = models.IntegerField(default=0)
+    active_count = models.IntegerField(default=0)
+    image_url = models.URLField(max_length=1000, blank=True)  # Representative image for the menu/landing page
+
+    class Meta:
+        verbose_name_plural = "Top-level categories"
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class Job(models.Model):
+    """A management command queued for the run_background_jobs worker."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    command = models.CharField(max_length=100)
+    arguments = models.JSONField(default=list, blank=True)  # Positional arguments for call_command
+    key = models.CharField(max_length=100, blank=True)  # At most one queued or running job per key
+    after = models.CharField(max_length=100, blank=True)  # Not claimed while a job with this key is queued or running
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)  # Not claimed before this (retry backoff)
+    # Lease of the worker running the job, extended by its heartbeat; a lapsed
+    # lease means the worker died and the job may be claimed again
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    progress = models.FloatField(null=True, blank=True)  # Percent done, when the command reports it
+    message = models.CharField(max_length=255, blank=True)  # Latest progress message
+    output = models.TextField(blank=True)  # End of the command's output
+    error = models.TextField(blank=True)  # Error of the last failed attempt
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['key'],
+                condition=models.Q(status__in=['queued', 'running']) & ~models.Q(key=''),
+                name='job_single_pending_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.command} #{self.pk} ({self.status})'
+
+
+class Cart(models.Model):
+    """A shopping cart, owned by an anonymous session or by a signed-in customer."""
+    session_key = models.CharField(max_length=40, unique=True, null=True, blank=True)
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True, related_name='cart',
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(session_key__isnull=False) | models.Q(user__isnull=False), name='cart_has_owner',
+            ),
+        ]
+
+    def __str__(self):
+        return f'Cart #{self.pk}'
+
+
+class CartItem(models.Model):
+    """A cart line; quantities are changed with single UPDATE ... SET quantity = quantity + n statements."""
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
+    # By product code and without a database constraint, so lines outlive a
+    # catalog reload (load_catalog --clear) and come back with the product
+    product = models.ForeignKey(
+        Product, to_field='product_code', db_column='product_code', on_delete=models.DO_NOTHING,
+        db_constraint=False, related_name='+',
+    )
+    quantity = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['id']
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='cart_item_product'),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id}'
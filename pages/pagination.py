@@ -0,0 +1,86 @@
+"""
+Keyset (cursor) pagination for product listings.
+
+Pages are addressed by the sort key of the last (or first) product shown
+instead of an OFFSET, so every page is a single indexed range scan no
+matter how deep the user browses.
+"""
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+from .models import Product
+
+
+# Sort option -> (field, descending); ties are always broken by id
+SORT_OPTIONS = {
+    'name': ('name', False),
+    'price': ('price', False),
+    '-price': ('price', True),
+    'stock': ('stock', True),
+}
+DEFAULT_SORT = 'name'
+PAGE_SIZES = [24, 48, 96]
+DEFAULT_PAGE_SIZE = 48
+
+
+def encode_cursor(product, field):
+    """Encode the (field, id) key of a product as a URL-safe cursor."""
+    payload = json.dumps([str(getattr(product, field)), product.pk])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, field):
+    """Decode a cursor into a (value, id) key, or None if it is malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return Product._meta.get_field(field).to_python(value), int(pk)
+    except (ValueError, TypeError, ValidationError):
+        return None
+
+
+def _after(field, descending, key):
+    """Q object selecting rows that sort after key."""
+    value, pk = key
+    op = 'lt' if descending else 'gt'
+    return Q(**{f'{field}__{op}': value}) | Q(**{field: value, f'pk__{op}': pk})
+
+
+def paginate_products(queryset, sort=DEFAULT_SORT, per_page=DEFAULT_PAGE_SIZE, after=None, before=None):
+    """
+    Return one page of products plus cursors for the neighbouring pages.
+
+    The result dict has 'products', 'next_cursor' and 'prev_cursor'
+    (None when there is no such page).
+    """
+    field, descending = SORT_OPTIONS.get(sort, SORT_OPTIONS[DEFAULT_SORT])
+    ordering = [f'-{field}', '-pk'] if descending else [field, 'pk']
+    reverse_ordering = [field, 'pk'] if descending else [f'-{field}', '-pk']
+
+    after_key = decode_cursor(after, field) if after else None
+    before_key = decode_cursor(before, field) if before else None
+
+    if before_key:
+        # Walk backwards from the cursor, then restore display order
+        rows = list(
+            queryset.filter(_after(field, not descending, before_key))
+            .order_by(*reverse_ordering)[:per_page + 1]
+        )
+        has_more = len(rows) > per_page
+        products = rows[:per_page][::-1]
+        has_prev, has_next = has_more, True
+    else:
+        if after_key:
+            queryset = queryset.filter(_after(field, descending, after_key))
+        rows = list(queryset.order_by(*ordering)[:per_page + 1])
+        products = rows[:per_page]
+        has_prev, has_next = after_key is not None, len(rows) > per_page
+
+    return {
+        'products': products,
+        'next_cursor': encode_cursor(products[-1], field) if products and has_next else None,
+        'prev_cursor': encode_cursor(products[0], field) if products and has_prev else None,
+    }
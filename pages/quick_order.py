@@ -0,0 +1,163 @@
+"""
+Quick order: product codes and quantities pasted from a customer's own list
+or uploaded as CSV, added to the cart at once.
+
+Lines are "code;quantity" (comma and tab separators work too). All codes are
+looked up with one query against the unique product_code index; valid lines
+are added to the cart with one write and every other line gets an error.
+"""
+import csv
+import io
+from .cart import MAX_ITEM_QUANTITY, add_items, cart_quantities
+from .models import Product
+
+# Most lines accepted per order
+MAX_LINES = 1000
+MAX_UPLOAD_BYTES = 1024 * 1024
+DELIMITERS = ';,\t'
+# Product columns needed to validate a line
+QUICK_ORDER_FIELDS = ('product_code', 'name', 'active', 'stock')
+
+
+class SemicolonDialect(csv.excel):
+    """Lines whose separator cannot be detected, e.g. a single code without quantity."""
+    delimiter = ';'
+
+
+def read_upload(upload):
+    """Text of an uploaded CSV file (UTF-8, with or without BOM, else Latin-1 as saved by Excel)."""
+    if upload.size > MAX_UPLOAD_BYTES:
+        raise ValueError(f'El archivo es demasiado grande (máximo {MAX_UPLOAD_BYTES // 1024} KB)')
+    data = upload.read()
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def parse_quantity(value):
+    """Return (quantity, None) for a positive whole number, else (None, error)."""
+    try:
+        quantity = int(str(value).strip())
+    except ValueError:
+        return None, f'Cantidad inválida: {value}'
+    if quantity <= 0:
+        return None, 'La cantidad debe ser mayor que 0'
+    return quantity, None
+
+
+def check_size(lines):
+    """Refuse orders with more than MAX_LINES lines."""
+    if len(lines) > MAX_LINES:
+        raise ValueError(f'Demasiadas líneas ({len(lines)}); el máximo es {MAX_LINES}')
+
+
+def parse_lines(text):
+    """
+    Parse "code;quantity" lines.
+
+    Return (lines, errors): lines is a list of (line number, code, quantity),
+    errors a list of {'line', 'code', 'error'}. Blank lines are skipped, and
+    so is a header row such as "código;cantidad".
+    """
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=DELIMITERS)
+    except csv.Error:
+        dialect = SemicolonDialect
+    lines = []
+    errors = []
+    for number, row in enumerate(csv.reader(io.StringIO(text), dialect), start=1):
+        row = [value.strip() for value in row]
+        if not any(row):
+            continue
+        code = row[0]
+        if len(row) < 2 or not row[1]:
+            errors.append({'line': number, 'code': code, 'error': 'Formato inválido, use código;cantidad'})
+            continue
+        quantity, error = parse_quantity(row[1])
+        if error:
+            if not lines and not errors and not row[1].lstrip('-').isdigit():
+                # Header row
+                continue
+            errors.append({'line': number, 'code': code, 'error': error})
+            continue
+        lines.append((number, code, quantity))
+    check_size(lines)
+    return lines, errors
+
+
+def parse_items(items):
+    """Parse [{'code': ..., 'quantity': ...}] from the JSON endpoint; items are numbered from 1 like lines."""
+    if not isinstance(items, list):
+        raise ValueError('items debe ser una lista')
+    lines = []
+    errors = []
+    for number, item in enumerate(items, start=1):
+        item = item if isinstance(item, dict) else {}
+        code = str(item.get('code', '')).strip()
+        if not code:
+            errors.append({'line': number, 'code': code, 'error': 'Falta el código'})
+            continue
+        quantity, error = parse_quantity(item.get('quantity', ''))
+        if error:
+            errors.append({'line': number, 'code': code, 'error': error})
+            continue
+        lines.append((number, code, quantity))
+    check_size(lines)
+    return lines, errors
+
+
+def validate_lines(lines, in_cart=None):
+    """
+    Check parsed lines against the catalog with one query.
+
+    Return (quantities, errors): quantities maps each orderable Product to
+    its total quantity (a code may appear on several lines), errors lists
+    the lines with unknown codes, inactive products, more than
+    MAX_ITEM_QUANTITY units or insufficient stock. in_cart maps product
+    codes to the quantities already in the cart, which count against both
+    limits too.
+    """
+    products = Product.objects.only(*QUICK_ORDER_FIELDS).in_bulk(
+        {code for _, code, _ in lines}, field_name='product_code',
+    )
+    totals = dict(in_cart or {})
+    for _, code, quantity in lines:
+        totals[code] = totals.get(code, 0) + quantity
+
+    quantities = {}
+    errors = []
+    for number, code, quantity in lines:
+        product = products.get(code)
+        already = f', ya en el carrito: {in_cart[code]}' if in_cart and in_cart.get(code) else ''
+        if product is None:
+            error = 'Código desconocido'
+        elif not product.active:
+            error = 'Producto no disponible'
+        elif totals[code] > MAX_ITEM_QUANTITY:
+            error = f'Cantidad excesiva (máximo por producto: {MAX_ITEM_QUANTITY}{already})'
+        elif totals[code] > product.stock:
+            error = f'Stock insuficiente (disponible: {product.stock}{already})'
+        else:
+            quantities[product] = quantities.get(product, 0) + quantity
+            continue
+        errors.append({'line': number, 'code': code, 'error': error})
+    return quantities, errors
+
+
+def add_lines_to_cart(request, lines, errors):
+    """
+    Validate parsed lines and add the valid ones to the cart.
+
+    Return {'added', 'quantity', 'errors'}: the number of cart lines
+    (distinct products) and units added, and the errors of parsing and
+    validation ordered by line.
+    """
+    in_cart = cart_quantities(request, {code for _, code, _ in lines})
+    quantities, invalid = validate_lines(lines, in_cart)
+    add_items(request, quantities)
+    return {
+        'added': len(quantities),
+        'quantity': sum(quantities.values()),
+        'errors': sorted(errors + invalid, key=lambda error: error['line']),
+    }
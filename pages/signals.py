@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .catalog import invalidate_catalog_caches, touch_catalog
+from .models import Category, Product
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def catalog_changed(sender, **kwargs):
+    """
+    Rebuild slug resolution and menus after a category or product is edited
+    or deleted: here at once, in the other processes through the catalog
+    version.
+    """
+    invalidate_catalog_caches()
+    touch_catalog()
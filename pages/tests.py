@@ -0,0 +1,1673 @@
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from importlib import import_module
+from decimal import Decimal
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.signing import get_cookie_signer
+from django.core.files.storage import default_storage
+from django.db import DatabaseError, connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .cart import (
+    CART_COUNT_COOKIE, CART_COUNT_SALT, MAX_ITEM_QUANTITY, add_item, add_items, count_items, get_cart_context,
+    get_cart_count,
+)
+from .catalog import (
+    SLUG_MAX_LENGTH, _reset_catalog_version, get_catalog_version, get_menu_categories, product_base_slug, slug_matches,
+    unique_slug,
+)
+from .catalog_copy import CopyCatalogImporter
+from .catalog_csv import DELIMITER, normalize_row, parse_catalog_parallel, read_catalog
+from .catalog_import import CatalogImporter, CatalogValidationError
+from .catalog_snapshot import CatalogSnapshot, export_snapshot
+from .health import check_migrations, readiness, wait_for
+from .image_derivatives import render_derivatives
+from .image_proxy import DiskLRUCache
+from .images import (
+    DownloadError, ImageDownloader, ImageSync, UnsupportedImage, blob_extension, build_derivatives, store_blob,
+)
+from .jobs import RETRY_BACKOFF_SECONDS, claim_job, enqueue, fail_exhausted_jobs, run_job, worker_name
+from .pagination import SORT_OPTIONS, encode_cursor, paginate_products
+from .models import (
+    BLOB_DIR, Cart, CartItem, CatalogVersion, Category, ImageBlob, Job, Product, ProductImage, ProductRedirect,
+    RemoteImage, TopLevelCategory, prefetch_product_images,
+)
+
+
+class ImageServer(ThreadingHTTPServer):
+    """Local stand-in for a supplier's image host that honours conditional requests."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ImageRequestHandler)
+        self.images = {}  # path -> (content, etag, last modified)
+        self.content_types = {}  # path -> Content-Type, when not image/png
+        self.failures = {}  # path -> statuses answered, one per request, before the image
+        self.requests = []  # (path, request headers)
+        self.delay = 0  # Seconds each request takes
+        self.lock = threading.Lock()
+        self.active = self.max_active = 0  # Requests being answered, and the most at once
+
+    def reset(self):
+        self.images.clear()
+        self.content_types.clear()
+        self.failures.clear()
+        self.requests.clear()
+        self.delay = 0
+        self.max_active = 0
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server_port}{path}'
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            self.respond()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def respond(self):
+        failures = self.server.failures.get(self.path)
+        if failures:
+            self.send_response(failures.pop(0))
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+        if self.path not in self.server.images:
+            self.send_response(404)
+            self.end_headers()
+            return
+        content, etag, last_modified = self.server.images[self.path]
+        if self.headers.get('If-None-Match') == etag or (
+            'If-None-Match' not in self.headers and self.headers.get('If-Modified-Since') == last_modified
+        ):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', self.server.content_types.get(self.path, 'image/png'))
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageServerTestCase(TestCase):
+    """Tests against an ImageServer, with media stored in a temporary directory."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ImageServer()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.media_root = tempfile.mkdtemp()
+        cls.media = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.reset()
+        self.downloader = ImageDownloader(concurrency=2, retries=0)
+        self.addCleanup(self.downloader.close)
+
+
+class ImageDownloaderTests(ImageServerTestCase):
+    """Concurrent downloads with per-host limits and retries."""
+
+    def add_images(self, count):
+        for number in range(count):
+            self.server.images[f'/{number}.png'] = (b'image %d' % number, f'"{number}"', '')
+        return [self.server.url(f'/{number}.png') for number in range(count)]
+
+    def test_transient_errors_are_retried(self):
+        url, = self.add_images(1)
+        self.server.failures['/0.png'] = [503, 429]
+        downloader = ImageDownloader(retries=2, backoff=0)
+        self.addCleanup(downloader.close)
+
+        self.assertEqual(downloader.fetch(url).content, b'image 0')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retries_give_up(self):
+        url, = self.add_images(1)
+        self.server.failures['/0.png'] = [503, 503]
+        downloader = ImageDownloader(retries=1, backoff=0)
+        self.addCleanup(downloader.close)
+
+        with self.assertRaisesMessage(DownloadError, 'after 2 attempts'):
+            downloader.fetch(url)
+
+    def test_client_errors_are_not_retried(self):
+        downloader = ImageDownloader(retries=3, backoff=0)
+        self.addCleanup(downloader.close)
+
+        with self.assertRaises(DownloadError):
+            downloader.fetch(self.server.url('/missing.png'))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_each_url_is_fetched_once_within_the_host_limit(self):
+        urls = self.add_images(8)
+        self.server.delay = 0.05
+        downloader = ImageDownloader(concurrency=6, per_host=2)
+        self.addCleanup(downloader.close)
+
+        results = list(downloader.download(urls + urls[:3]))
+
+        self.assertEqual(sorted(url for url, _, _ in results), sorted(urls))
+        self.assertTrue(all(response.status_code == 200 and error is None for _, response, error in results))
+        self.assertEqual(len(self.server.requests), 8)
+        self.assertEqual(self.server.max_active, 2)
+
+    def test_downloads_in_flight_are_bounded(self):
+        urls = self.add_images(20)
+        downloader = ImageDownloader(concurrency=2)
+        self.addCleanup(downloader.close)
+
+        # Nothing runs ahead of a consumer that stopped reading
+        results = downloader.download(urls)
+        next(results)
+        time.sleep(0.2)
+        self.assertLessEqual(len(self.server.requests), 5)
+        results.close()
+
+
+class ImageSyncTests(ImageServerTestCase):
+    """Revalidation of downloaded images against a local HTTP server."""
+
+    def sync(self, *paths, force=False):
+        sync = ImageSync(self.downloader, force=force)
+        results = {url: (manifest, error) for url, manifest, error in sync.sync(self.server.url(p) for p in paths)}
+        return sync.stats, results
+
+    def test_first_download_stores_validators(self):
+        self.server.images['/a.png'] = (b'first', '"v1"', 'Mon, 05 Oct 2026 10:00:00 GMT')
+        stats, results = self.sync('/a.png')
+
+        self.assertEqual(stats['downloaded'], 1)
+        manifest, error = results[self.server.url('/a.png')]
+        self.assertIsNone(error)
+        self.assertEqual(manifest.etag, '"v1"')
+        self.assertEqual(manifest.last_modified, 'Mon, 05 Oct 2026 10:00:00 GMT')
+        self.assertEqual(manifest.size, 5)
+        self.assertIsNotNone(manifest.blob)
+        self.assertNotIn('If-None-Match', self.server.requests[0][1])
+
+    def test_revalidation_sends_validators_and_keeps_copy_on_304(self):
+        self.server.images['/a.png'] = (b'first', '"v1"', 'Mon, 05 Oct 2026 10:00:00 GMT')
+        self.sync('/a.png')
+        blob = RemoteImage.objects.get().blob
+        self.server.requests.clear()
+
+        stats, _ = self.sync('/a.png')
+
+        self.assertEqual(stats, {'downloaded': 0, 'not_modified': 1, 'unchanged': 0, 'failed': 0})
+        headers = self.server.requests[0][1]
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'], 'Mon, 05 Oct 2026 10:00:00 GMT')
+        manifest = RemoteImage.objects.get()
+        self.assertEqual(manifest.blob, blob)
+        self.assertIsNotNone(manifest.checked_at)
+
+    def test_changed_image_is_downloaded_again(self):
+        self.server.images['/a.png'] = (b'first', '"v1"', 'Mon, 05 Oct 2026 10:00:00 GMT')
+        self.sync('/a.png')
+        self.server.images['/a.png'] = (b'second', '"v2"', 'Tue, 06 Oct 2026 10:00:00 GMT')
+
+        stats, _ = self.sync('/a.png')
+
+        self.assertEqual(stats['downloaded'], 1)
+        manifest = RemoteImage.objects.get()
+        self.assertEqual(manifest.etag, '"v2"')
+        self.assertEqual(manifest.size, 6)
+
+    def test_same_bytes_under_new_validators_are_unchanged(self):
+        self.server.images['/a.png'] = (b'first', '"v1"', 'Mon, 05 Oct 2026 10:00:00 GMT')
+        self.sync('/a.png')
+        blob = RemoteImage.objects.get().blob
+        self.server.images['/a.png'] = (b'first', '"v2"', 'Tue, 06 Oct 2026 10:00:00 GMT')
+
+        stats, _ = self.sync('/a.png')
+
+        self.assertEqual(stats['unchanged'], 1)
+        manifest = RemoteImage.objects.get()
+        self.assertEqual(manifest.etag, '"v2"')
+        self.assertEqual(manifest.blob, blob)
+
+    def test_force_downloads_without_validators(self):
+        self.server.images['/a.png'] = (b'first', '"v1"', 'Mon, 05 Oct 2026 10:00:00 GMT')
+        self.sync('/a.png')
+        self.server.requests.clear()
+
+        stats, _ = self.sync('/a.png', force=True)
+
+        self.assertNotIn('If-None-Match', self.server.requests[0][1])
+        self.assertEqual(stats['unchanged'], 1)
+
+    def test_identical_images_share_a_blob(self):
+        self.server.images['/a.png'] = (b'same', '"a"', 'Mon, 05 Oct 2026 10:00:00 GMT')
+        self.server.images['/b.png'] = (b'same', '"b"', 'Mon, 05 Oct 2026 10:00:00 GMT')
+
+        self.sync('/a.png', '/b.png')
+
+        first, second = RemoteImage.objects.order_by('url')
+        self.assertEqual(first.blob_id, second.blob_id)
+
+    def test_svg_is_refused_and_the_previous_copy_kept(self):
+        self.server.images['/a.png'] = (b'first', '"v1"', 'Mon, 05 Oct 2026 10:00:00 GMT')
+        self.sync('/a.png')
+        blob = RemoteImage.objects.get().blob
+        self.server.images['/a.png'] = (b'<svg onload="alert(1)"/>', '"v2"', 'Tue, 06 Oct 2026 10:00:00 GMT')
+        self.server.content_types['/a.png'] = 'image/svg+xml'
+
+        stats, results = self.sync('/a.png')
+
+        self.assertEqual(stats['failed'], 1)
+        manifest, error = results[self.server.url('/a.png')]
+        self.assertIsInstance(error, UnsupportedImage)
+        self.assertEqual(manifest.blob, blob)
+        self.assertEqual(RemoteImage.objects.get().etag, '"v1"')
+        self.assertFalse(ImageBlob.objects.filter(content_type='image/svg+xml').exists())
+
+    def test_untyped_download_takes_the_url_extension(self):
+        self.assertEqual(blob_extension('application/octet-stream', 'https://example.com/a.JPEG'), '.jpg')
+        self.assertEqual(blob_extension('', 'https://example.com/a'), '.jpg')
+        with self.assertRaises(UnsupportedImage):
+            blob_extension('', 'https://example.com/a.svg')
+        with self.assertRaises(UnsupportedImage):
+            blob_extension('text/html', 'https://example.com/a.png')
+
+    def test_blobs_are_served_without_sniffing_and_svg_as_attachment(self):
+        blob = store_blob(b'png bytes', 'image/png')
+        response = self.client.get(reverse('image_blob', args=[blob.file.rpartition('/')[2]]))
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+        self.assertTrue(response['Content-Disposition'].startswith('inline'))
+        response.close()
+
+        # An SVG stored before they were refused
+        name = 'ab' * 32 + '.svg'
+        default_storage.save(f'{BLOB_DIR}/ab/{name}', ContentFile(b'<svg/>'))
+        response = self.client.get(reverse('image_blob', args=[name]))
+        self.assertEqual(response['Content-Disposition'], 'attachment')
+        self.assertEqual(response['Content-Security-Policy'], "default-src 'none'")
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+        response.close()
+
+    def test_fetch_gives_up_past_max_bytes(self):
+        self.server.images['/big.png'] = (b'x' * 1000, '"v1"', 'Mon, 05 Oct 2026 10:00:00 GMT')
+
+        with self.assertRaisesMessage(DownloadError, 'too large'):
+            self.downloader.fetch(self.server.url('/big.png'), max_bytes=999)
+        self.assertEqual(self.downloader.fetch(self.server.url('/big.png'), max_bytes=1000).content, b'x' * 1000)
+
+    def test_missing_image_fails_without_manifest(self):
+        stats, results = self.sync('/missing.png')
+
+        self.assertEqual(stats['failed'], 1)
+        manifest, error = results[self.server.url('/missing.png')]
+        self.assertIsNone(manifest)
+        self.assertIsNotNone(error)
+        self.assertFalse(RemoteImage.objects.exists())
+
+
+def png_bytes(width, height, mode='RGB', color=(200, 30, 30)):
+    """A PNG image of the given size."""
+    buffer = io.BytesIO()
+    Image.new(mode, (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class ImageDerivativeTests(TestCase):
+    """Resized WebP/JPEG copies and placeholders of stored images."""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def test_widths_are_never_upscaled(self):
+        result = render_derivatives(png_bytes(700, 350))
+
+        self.assertEqual((result['width'], result['height']), (700, 350))
+        self.assertEqual(sorted(result['derivatives']), [
+            (width, extension) for width in (160, 320, 640) for extension in ('jpg', 'webp')
+        ])
+        with Image.open(io.BytesIO(result['derivatives'][(320, 'webp')])) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (320, 160)))
+        self.assertTrue(result['placeholder'].startswith('data:image/jpeg;base64,'))
+
+    def test_small_image_keeps_its_own_width(self):
+        result = render_derivatives(png_bytes(100, 50))
+
+        self.assertEqual(sorted({width for width, _ in result['derivatives']}), [100])
+
+    def test_transparency_is_flattened_for_jpeg(self):
+        result = render_derivatives(png_bytes(200, 100, mode='RGBA', color=(0, 0, 0, 0)))
+
+        with Image.open(io.BytesIO(result['derivatives'][(160, 'jpg')])) as image:
+            self.assertEqual(image.mode, 'RGB')
+            red, green, blue = image.getpixel((10, 10))
+            self.assertGreater(min(red, green, blue), 240)
+
+    def test_unreadable_content_has_no_derivatives(self):
+        self.assertIsNone(render_derivatives(b'not an image'))
+
+    def test_build_stores_copies_next_to_the_blob(self):
+        blob = store_blob(png_bytes(800, 400), 'image/png')
+        broken = store_blob(b'truncated', 'image/jpeg')
+
+        built, unreadable = build_derivatives([blob, broken], workers=1)
+
+        # Both processed, one of them not an image
+        self.assertEqual((built, unreadable), (2, 1))
+        blob.refresh_from_db()
+        self.assertEqual((blob.width, blob.height, blob.derivative_widths), (800, 400, [160, 320, 640]))
+        self.assertTrue(all(default_storage.exists(name) for name in blob.derivative_files()))
+        self.assertEqual(blob.src, f'/img/{blob.sha256}-640w.jpg')
+        self.assertIn(f'/img/{blob.sha256}-320w.webp 320w', blob.webp_srcset)
+        response = self.client.get(blob.src)
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'image/jpeg'))
+        response.close()
+
+        broken.refresh_from_db()
+        self.assertEqual((broken.width, broken.derivative_widths), (0, []))
+        self.assertEqual(broken.src, broken.get_url())
+
+
+class DiskLRUCacheTests(TestCase):
+    """Each cache entry is produced once, however many requests want it at the same time."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.calls = []
+
+    def producer(self, content=b'resized', delay=0.2):
+        def produce():
+            self.calls.append(content)
+            time.sleep(delay)
+            return content
+        return produce
+
+    def open_concurrently(self, caches, producers):
+        """Open the same entry from one thread per (cache, producer); return what each read."""
+        results = [None] * len(caches)
+        barrier = threading.Barrier(len(caches))
+
+        def read(index):
+            barrier.wait()
+            with caches[index].open('ab-640.jpg', producers[index]) as f:
+                results[index] = f.read()
+
+        threads = [threading.Thread(target=read, args=(index,)) for index in range(len(caches))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_opens_produce_once(self):
+        cache = DiskLRUCache(self.directory, 1024 * 1024)
+
+        results = self.open_concurrently([cache] * 8, [self.producer()] * 8)
+
+        self.assertEqual(self.calls, [b'resized'])
+        self.assertEqual(results, [b'resized'] * 8)
+
+    @mock.patch('pages.image_proxy.LOCK_TIMEOUT', 0.3)
+    def test_slow_producer_keeps_its_lock(self):
+        # Two caches on one directory stand for two processes
+        caches = [DiskLRUCache(self.directory, 1024 * 1024) for _ in range(4)]
+
+        results = self.open_concurrently(caches, [self.producer(delay=1)] * 4)
+
+        self.assertEqual(self.calls, [b'resized'])
+        self.assertEqual(results, [b'resized'] * 4)
+
+    def test_failure_is_remembered_briefly(self):
+        cache = DiskLRUCache(self.directory, 1024 * 1024)
+
+        def fail():
+            self.calls.append('fail')
+            raise ValueError('broken image')
+
+        for _ in range(3):
+            with self.assertRaisesMessage(ValueError, 'broken image'):
+                cache.open('ab-640.jpg', fail)
+        self.assertEqual(self.calls, ['fail'])
+
+        with mock.patch('pages.image_proxy.FAILURE_TTL', 0):
+            cache._failed('ab-640.jpg', ValueError('broken image'))
+        with cache.open('ab-640.jpg', self.producer(delay=0)) as f:
+            self.assertEqual(f.read(), b'resized')
+
+
+def feed_row(product_code, **values):
+    """A catalog CSV row as read by csv.DictReader."""
+    row = {
+        'product_code': product_code,
+        'category': 'Herrajes > Pinzas',
+        'active': '1',
+        'name': f'Producto {product_code}',
+        'price': '10,50',
+        'stock': '5',
+        'currency': 'EUR',
+    }
+    row.update(values)
+    return row
+
+
+def import_rows(*rows, dry_run=False, importer_class=CatalogImporter, **options):
+    """Import rows with CatalogImporter; return (importer, plan, stats)."""
+    importer = importer_class(**options)
+    plan, stats = importer.run((normalize_row(row) for row in rows), dry_run=dry_run)
+    return importer, plan, stats
+
+
+class NormalizeRowTests(TestCase):
+    def test_missing_columns_take_defaults(self):
+        record = normalize_row({'product_code': 'A1', 'price': '3,25'})
+
+        self.assertTrue(record['active'])
+        self.assertEqual(record['currency'], 'EUR')
+        self.assertEqual(record['price'], Decimal('3.25'))
+        self.assertEqual(record['stock'], 0)
+
+    def test_empty_cells_are_empty(self):
+        record = normalize_row({'product_code': 'A1', 'active': '', 'currency': '', 'price': ''})
+
+        self.assertFalse(record['active'])
+        self.assertEqual(record['currency'], '')
+        self.assertEqual(record['price'], Decimal('0'))
+
+    def test_short_row(self):
+        # csv.DictReader fills the missing cells of a short row with None
+        record = normalize_row({'product_code': 'A1', 'name': None, 'active': None})
+
+        self.assertEqual(record['name'], '')
+        self.assertFalse(record['active'])
+
+    def test_row_without_product_code_is_ignored(self):
+        self.assertIsNone(normalize_row({'product_code': '  ', 'name': 'Sin código'}))
+
+
+class ParallelParseTests(TestCase):
+    """The parallel parser returns exactly the serial parser's records."""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.csv')
+        self.addCleanup(os.remove, self.path)
+        rows = [
+            feed_row(
+                f'P{i}',
+                name=f'Pinza "{i}"; doble' if i % 3 else f'Pinza {i}',
+                # Quoted fields spanning lines, some with quotes and delimiters inside
+                description=f'Línea 1\nLínea 2; "{i}"\n' if i % 2 else f'Corta {i}',
+                short_description='\r\n'.join(['a', 'b']) if i % 5 == 0 else '',
+            )
+            for i in range(200)
+        ]
+        with os.fdopen(handle, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]), delimiter=DELIMITER)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    @mock.patch('pages.catalog_csv.os.cpu_count', return_value=4)
+    @mock.patch('pages.catalog_csv.MIN_CHUNK_BYTES', 512)
+    def test_small_chunks_match_serial_parse(self, cpu_count):
+        serial = list(read_catalog(self.path))
+        parallel = parse_catalog_parallel(self.path, 3)
+
+        self.assertIsNotNone(parallel)
+        self.assertEqual(len(serial), 200)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(serial[1]['description'], 'Línea 1\nLínea 2; "1"')
+        self.assertEqual(list(read_catalog(self.path, workers=3)), serial)
+
+    @mock.patch('pages.catalog_csv.os.cpu_count', return_value=1)
+    @mock.patch('pages.catalog_csv.MIN_CHUNK_BYTES', 512)
+    def test_single_cpu_parses_serially(self, cpu_count):
+        self.assertIsNone(parse_catalog_parallel(self.path, 3))
+
+
+class CatalogImportTests(TestCase):
+    def test_import_creates_catalog_and_activates_version(self):
+        importer, _, stats = import_rows(feed_row('A1'), feed_row('A2', category='Herrajes'), feed_row('A3', active='0'))
+
+        self.assertEqual(stats['products_created'], 3)
+        self.assertEqual(stats['categories_created'], 2)
+        self.assertEqual(Product.objects.filter(active=True).count(), 2)
+        self.assertEqual(Product.objects.get(product_code='A1').category.full_path, 'Herrajes > Pinzas')
+        version = CatalogVersion.objects.get(is_active=True)
+        self.assertEqual(version, importer.version)
+        self.assertEqual((version.product_count, version.category_count), (2, 2))
+
+    def test_later_duplicate_row_wins(self):
+        _, _, stats = import_rows(feed_row('A1', name='Primero'), feed_row('A1', name='Segundo'))
+
+        self.assertEqual(stats['rows'], 2)
+        self.assertEqual(Product.objects.get().name, 'Segundo')
+
+    def test_rows_that_do_not_fit_the_columns_are_skipped(self):
+        importer, _, stats = import_rows(
+            feed_row('A1'),
+            feed_row('A2', price='12345678901'),
+            feed_row('A3', name='x' * 501),
+            feed_row('A4', stock='9' * 30),
+        )
+
+        self.assertEqual(stats['rows_skipped'], 3)
+        self.assertEqual([code for code, _ in importer.skipped], ['A2', 'A3', 'A4'])
+        self.assertEqual(list(Product.objects.values_list('product_code', flat=True)), ['A1'])
+        self.assertEqual(importer.version.product_count, 1)
+
+    def test_clear_replaces_the_catalog(self):
+        import_rows(feed_row('A1'), feed_row('A2'))
+
+        import_rows(feed_row('B1', category='Vidrio'), clear=True, max_shrink=None)
+
+        self.assertEqual(list(Product.objects.values_list('product_code', flat=True)), ['B1'])
+        self.assertEqual(list(Category.objects.values_list('full_path', flat=True)), ['Vidrio'])
+
+
+class CatalogCacheTests(TestCase):
+    """The menu comes from the top-level index, cached until the catalog version changes."""
+
+    def setUp(self):
+        _reset_catalog_version()
+        self.addCleanup(_reset_catalog_version)
+
+    def load(self, *rows):
+        with self.captureOnCommitCallbacks(execute=True):
+            import_rows(*rows)
+
+    def menu(self):
+        return [(category['name'], category['slug'], category['count']) for category in get_menu_categories()]
+
+    def test_top_level_index_counts_the_products_below(self):
+        self.load(
+            feed_row('A1'), feed_row('A2', category='Herrajes > Bisagras'),
+            feed_row('B1', category='Vidrio', active='0'), feed_row('C1', category=''),
+        )
+
+        self.assertEqual(
+            list(TopLevelCategory.objects.values_list('name', 'slug', 'product_count', 'active_count')),
+            [('Herrajes', 'herrajes', 2, 2), ('Vidrio', 'vidrio', 1, 0)],
+        )
+        self.assertEqual(self.menu(), [('Herrajes', 'herrajes', 2), ('Vidrio', 'vidrio', 1)])
+
+    def test_menu_is_cached_until_an_import_activates_a_new_version(self):
+        self.load(feed_row('A1'))
+        self.menu()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.menu(), [('Herrajes', 'herrajes', 1)])
+
+        self.load(feed_row('A1'), feed_row('B1', category='Vidrio'))
+        self.assertEqual(self.menu(), [('Herrajes', 'herrajes', 1), ('Vidrio', 'vidrio', 1)])
+
+    def test_other_processes_see_a_new_version_after_the_check_interval(self):
+        self.load(feed_row('A1'))
+        self.menu()
+        # Another process renames the category and bumps the version, without
+        # resetting this process's caches
+        TopLevelCategory.objects.update(name='Herrajes nuevos')
+        CatalogVersion.objects.filter(is_active=True).update(edited_at=timezone.now())
+
+        self.assertEqual(self.menu(), [('Herrajes', 'herrajes', 1)])
+        with override_settings(CATALOG_VERSION_CHECK_INTERVAL=0):
+            self.assertEqual(self.menu(), [('Herrajes nuevos', 'herrajes', 1)])
+
+
+class CategoryAggregateTests(TestCase):
+    """load_catalog stores subtree totals on every category for the landing page."""
+
+    def setUp(self):
+        _reset_catalog_version()
+        self.addCleanup(_reset_catalog_version)
+        with self.captureOnCommitCallbacks(execute=True):
+            import_rows(
+                feed_row('A1', name='Pinza B', **{'images 1': 'https://example.com/b.jpg'}),
+                feed_row(
+                    'A2', name='Pinza A', category='Herrajes > Pinzas > Planas',
+                    **{'images 1': 'https://example.com/a.jpg'},
+                ),
+                feed_row('A3', name='Bisagra', category='Herrajes > Bisagras', active='0'),
+                feed_row('A4', name='Aaa sin imagen', category='Herrajes > Bisagras'),
+            )
+
+    def test_counts_and_first_image_roll_up_the_tree(self):
+        categories = {
+            category.full_path: (category.product_count, category.active_count, category.first_image_url)
+            for category in Category.objects.all()
+        }
+
+        self.assertEqual(categories, {
+            'Herrajes': (4, 3, 'https://example.com/a.jpg'),
+            'Herrajes > Pinzas': (2, 2, 'https://example.com/a.jpg'),
+            'Herrajes > Pinzas > Planas': (1, 1, 'https://example.com/a.jpg'),
+            'Herrajes > Bisagras': (2, 1, ''),
+        })
+        top_level = TopLevelCategory.objects.get()
+        self.assertEqual((top_level.product_count, top_level.image_url), (4, 'https://example.com/a.jpg'))
+
+    def test_deactivated_product_updates_the_active_counts(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            import_rows(
+                feed_row('A1', name='Pinza B', **{'images 1': 'https://example.com/b.jpg'}),
+                feed_row('A3', name='Bisagra', category='Herrajes > Bisagras', active='0'),
+                feed_row('A4', name='Aaa sin imagen', category='Herrajes > Bisagras'),
+            )
+
+        # A2 is kept, inactive
+        herrajes = Category.objects.get(full_path='Herrajes')
+        self.assertEqual((herrajes.product_count, herrajes.active_count), (4, 2))
+        planas = Category.objects.get(full_path='Herrajes > Pinzas > Planas')
+        self.assertEqual((planas.product_count, planas.active_count), (1, 0))
+
+    def test_landing_page_renders_from_the_cached_index(self):
+        self.client.get(reverse('landing_page'))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('landing_page'))
+
+        self.assertContains(response, 'Herrajes')
+        self.assertEqual(response.context['categories'][0]['count'], 4)
+
+
+@override_settings(CATALOG_SNAPSHOT_PATH='')
+class ProductUrlTests(TestCase):
+    """Products have unique stored slugs, served under their top-level category."""
+
+    def setUp(self):
+        _reset_catalog_version()
+        self.addCleanup(_reset_catalog_version)
+        with self.captureOnCommitCallbacks(execute=True):
+            import_rows(
+                feed_row('A1', name='Pinza'),
+                feed_row('A2', name='Pinza'),
+                feed_row('B1', name='Vidrio templado', category='Vidrio > Templado'),
+            )
+
+    def url(self, category_slug, product_slug):
+        return reverse('product_page', args=[category_slug, product_slug])
+
+    def test_same_names_get_distinct_slugs(self):
+        self.assertEqual(
+            list(Product.objects.order_by('product_code').values_list('slug', flat=True)),
+            ['pinza', 'pinza-1', 'vidrio-templado'],
+        )
+
+    def test_long_names_fit_the_slug_column(self):
+        slug = product_base_slug('x' * 300, 'A1')
+        self.assertEqual(len(slug), SLUG_MAX_LENGTH)
+
+        variant = unique_slug(slug, {slug})
+        self.assertEqual(len(variant), SLUG_MAX_LENGTH)
+        self.assertTrue(variant.endswith('-1'))
+        self.assertTrue(slug_matches(variant, slug))
+        self.assertFalse(slug_matches(slug + '-x', slug))
+
+    def test_product_page_by_slug(self):
+        response = self.client.get(self.url('herrajes', 'pinza-1'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['product'].product_code, 'A2')
+
+    def test_product_under_another_category_moves_to_its_own(self):
+        response = self.client.get(self.url('vidrio', 'pinza'))
+
+        self.assertRedirects(response, self.url('herrajes', 'pinza'), status_code=301)
+
+    def test_old_slug_redirects_after_a_rename(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            import_rows(
+                feed_row('A1', name='Pinza'),
+                feed_row('A2', name='Pinza'),
+                feed_row('B1', name='Vidrio laminado', category='Vidrio > Templado'),
+            )
+
+        self.assertRedirects(
+            self.client.get(self.url('vidrio', 'vidrio-templado')), self.url('vidrio', 'vidrio-laminado'),
+            status_code=301,
+        )
+        # The other products keep their slugs
+        self.assertEqual(self.client.get(self.url('herrajes', 'pinza-1')).context['product'].product_code, 'A2')
+
+    def test_unknown_product_or_category_is_not_found(self):
+        self.assertEqual(self.client.get(self.url('herrajes', 'no-existe')).status_code, 404)
+        self.assertEqual(self.client.get(self.url('no-existe', 'pinza')).status_code, 404)
+
+
+@override_settings(CATALOG_SNAPSHOT_PATH='')
+class CategoryTreeTests(TestCase):
+    """load_catalog builds a nested-set tree with one tree per top-level category."""
+
+    def setUp(self):
+        _reset_catalog_version()
+        self.addCleanup(_reset_catalog_version)
+        with self.captureOnCommitCallbacks(execute=True):
+            import_rows(
+                feed_row('C1', category='Vidrio > Templado > Claro'),
+                feed_row('C2', category='Vidrio > Templado'),
+                feed_row('L1', category='Vidrio > Laminado'),
+                feed_row('H1', category='Herrajes'),
+            )
+
+    def category(self, full_path):
+        return Category.objects.get(full_path=full_path)
+
+    def test_missing_ancestors_are_created_and_bounds_nest(self):
+        tree = {
+            category.full_path: (
+                category.parent and category.parent.full_path,
+                category.depth, category.tree_id, category.lft, category.rgt,
+            )
+            for category in Category.objects.select_related('parent')
+        }
+
+        self.assertEqual(tree, {
+            'Herrajes': (None, 0, 1, 1, 2),
+            'Vidrio': (None, 0, 2, 1, 8),
+            'Vidrio > Laminado': ('Vidrio', 1, 2, 2, 3),
+            'Vidrio > Templado': ('Vidrio', 1, 2, 4, 7),
+            'Vidrio > Templado > Claro': ('Vidrio > Templado', 2, 2, 5, 6),
+        })
+        self.assertEqual(self.category('Vidrio').product_count, 3)
+
+    def test_subtree_holds_the_products_below(self):
+        def codes(full_path):
+            products = Product.objects.filter(self.category(full_path).subtree_q())
+            return sorted(products.values_list('product_code', flat=True))
+
+        self.assertEqual(codes('Vidrio'), ['C1', 'C2', 'L1'])
+        self.assertEqual(codes('Vidrio > Templado'), ['C1', 'C2'])
+        self.assertEqual(codes('Herrajes'), ['H1'])
+
+    def test_subcategory_page(self):
+        templado = self.category('Vidrio > Templado')
+        response = self.client.get(reverse('subcategory_page', args=['vidrio', templado.slug]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([category.name for category in response.context['ancestors']], ['Vidrio'])
+        self.assertEqual([category.name for category in response.context['subcategories']], ['Claro'])
+        self.assertEqual(sorted(product.product_code for product in response.context['products']), ['C1', 'C2'])
+
+    def test_subcategory_page_checks_the_tree(self):
+        templado = self.category('Vidrio > Templado')
+        response = self.client.get(reverse('subcategory_page', args=['herrajes', templado.slug]))
+        self.assertEqual(response.status_code, 404)
+        self.assertRedirects(
+            self.client.get(reverse('subcategory_page', args=['vidrio', self.category('Vidrio').slug])),
+            reverse('category_page', args=['vidrio']),
+        )
+
+
+@override_settings(CATALOG_SNAPSHOT_PATH='', CATALOG_VERSIONS_KEPT=2)
+class CatalogVersionTests(TestCase):
+    """Each import activates a validated catalog version in its own transaction."""
+
+    rows = [feed_row('A1'), feed_row('A2'), feed_row('A3'), feed_row('A4', category='Vidrio')]
+
+    def setUp(self):
+        self.first, _, _ = import_rows(*self.rows)
+
+    def active_codes(self):
+        return sorted(Product.objects.filter(active=True).values_list('product_code', flat=True))
+
+    def test_one_version_is_active(self):
+        importer, _, _ = import_rows(*self.rows[:3])
+
+        self.assertEqual(list(CatalogVersion.objects.filter(is_active=True)), [importer.version])
+        # Categories stay when their products leave the feed
+        self.assertEqual((importer.version.product_count, importer.version.category_count), (3, 3))
+
+    def test_shrinking_import_is_refused_and_rolled_back(self):
+        with self.assertRaises(CatalogValidationError):
+            import_rows(self.rows[0], max_shrink=0.5)
+
+        self.assertEqual(self.active_codes(), ['A1', 'A2', 'A3', 'A4'])
+        self.assertEqual(CatalogVersion.objects.get(is_active=True), self.first.version)
+
+        importer, _, _ = import_rows(self.rows[0], max_shrink=None)
+        self.assertEqual(self.active_codes(), ['A1'])
+        self.assertTrue(CatalogVersion.objects.get(pk=importer.version.pk).is_active)
+
+    def test_only_the_newest_versions_keep_their_records(self):
+        import_rows(*self.rows[:3])
+        import_rows(*self.rows[:2])
+
+        self.assertEqual(list(CatalogVersion.objects.values_list('records', flat=True)[2:]), [None])
+        self.assertIsNone(CatalogVersion.objects.get(pk=self.first.version.pk).records)
+
+    def test_rollback_restores_the_previous_catalog_as_a_new_version(self):
+        import_rows(*self.rows[:2])
+        self.assertEqual(self.active_codes(), ['A1', 'A2'])
+
+        call_command('load_catalog', '--rollback', stdout=io.StringIO())
+
+        self.assertEqual(self.active_codes(), ['A1', 'A2', 'A3', 'A4'])
+        version = CatalogVersion.objects.get(is_active=True)
+        self.assertEqual(version.source, f'rollback to v{self.first.version.pk}')
+
+
+class ProductImageImportTests(TestCase):
+    """The import writes one ProductImage per feed image, only when the image list changed."""
+
+    url1 = 'https://proveedor.example/a1-1.png'
+    url2 = 'https://proveedor.example/a1-2.png'
+    url3 = 'https://proveedor.example/a1-3.png'
+
+    def images(self, product_code='A1'):
+        return list(
+            ProductImage.objects.filter(product__product_code=product_code).values_list('position', 'url', 'blob_id')
+        )
+
+    def test_images_are_written_in_feed_order(self):
+        _, _, stats = import_rows(
+            feed_row('A1', **{'images 1': self.url1, 'images 3': self.url3}), feed_row('A2'),
+        )
+
+        self.assertEqual(self.images(), [(0, self.url1, None), (1, self.url3, None)])
+        self.assertEqual(self.images('A2'), [])
+        self.assertEqual(stats['images_written'], 2)
+        self.assertEqual(Product.objects.get(product_code='A1').get_image_url(), self.url1)
+
+    def test_unchanged_image_list_is_not_rewritten(self):
+        import_rows(feed_row('A1', **{'images 1': self.url1, 'images 2': self.url2}))
+        ids = list(ProductImage.objects.values_list('id', flat=True))
+
+        _, _, stats = import_rows(feed_row('A1', price='11,00', **{'images 1': self.url1, 'images 2': self.url2}))
+
+        self.assertEqual(stats['products_updated'], 1)
+        self.assertEqual(stats['images_written'], 0)
+        self.assertEqual(list(ProductImage.objects.values_list('id', flat=True)), ids)
+
+    def test_downloaded_copies_are_kept_for_urls_still_in_use(self):
+        import_rows(feed_row('A1', **{'images 1': self.url1, 'images 2': self.url2}))
+        blob = ImageBlob.objects.create(sha256='a' * 64, file=f'{BLOB_DIR}/aa/{"a" * 64}.png')
+        ProductImage.objects.filter(url=self.url2).update(blob=blob)
+
+        _, _, stats = import_rows(feed_row('A1', **{'images 1': self.url2, 'images 2': self.url3}))
+
+        self.assertEqual(self.images(), [(0, self.url2, blob.pk), (1, self.url3, None)])
+        self.assertEqual(stats['images_written'], 2)
+
+    def test_listing_loads_images_in_one_query(self):
+        import_rows(*[feed_row(f'A{i}', **{'images 1': self.url1, 'images 2': self.url2}) for i in range(5)])
+        products = list(Product.objects.all())
+
+        with self.assertNumQueries(1):
+            prefetch_product_images(products)
+            images = [product.get_images() for product in products]
+
+        self.assertEqual(images, [[self.url1, self.url2]] * 5)
+
+class CatalogDeltaTests(TestCase):
+    """Only rows whose content hash changed are written."""
+
+    def setUp(self):
+        self.rows = [feed_row('A1'), feed_row('A2'), feed_row('A3', category='Herrajes')]
+        importer, _, _ = import_rows(*self.rows)
+        self.version = importer.version
+
+    def test_unchanged_feed_writes_nothing(self):
+        with CaptureQueriesContext(connection) as queries:
+            importer, plan, stats = import_rows(*self.rows)
+
+        self.assertFalse([query['sql'] for query in queries if query['sql'].startswith(('INSERT', 'UPDATE'))])
+
+        self.assertFalse(plan.has_changes)
+        self.assertEqual(stats['products_unchanged'], 3)
+        self.assertIsNone(importer.version)
+        self.assertEqual(CatalogVersion.objects.get(is_active=True), self.version)
+
+    def test_only_changed_rows_are_updated(self):
+        self.rows[1]['price'] = '11,00'
+
+        importer, plan, stats = import_rows(*self.rows)
+
+        self.assertEqual([product.product_code for product in plan.products_to_update], ['A2'])
+        self.assertEqual((stats['products_updated'], stats['products_unchanged']), (1, 2))
+        self.assertEqual(Product.objects.get(product_code='A2').price, Decimal('11.00'))
+        self.assertNotEqual(importer.version, self.version)
+
+    def test_missing_product_is_deactivated_and_comes_back(self):
+        _, plan, stats = import_rows(self.rows[0], self.rows[2])
+
+        self.assertEqual(plan.products_to_deactivate, [(Product.objects.get(product_code='A2').pk, 'A2')])
+        self.assertEqual(stats['products_removed'], 1)
+        product = Product.objects.get(product_code='A2')
+        self.assertFalse(product.active)
+        self.assertEqual(product.content_hash, '')
+
+        _, plan, stats = import_rows(*self.rows)
+
+        self.assertEqual([product.product_code for product in plan.products_to_update], ['A2'])
+        self.assertTrue(Product.objects.get(product_code='A2').active)
+
+    def test_dry_run_plans_without_writing(self):
+        self.rows[0]['name'] = 'Renombrado'
+
+        importer, plan, _ = import_rows(*self.rows, feed_row('A4'), dry_run=True)
+
+        self.assertEqual([product.product_code for product in plan.products_to_create], ['A4'])
+        self.assertEqual([product.product_code for product in plan.products_to_update], ['A1'])
+        self.assertFalse(Product.objects.filter(product_code='A4').exists())
+        self.assertEqual(Product.objects.get(product_code='A1').name, 'Producto A1')
+        self.assertIsNone(importer.version)
+
+    def test_renamed_product_gets_new_slug_and_redirect(self):
+        old_slug = Product.objects.get(product_code='A1').slug
+        self.rows[0]['name'] = 'Pinza nueva'
+
+        import_rows(*self.rows)
+
+        product = Product.objects.get(product_code='A1')
+        self.assertEqual(product.slug, 'pinza-nueva')
+        self.assertTrue(product.redirects.filter(old_slug=old_slug).exists())
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'COPY imports need PostgreSQL')
+class CopyImportParityTests(TestCase):
+    """The COPY importer leaves the same catalog tables as the ORM importer."""
+
+    feeds = [
+        [
+            feed_row('A1', description='Acero "inox", 2 mm\nLínea 2\\fin', weight='1,25'),
+            feed_row('A2', name='Pinza, doble', category='Herrajes > Pinzas > Dobles'),
+            feed_row('A3', category='Vidrio', stock='0', active='0'),
+            feed_row('A4', name='Producto A1'),
+        ],
+        [
+            feed_row('A1', name='Pinza renombrada', weight=''),
+            feed_row('A3', category='Vidrio > Templado', price='7,00'),
+            feed_row('A5', category='Vidrio'),
+        ],
+    ]
+
+    def catalog_tables(self):
+        """The four catalog tables with foreign keys and ids replaced by natural keys."""
+        def rows(queryset, exclude, *related):
+            fields = [field.attname for field in queryset.model._meta.concrete_fields if field.attname not in exclude]
+            return sorted(queryset.values_list(*fields, *related))
+
+        return {
+            'categories': rows(Category.objects.all(), {'id', 'parent_id'}, 'parent__full_path'),
+            'products': rows(Product.objects.all(), {'id', 'category_id'}, 'category__full_path'),
+            'redirects': rows(ProductRedirect.objects.all(), {'id', 'product_id'}, 'product__product_code'),
+            'top_level': rows(TopLevelCategory.objects.all(), {'id'}),
+        }
+
+    def import_feeds(self, importer_class):
+        with transaction.atomic():
+            for feed in self.feeds:
+                import_rows(*feed, importer_class=importer_class)
+            tables = self.catalog_tables()
+            transaction.set_rollback(True)
+        return tables
+
+    def test_copy_and_orm_imports_match(self):
+        orm_tables = self.import_feeds(CatalogImporter)
+        copy_tables = self.import_feeds(CopyCatalogImporter)
+
+        self.assertTrue(orm_tables['redirects'])
+        for table, rows in orm_tables.items():
+            self.assertEqual(copy_tables[table], rows, table)
+
+
+class PaginationParityTests(TestCase):
+    """The catalog snapshot pages through a category exactly like the ORM."""
+
+    @classmethod
+    def setUpTestData(cls):
+        rows = []
+        for number in range(23):
+            rows.append(feed_row(
+                f'P{number:03}',
+                category=['Herrajes > Pinzas', 'Herrajes > Pinzas > Planas', 'Herrajes > Bisagras', 'Vidrio'][number % 4],
+                # Repeated names, prices and stocks, so ties are broken by id
+                name=f'Producto {number % 5}',
+                price=f'{number % 3 * 10},50',
+                stock=str(number % 4),
+                active='0' if number % 7 == 0 else '1',
+            ))
+        import_rows(*rows)
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = f'{directory}/catalog.snapshot'
+        export_snapshot(path)
+        self.snapshot = CatalogSnapshot(path)
+
+    def pages(self, paginate, direction='after', cursor=None):
+        """Product ids of every page reached by following cursors from the first (or given) page."""
+        pages = []
+        while True:
+            page = paginate(**{direction: cursor})
+            pages.append(([product.pk for product in page['products']], page['next_cursor'], page['prev_cursor']))
+            cursor = page['next_cursor' if direction == 'after' else 'prev_cursor']
+            if cursor is None:
+                return pages
+
+    def assert_same_pages(self, category, sort):
+        def orm(**cursors):
+            products = Product.objects.filter(category.subtree_q())
+            return paginate_products(products, sort=sort, per_page=4, **cursors)
+
+        def snapshot(**cursors):
+            return self.snapshot.paginate_products(category, sort=sort, per_page=4, **cursors)
+
+        forward = self.pages(orm)
+        self.assertEqual(self.pages(snapshot), forward)
+        self.assertEqual(
+            sorted(pk for pks, _, _ in forward for pk in pks),
+            sorted(Product.objects.filter(category.subtree_q()).values_list('pk', flat=True)),
+        )
+        # And back again from the last page
+        last_cursor = forward[-2][1] if len(forward) > 1 else None
+        if last_cursor:
+            self.assertEqual(
+                self.pages(snapshot, 'before', self.pages(snapshot, 'after', last_cursor)[0][2]),
+                self.pages(orm, 'before', self.pages(orm, 'after', last_cursor)[0][2]),
+            )
+
+    def test_every_category_and_sort(self):
+        categories = list(Category.objects.all())
+        self.assertGreater(len(categories), 3)
+        for category in categories:
+            for sort in SORT_OPTIONS:
+                with self.subTest(category=category.full_path, sort=sort):
+                    self.assert_same_pages(category, sort)
+
+    def test_name_order_is_python_order(self):
+        # Case and accents, which database collations may sort differently from Python
+        names = ['árbol', 'Zeta', 'abeto', 'Ñandú', 'beta']
+        import_rows(*(feed_row(f'N{number}', category='Nombres', name=name) for number, name in enumerate(names)))
+        path = f'{tempfile.mkdtemp()}/catalog.snapshot'
+        self.addCleanup(shutil.rmtree, os.path.dirname(path), ignore_errors=True)
+        export_snapshot(path)
+        snapshot = CatalogSnapshot(path)
+        category = Category.objects.get(full_path='Nombres')
+
+        listed = []
+        cursor = None
+        while True:
+            page = snapshot.paginate_products(category, sort='name', per_page=2, after=cursor)
+            listed += [product.name for product in page['products']]
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(listed, sorted(names))
+
+        # A cursor whose product is gone is found by binary search over the same order
+        gone = Product(pk=10 ** 6, name='abf')
+        page = snapshot.paginate_products(category, sort='name', per_page=2, after=encode_cursor(gone, 'name'))
+        self.assertEqual([product.name for product in page['products']], ['beta', 'Ñandú'])
+
+    def test_malformed_cursor_starts_over(self):
+        category = Category.objects.get(full_path='Herrajes')
+        orm = paginate_products(Product.objects.filter(category.subtree_q()), per_page=4, after='no-es-un-cursor')
+        snapshot = self.snapshot.paginate_products(category, per_page=4, after='no-es-un-cursor')
+
+        self.assertEqual([p.pk for p in snapshot['products']], [p.pk for p in orm['products']])
+        self.assertIsNone(orm['prev_cursor'])
+
+
+class HealthCheckTests(TestCase):
+    """/healthz answers from the process alone; /readyz waits for the database, migrations and a catalog."""
+
+    def test_liveness_touches_nothing_and_skips_host_validation(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/healthz', HTTP_HOST='10.0.0.7:8000')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'alive'})
+        self.assertIn('no-cache', response['Cache-Control'])
+
+    def test_readiness_waits_for_an_active_catalog(self):
+        response = self.client.get('/readyz', HTTP_HOST='10.0.0.7:8000')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'starting')
+        self.assertEqual(response.json()['checks'], {'database': True, 'migrations': True, 'catalog': None})
+
+        importer, _, _ = import_rows(feed_row('A1'), feed_row('A2'))
+        response = self.client.get('/readyz', HTTP_HOST='10.0.0.7:8000')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['checks']['catalog'], {'version': importer.version.pk, 'products': 2})
+
+    def test_readiness_fails_when_the_database_is_unreachable(self):
+        with mock.patch('pages.health.check_database', side_effect=DatabaseError('connection refused')), \
+                self.assertLogs('pages.health', 'WARNING'):
+            ready, checks = readiness()
+
+        self.assertFalse(ready)
+        self.assertEqual(checks, {'database': False, 'migrations': False, 'catalog': None})
+
+    def test_check_migrations(self):
+        self.assertTrue(check_migrations())
+
+    def test_wait_for_retries_until_ready(self):
+        results = iter([DatabaseError('starting'), None, 0, 'ok'])
+
+        def check():
+            result = next(results)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        messages = []
+        self.assertEqual(wait_for(check, 5, 'database', messages.append), 'ok')
+        self.assertEqual(messages[0], 'Waiting for database...')
+
+    def test_wait_for_gives_up_after_the_timeout(self):
+        started = time.monotonic()
+
+        self.assertIsNone(wait_for(lambda: None, 0.2, 'database', lambda message: None))
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_migration_activates_a_catalog_loaded_before_versions(self):
+        from django.apps import apps
+
+        activate_loaded_catalog = import_module('pages.migrations.0023_activate_loaded_catalog').activate_loaded_catalog
+        activate_loaded_catalog(apps, None)
+        self.assertFalse(CatalogVersion.objects.exists())
+
+        import_rows(feed_row('A1'), feed_row('A2', active='0'))
+        CatalogVersion.objects.all().delete()
+        activate_loaded_catalog(apps, None)
+
+        version = CatalogVersion.objects.get(is_active=True)
+        self.assertEqual((version.product_count, version.category_count), (1, 2))
+        activate_loaded_catalog(apps, None)
+        self.assertEqual(CatalogVersion.objects.count(), 1)
+
+
+class CartTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        import_rows(
+            feed_row('A1', stock='5'), feed_row('A2', stock='20'), feed_row('A3', active='0'),
+            feed_row('H1', stock='50000'),
+        )
+
+    def add(self, product_code, quantity):
+        return self.client.post(reverse('add_to_cart'), {'product_code': product_code, 'quantity': quantity})
+
+    def quantities(self):
+        return dict(CartItem.objects.values_list('product_id', 'quantity'))
+
+    def cookie_count(self, response):
+        """The item count in the response's signed cookie, or None if it sets none."""
+        if CART_COUNT_COOKIE not in response.cookies:
+            return None
+        request = RequestFactory().get('/')
+        request.COOKIES[CART_COUNT_COOKIE] = response.cookies[CART_COUNT_COOKIE].value
+        return int(request.get_signed_cookie(CART_COUNT_COOKIE, salt=CART_COUNT_SALT))
+
+
+class CartTests(CartTestCase):
+    def test_browsing_creates_no_session_or_cart(self):
+        response = self.client.get(reverse('cart_page'))
+
+        self.assertEqual(response.context['cart_count'], 0)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_add_creates_one_line_and_sets_count_cookie(self):
+        self.add('A1', 2)
+        response = self.add('A1', 1)
+
+        self.assertEqual(response.json()['cart_count'], 3)
+        self.assertEqual(self.quantities(), {'A1': 3})
+        self.assertEqual(self.cookie_count(response), 3)
+
+    def test_add_rejects_quantities_below_one(self):
+        for quantity in (0, -1, 'dos'):
+            with self.subTest(quantity=quantity):
+                response = self.add('A1', quantity)
+
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(response.json()['success'])
+        self.assertFalse(CartItem.objects.exists())
+        self.assertFalse(Cart.objects.exists())
+
+    def test_add_unknown_product(self):
+        self.assertEqual(self.add('NOPE', 1).status_code, 404)
+
+    def test_repeated_adds_stop_at_the_maximum(self):
+        self.add('A1', MAX_ITEM_QUANTITY)
+        self.assertEqual(self.add('A1', MAX_ITEM_QUANTITY + 1).status_code, 400)
+        self.add('A1', 5)
+
+        self.assertEqual(self.quantities(), {'A1': MAX_ITEM_QUANTITY})
+
+    def test_update_and_remove_from_the_cart_page(self):
+        self.add('A1', 2)
+        self.add('A2', 1)
+
+        self.client.post(reverse('update_cart_item', args=['A1']), {'quantity': 4})
+        self.client.post(reverse('update_cart_item', args=['A2']), {'quantity': 0})
+
+        self.assertEqual(self.quantities(), {'A1': 4})
+        self.client.post(reverse('remove_cart_item', args=['A1']))
+        self.assertEqual(self.quantities(), {})
+
+    def test_update_with_non_numeric_quantity_keeps_the_line(self):
+        self.add('A1', 2)
+
+        response = self.client.post(reverse('update_cart_item', args=['A1']), {'quantity': 'dos'}, follow=True)
+
+        self.assertRedirects(response, reverse('cart_page'))
+        self.assertContains(response, 'Cantidad inválida')
+        self.assertEqual(self.quantities(), {'A1': 2})
+
+    def test_lines_survive_a_catalog_reload(self):
+        self.add('A1', 2)
+
+        import_rows(feed_row('B1'), clear=True)
+        response = self.client.get(reverse('cart_page'))
+
+        self.assertEqual(response.context['cart_count'], 0)
+        self.assertEqual(self.cookie_count(response), 0)
+        self.assertEqual(self.quantities(), {'A1': 2})
+
+        import_rows(feed_row('A1'), feed_row('B1'), clear=True)
+        response = self.client.get(reverse('cart_page'))
+
+        self.assertEqual(response.context['cart_count'], 2)
+        self.assertEqual(self.cookie_count(response), 2)
+
+
+class LazySessionTests(CartTestCase):
+    """Sessions are created by the first cart change; the header count comes from a signed cookie."""
+
+    def signed_count(self, count):
+        return get_cookie_signer(salt=CART_COUNT_COOKIE + CART_COUNT_SALT).sign(str(count))
+
+    def count_request(self, **cookies):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        request.session = SessionStore(cookies.get(settings.SESSION_COOKIE_NAME))
+        request.COOKIES.update(cookies)
+        return request
+
+    def test_first_cart_change_creates_the_session(self):
+        self.client.get(reverse('landing_page'))
+        self.assertFalse(Session.objects.exists())
+
+        self.add('A1', 1)
+        self.add('A2', 1)
+
+        session = Session.objects.get()
+        self.assertEqual(Cart.objects.get().session_key, session.session_key)
+        self.assertEqual(self.client.cookies[settings.SESSION_COOKIE_NAME].value, session.session_key)
+
+    def test_count_is_read_from_the_cookie_without_queries(self):
+        request = self.count_request(
+            **{settings.SESSION_COOKIE_NAME: 'x' * 32, CART_COUNT_COOKIE: self.signed_count(7)},
+        )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_count(request), 7)
+
+    def test_count_cookie_without_a_session_counts_nothing(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_count(self.count_request(**{CART_COUNT_COOKIE: self.signed_count(7)})), 0)
+
+    def test_forged_count_cookie_falls_back_to_the_cart(self):
+        self.add('A1', 2)
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+
+        for forged in ('99', self.signed_count(99)[:-1] + 'x', 'no-es-un-numero'):
+            with self.subTest(cookie=forged):
+                request = self.count_request(**{settings.SESSION_COOKIE_NAME: session_key, CART_COUNT_COOKIE: forged})
+
+                self.assertEqual(get_cart_count(request), 2)
+
+    def test_clear_empty_sessions(self):
+        def session(data, expired=False):
+            store = SessionStore()
+            store.update(data)
+            store.create()
+            if expired:
+                Session.objects.filter(session_key=store.session_key).update(
+                    expire_date=timezone.now() - timedelta(days=1),
+                )
+            return store.session_key
+
+        session({'cart': {}})
+        contact = session({'checkout_contact': {'email': 'ana@example.com'}})
+        session({'cart': {'A1': {'quantity': 1}}}, expired=True)
+        with_cart = session({})
+        Cart.objects.create(session_key=with_cart)
+        Cart.objects.create(session_key='y' * 32)
+
+        call_command('clear_empty_sessions', stdout=io.StringIO())
+
+        self.assertEqual(set(Session.objects.values_list('session_key', flat=True)), {contact, with_cart})
+        self.assertEqual(list(Cart.objects.values_list('session_key', flat=True)), [with_cart])
+
+
+class QuickOrderTests(CartTestCase):
+    def order(self, lines):
+        return self.client.post(reverse('quick_order_api'), json.dumps({'lines': lines}), content_type='application/json')
+
+    def test_valid_lines_are_added_and_others_reported(self):
+        response = self.order('código;cantidad\nA1;2\nA2;3\nA1;1\nNOPE;1\nA3;1\nA2;0\nA2')
+
+        result = response.json()
+        # A1 on two lines is one cart line
+        self.assertEqual((result['added'], result['quantity']), (2, 6))
+        self.assertEqual(
+            [(error['line'], error['code']) for error in result['errors']],
+            [(5, 'NOPE'), (6, 'A3'), (7, 'A2'), (8, 'A2')],
+        )
+        self.assertEqual(self.quantities(), {'A1': 3, 'A2': 3})
+
+    def test_stock_counts_the_quantity_already_in_the_cart(self):
+        self.add('A1', 4)
+
+        result = self.order('A1;2').json()
+
+        self.assertEqual(result['added'], 0)
+        self.assertIn('ya en el carrito: 4', result['errors'][0]['error'])
+        self.assertEqual(self.quantities(), {'A1': 4})
+        self.assertEqual(self.order('A1;1').json()['added'], 1)
+
+    def test_quantity_above_the_maximum_is_a_line_error(self):
+        for lines in (f'H1;{MAX_ITEM_QUANTITY + 1}', 'H1;6000\nH1;6000'):
+            with self.subTest(lines=lines):
+                response = self.order(lines)
+
+                self.assertEqual(response.status_code, 200)
+                result = response.json()
+                self.assertEqual(result['added'], 0)
+                self.assertTrue(all('Cantidad excesiva' in error['error'] for error in result['errors']))
+        self.assertEqual(self.quantities(), {})
+
+    def test_maximum_counts_the_quantity_already_in_the_cart(self):
+        self.add('H1', 9000)
+
+        result = self.order('H1;5000').json()
+
+        self.assertEqual(
+            result['errors'][0]['error'], 'Cantidad excesiva (máximo por producto: 10000, ya en el carrito: 9000)',
+        )
+        self.assertEqual(self.quantities(), {'H1': 9000})
+
+    def test_quick_order_page_reports_excess_quantity(self):
+        response = self.client.post(reverse('quick_order_page'), {'lines': 'H1;20000'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Cantidad excesiva')
+
+    def test_merge_into_existing_line_stops_at_the_maximum(self):
+        self.add('H1', 9000)
+        request = RequestFactory().post('/')
+        request.user = AnonymousUser()
+        request.session = SessionStore(self.client.cookies[settings.SESSION_COOKIE_NAME].value)
+
+        add_items(request, {Product.objects.get(product_code='H1'): 5000})
+
+        self.assertEqual(self.quantities(), {'H1': MAX_ITEM_QUANTITY})
+
+
+class CartContextTests(CartTestCase):
+    """Cart lines are priced with one query, memoized on the request until the cart changes."""
+
+    def cart_request(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        request.session = SessionStore(self.client.cookies[settings.SESSION_COOKIE_NAME].value)
+        request.COOKIES = {name: cookie.value for name, cookie in self.client.cookies.items()}
+        return request
+
+    def test_lines_are_priced_with_one_query_and_memoized(self):
+        self.add('A1', 2)
+        self.add('A2', 3)
+        request = self.cart_request()
+
+        with self.assertNumQueries(2):  # The cart, then its lines with their products
+            context = get_cart_context(request)
+
+        self.assertEqual(
+            [(item['product'].product_code, item['quantity'], item['item_total']) for item in context['cart_items']],
+            [('A1', 2, Decimal('21.00')), ('A2', 3, Decimal('31.50'))],
+        )
+        self.assertEqual((context['grand_total'], context['cart_count']), (Decimal('52.50'), 5))
+        with self.assertNumQueries(0):
+            self.assertIs(get_cart_context(request), context)
+            self.assertEqual(count_items(request), 5)
+        self.assertFalse(getattr(request, 'cart_changed', False))
+
+        add_item(request, Product.objects.get(product_code='A1'), 1)
+
+        self.assertEqual(get_cart_context(request)['cart_count'], 6)
+
+    def test_page_queries_do_not_grow_with_the_cart(self):
+        import_rows(*[feed_row(f'B{i}') for i in range(20)])
+        self.add('A1', 1)
+
+        def checkout_queries():
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(reverse('checkout_page')).status_code, 200)
+            return len(queries)
+
+        checkout_queries()  # Fills the menu cache
+        few = checkout_queries()
+        for i in range(20):
+            self.add(f'B{i}', 1)
+
+        self.assertEqual(checkout_queries(), few)
+
+    def test_stale_count_cookie_is_corrected(self):
+        self.add('A1', 2)
+        Product.objects.filter(product_code='A1').delete()
+
+        response = self.client.get(reverse('checkout_page'))
+
+        self.assertRedirects(response, reverse('cart_page'))
+        self.assertEqual(self.cookie_count(response), 0)
+
+
+class CartApiTests(CartTestCase):
+    def setUp(self):
+        self.add('A1', 2)
+        self.add('A2', 3)
+
+    def apply(self, *ops):
+        return self.client.post(reverse('cart_api'), json.dumps({'ops': list(ops)}), content_type='application/json')
+
+    def test_operations_are_applied_together(self):
+        response = self.apply(
+            {'op': 'set', 'code': 'A1', 'quantity': 5},
+            {'op': 'remove', 'code': 'A2'},
+        )
+
+        result = response.json()
+        self.assertTrue(result['success'])
+        self.assertEqual([(item['code'], item['quantity']) for item in result['items']], [('A1', 5)])
+        self.assertEqual(result['cart_count'], 5)
+        self.assertEqual(self.cookie_count(response), 5)
+        self.assertEqual(self.quantities(), {'A1': 5})
+
+    def test_set_zero_removes_and_later_operation_wins(self):
+        self.apply({'op': 'set', 'code': 'A1', 'quantity': 7}, {'op': 'set', 'code': 'A1', 'quantity': 0})
+
+        self.assertEqual(self.quantities(), {'A2': 3})
+
+    def test_invalid_operation_applies_none(self):
+        invalid = [
+            ({'op': 'set', 'code': 'A2', 'quantity': -1}, 'Cantidad inválida'),
+            ({'op': 'set', 'code': 'A2', 'quantity': MAX_ITEM_QUANTITY + 1}, 'Cantidad inválida'),
+            ({'op': 'set', 'code': 'A2', 'quantity': 10 ** 12}, 'Cantidad inválida'),
+            ({'op': 'set', 'code': 'A2', 'quantity': True}, 'Cantidad inválida'),
+            ({'op': 'set', 'code': 'A3', 'quantity': 1}, 'El producto no está en el carrito'),
+            ({'op': 'add', 'code': 'A2'}, 'Operación desconocida, use set o remove'),
+        ]
+        for operation, error in invalid:
+            with self.subTest(operation=operation):
+                response = self.apply({'op': 'set', 'code': 'A1', 'quantity': 9}, operation)
+
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()['errors'], [{'index': 1, 'code': operation['code'], 'error': error}])
+                self.assertEqual(self.quantities(), {'A1': 2, 'A2': 3})
+
+    def test_malformed_requests(self):
+        response = self.client.post(reverse('cart_api'), 'no es json', content_type='application/json')
+        self.assertEqual(response.json()['error'], 'JSON inválido')
+        response = self.client.post(reverse('cart_api'), json.dumps({'ops': 'set'}), content_type='application/json')
+        self.assertEqual(response.json()['errors'][0]['error'], 'ops debe ser una lista')
+        self.assertEqual(self.client.put(reverse('cart_api')).status_code, 405)
+
+    def test_get_returns_the_cart(self):
+        result = self.client.get(reverse('cart_api')).json()
+
+        self.assertEqual(result['grand_total'], '52.50')
+        self.assertEqual(result['cart_count'], 5)
+
+
+class TouchCatalogTests(TestCase):
+    """Edits outside an import bump the catalog version once per transaction."""
+
+    @classmethod
+    def setUpTestData(cls):
+        import_rows(feed_row('A1'), feed_row('A2'))
+
+    def test_edits_in_one_transaction_touch_once(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            for product in Product.objects.all():
+                product.save()
+            Category.objects.first().save()
+
+        self.assertEqual(len(callbacks), 1)
+        version = CatalogVersion.objects.get(is_active=True)
+        self.assertIsNotNone(version.edited_at)
+        self.assertEqual(get_catalog_version(), (version.pk, None, version.edited_at))
+
+    def test_rolled_back_edit_does_not_block_the_next_one(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(ValueError), transaction.atomic():
+                Product.objects.first().save()
+                raise ValueError
+            Product.objects.first().save()
+
+        self.assertEqual(len(callbacks), 1)
+
+
+# run_job closes the connection after the command, so these run outside a test transaction
+class JobQueueTests(TransactionTestCase):
+    """Claiming, retrying and taking over background jobs."""
+
+    def lapsed_job(self, worker, attempts=1):
+        past = timezone.now() - timedelta(seconds=1)
+        return Job.objects.create(
+            command='gc_images', status=Job.RUNNING, locked_by=worker, locked_until=past, attempts=attempts,
+        )
+
+    def test_a_job_is_claimed_by_one_worker(self):
+        job = enqueue('gc_images')
+
+        self.assertEqual(claim_job('host-a:1').pk, job.pk)
+        self.assertIsNone(claim_job('host-b:2'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by, job.attempts), (Job.RUNNING, 'host-a:1', 1))
+
+    def test_workers_claim_different_jobs(self):
+        first, second = enqueue('gc_images'), enqueue('collectstatic', '--noinput')
+
+        claimed = {claim_job('host-a:1').pk, claim_job('host-b:2').pk}
+        self.assertEqual(claimed, {first.pk, second.pk})
+
+    @override_settings(JOB_LEASE_SECONDS=42)
+    def test_lease_length_comes_from_settings(self):
+        enqueue('gc_images')
+        job = claim_job('host-a:1')
+        self.assertEqual(job.locked_until - job.heartbeat_at, timedelta(seconds=42))
+
+    def test_failed_job_is_retried_with_backoff_then_failed(self):
+        job = enqueue('load_catalog', '--rollback', max_attempts=2)
+
+        job = run_job(claim_job('host-a:1'), 'host-a:1')
+        self.assertEqual((job.status, job.attempts, job.locked_by), (Job.QUEUED, 1, ''))
+        self.assertIn('CommandError', job.error)
+        self.assertAlmostEqual(
+            (job.run_after - job.heartbeat_at).total_seconds(), RETRY_BACKOFF_SECONDS, delta=1,
+        )
+        # Not due again before the backoff
+        self.assertIsNone(claim_job('host-a:1'))
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        job = run_job(claim_job('host-a:1'), 'host-a:1')
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_expired_lease_of_a_dead_worker_is_taken_over(self):
+        job = self.lapsed_job('elsewhere:1')
+
+        claimed = claim_job('host-a:1')
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual((claimed.locked_by, claimed.attempts), ('host-a:1', 2))
+        self.assertGreater(claimed.locked_until, timezone.now())
+
+    def test_expired_lease_of_a_live_worker_is_kept(self):
+        # e.g. a heartbeat blocked by the command's own SQLite write transaction
+        job = self.lapsed_job(worker_name(), attempts=3)
+
+        self.assertIsNone(claim_job('host-a:1'))
+        self.assertEqual(fail_exhausted_jobs(), 0)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by), (Job.RUNNING, worker_name()))
+
+    def test_dead_worker_on_last_attempt_fails_the_job(self):
+        job = self.lapsed_job('elsewhere:1', attempts=3)
+
+        self.assertEqual(fail_exhausted_jobs(), 1)
+        self.assertIsNone(claim_job('host-a:1'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
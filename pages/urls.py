@@ -5,10 +5,18 @@ urlpatterns = [
     path('', views.landing_page, name='landing_page'),
     path('categoria/<slug:category_slug>/', views.category_page, name='category_page'),
     path('categoria/<slug:category_slug>/<slug:product_slug>/', views.product_page, name='product_page'),
+    path('categoria/<slug:category_slug>/sub/<slug:subcategory_slug>/', views.subcategory_page, name='subcategory_page'),
+    path('img/<str:name>', views.image_blob, name='image_blob'),
+    path('img/<int:width>/<str:name>', views.image_proxy, name='image_proxy'),
+    path('healthz', views.liveness, name='liveness'),
+    path('readyz', views.readiness_check, name='readiness'),
     path('carrito/', views.cart_page, name='cart_page'),
+    path('carrito/api/', views.cart_api, name='cart_api'),
     path('carrito/agregar/', views.add_to_cart, name='add_to_cart'),
     path('carrito/actualizar/<str:product_code>/', views.update_cart_item, name='update_cart_item'),
     path('carrito/eliminar/<str:product_code>/', views.remove_cart_item, name='remove_cart_item'),
+    path('pedido-rapido/', views.quick_order_page, name='quick_order_page'),
+    path('pedido-rapido/api/', views.quick_order_api, name='quick_order_api'),
     path('checkout/', views.checkout_page, name='checkout_page'),
     path('resumen-pedido/', views.order_summary_page, name='order_summary_page'),
     path('pedido-exitoso/', views.order_success_page, name='order_success_page'),
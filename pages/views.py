@@ -1,172 +1,168 @@
-from django.shortcuts import render, get_object_or_404, redirect
-from django.utils.text import slugify
-from django.db.models import Q, Count
-from django.http import JsonResponse
-from decimal import Decimal
-from .models import Product, Category
+from django.shortcuts import render, redirect
+from django.contrib import messages
+from django.core.files.storage import default_storage
+from django.views.decorators.cache import never_cache
+from django.http import FileResponse, Http404, HttpResponseNotModified, JsonResponse
+import json
+import mimetypes
+import re
+from .models import BLOB_DIR, DERIVATIVE_EXTENSIONS, Product, ProductRedirect, prefetch_product_images
+from .cart import (
+    MAX_ITEM_QUANTITY, add_item, apply_operations, clear_cart, count_items, get_cart_context, get_cart_count,
+    remove_item, set_item_quantity,
+)
+from .catalog import (
+    category_ancestors, get_category_tree, get_menu_categories, resolve_category_slug, top_level_category,
+    top_level_name, top_level_slug,
+)
+from .catalog_snapshot import get_snapshot
+from .health import readiness, seconds_since_startup
+from .image_derivatives import DERIVATIVE_WIDTHS
+from .image_proxy import CONTENT_TYPES, ProxyError, open_resized, source_url
+from .pagination import DEFAULT_PAGE_SIZE, DEFAULT_SORT, PAGE_SIZES, SORT_OPTIONS, paginate_products
+from .quick_order import MAX_LINES, add_lines_to_cart, parse_items, parse_lines, parse_quantity, read_upload
 
 
-def get_cart(request):
-    """Get cart from session or initialize empty cart."""
-    if 'cart' not in request.session:
-        request.session['cart'] = {}
-    return request.session['cart']
-
-
-def get_cart_count(request):
-    """Get total number of items in cart."""
-    cart = get_cart(request)
-    return sum(item['quantity'] for item in cart.values())
-
-
-def get_cart_context(request):
-    """Get cart items with product details."""
-    cart = get_cart(request)
-    cart_items = []
-    grand_total = Decimal('0.00')
-    
-    for product_code, item_data in cart.items():
-        try:
-            product = Product.objects.get(product_code=product_code)
-            quantity = item_data['quantity']
-            unit_price = product.price
-            item_total = unit_price * Decimal(str(quantity))
-            grand_total += item_total
-            
-            cart_items.append({
-                'product': product,
-                'quantity': quantity,
-                'unit_price': unit_price,
-                'item_total': item_total,
-            })
-        except Product.DoesNotExist:
-            # Product was deleted, skip it
-            continue
-    
-    return {
-        'cart_items': cart_items,
-        'grand_total': grand_total,
+def landing_page(request):
+    """Landing page view."""
+    # Top-level categories with their product counts and images come from the
+    # aggregates precomputed by load_catalog (cached per catalog version)
+    context = {
+        'categories': get_menu_categories(),
         'cart_count': get_cart_count(request),
     }
+    return render(request, 'pages/landing.html', context)
 
 
-def landing_page(request):
-    """Landing page view."""
-    # Get products grouped by category
-    # Categories are stored as full_path in the Category model
-    # Get all products with their categories and group by top-level category
-    
-    # Get all products that have categories
-    products = Product.objects.filter(category__isnull=False).select_related('category')
-    
-    # Group by top-level category name
-    top_level_categories = {}
-    
-    for product in products:
-        if not product.category:
-            continue
-            
-        # Extract top-level category name (first part before " > ")
-        full_path = product.category.full_path
-        top_level = full_path.split(' > ')[0].strip()
-        
-        if top_level not in top_level_categories:
-            # Find first product in this category with an image
-            product_with_image = Product.objects.filter(
-                category__full_path__startswith=top_level
-            ).exclude(
-                Q(image_url__isnull=True) | Q(image_url='')
-            ).first()
-            
-            # Get product count for this top-level category
-            product_count = Product.objects.filter(
-                category__full_path__startswith=top_level
-            ).count()
-            
-            top_level_categories[top_level] = {
-                'name': top_level,
-                'slug': slugify(top_level),
-                'count': product_count,
-                'image_url': product_with_image.image_url if product_with_image else ''
-            }
+def render_category_listing(request, category_slug, category, ancestors=()):
+    """Render one page of the products in a category's subtree."""
+    # Sorting and page size come from the query string; pages are keyset cursors
+    sort = request.GET.get('sort', DEFAULT_SORT)
+    if sort not in SORT_OPTIONS:
+        sort = DEFAULT_SORT
+    try:
+        per_page = int(request.GET.get('per_page', DEFAULT_PAGE_SIZE))
+    except (ValueError, TypeError):
+        per_page = DEFAULT_PAGE_SIZE
+    if per_page not in PAGE_SIZES:
+        per_page = DEFAULT_PAGE_SIZE
+    
+    # Get one page of products in this category and its subcategories (including
+    # those without images); the subtree is an integer range on the category tree
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        # From the shared catalog snapshot, images included: no queries
+        page = snapshot.paginate_products(
+            category,
+            sort=sort,
+            per_page=per_page,
+            after=request.GET.get('after'),
+            before=request.GET.get('before'),
+        )
+    else:
+        products = Product.objects.filter(category.subtree_q()).select_related('category')
+        page = paginate_products(
+            products,
+            sort=sort,
+            per_page=per_page,
+            after=request.GET.get('after'),
+            before=request.GET.get('before'),
+        )
+        # Images of the whole page, with their stored copies, in one query
+        prefetch_product_images(page['products'])
     
     context = {
-        'categories': list(top_level_categories.values()),
+        'category_name': category.name,
+        'category_slug': category_slug,
+        'category': category,
+        'ancestors': ancestors,
+        'subcategories': get_category_tree()['children'].get(category.pk, []),
+        'products': page['products'],
+        'next_cursor': page['next_cursor'],
+        'prev_cursor': page['prev_cursor'],
+        'sort': sort,
+        'per_page': per_page,
+        'page_sizes': PAGE_SIZES,
+        # Precomputed by load_catalog instead of a COUNT(*) per request
+        'product_count': category.product_count,
         'cart_count': get_cart_count(request),
     }
-    return render(request, 'pages/landing.html', context)
+    return render(request, 'pages/category.html', context)
 
 
 def category_page(request, category_slug):
     """Category page view showing products in a category."""
-    # Find category by matching top-level category name slug
-    # Get all categories and find one whose top-level name matches the slug
-    categories = Category.objects.all()
-    
-    # Find the category by matching the slugified top-level name
-    matching_category = None
-    for cat in categories:
-        top_level = cat.full_path.split(' > ')[0].strip()
-        if slugify(top_level) == category_slug:
-            matching_category = top_level
-            break
-    
-    if not matching_category:
-        # If not found, try to find by any part of the full path
-        for cat in categories:
-            if slugify(cat.full_path) == category_slug or slugify(cat.name) == category_slug:
-                matching_category = cat.full_path.split(' > ')[0].strip()
-                break
+    # Resolve the URL slug (top-level, full-path or leaf-name slug) to its
+    # top-level category with a single lookup in the per-process resolver
+    matching_category = resolve_category_slug(category_slug)
+    category = top_level_category(matching_category) if matching_category else None
     
-    if not matching_category:
+    if not category:
         # Return 404 if category not found
-        from django.http import Http404
         raise Http404("Category not found")
     
-    # Get all products in this top-level category (including those without images)
-    products = Product.objects.filter(
-        category__full_path__startswith=matching_category
-    ).select_related('category').order_by('name')
+    return render_category_listing(request, category_slug, category)
+
+
+def subcategory_page(request, category_slug, subcategory_slug):
+    """Subcategory page view showing products below a category of the tree."""
+    matching_category = resolve_category_slug(category_slug)
+    root = top_level_category(matching_category) if matching_category else None
+    category = get_category_tree()['by_slug'].get(subcategory_slug)
     
-    context = {
-        'category_name': matching_category,
-        'category_slug': category_slug,
-        'products': products,
-        'product_count': products.count(),
-        'cart_count': get_cart_count(request),
-    }
-    return render(request, 'pages/category.html', context)
+    if not root or not category or category.tree_id != root.tree_id:
+        raise Http404("Category not found")
+    
+    if category.pk == root.pk:
+        return redirect('category_page', category_slug=category_slug)
+    
+    return render_category_listing(request, category_slug, category, ancestors=category_ancestors(category))
 
 
 def product_page(request, category_slug, product_slug):
     """Product page view showing product details."""
     # Find the category first
-    categories = Category.objects.all()
-    matching_category = None
-    for cat in categories:
-        top_level = cat.full_path.split(' > ')[0].strip()
-        if slugify(top_level) == category_slug:
-            matching_category = top_level
-            break
+    matching_category = resolve_category_slug(category_slug)
     
     if not matching_category:
-        from django.http import Http404
         raise Http404("Category not found")
     
-    # Find the product by slug (product name slugified)
-    products_in_category = Product.objects.filter(
-        category__full_path__startswith=matching_category
-    )
-    
+    # Find the product by its stored slug; old slug-by-name URLs go through
+    # the redirect table (category-scoped redirects win over live slugs).
+    # Both come from the catalog snapshot when there is one.
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        redirects = snapshot.product_redirects(product_slug, [category_slug, ''])
+    else:
+        redirects = {
+            r.category_slug: r.product
+            for r in ProductRedirect.objects.filter(
+                old_slug=product_slug, category_slug__in=[category_slug, '']
+            ).select_related('product__category')
+        }
     product = None
-    for p in products_in_category:
-        if slugify(p.name) == product_slug:
-            product = p
-            break
+    if category_slug not in redirects:
+        if snapshot is not None:
+            product = snapshot.product_by_slug(product_slug)
+        else:
+            product = Product.objects.filter(slug=product_slug).select_related('category').first()
     
     if not product:
-        from django.http import Http404
+        target = redirects.get(category_slug) or redirects.get('')
+        if not target:
+            raise Http404("Product not found")
+        target_category_slug = top_level_slug(target.category.full_path) if target.category else category_slug
+        return redirect('product_page', category_slug=target_category_slug, product_slug=target.slug, permanent=True)
+    
+    # The product must belong to the category of the URL; a product reached
+    # through another category moves to its canonical URL
+    if not product.category:
         raise Http404("Product not found")
+    if top_level_name(product.category.full_path) != matching_category:
+        return redirect(
+            'product_page', category_slug=top_level_slug(product.category.full_path), product_slug=product.slug,
+            permanent=True,
+        )
     
     # Handle add to cart form submission
     error_message = None
@@ -177,29 +173,20 @@ def product_page(request, category_slug, product_slug):
             quantity_int = int(quantity)
             if quantity_int > 0:
                 # Add to cart
-                cart = get_cart(request)
-                product_code = product.product_code
-                
-                if product_code in cart:
-                    cart[product_code]['quantity'] += quantity_int
-                else:
-                    cart[product_code] = {
-                        'quantity': quantity_int,
-                    }
-                
-                request.session.modified = True
+                add_item(request, product, quantity_int)
                 from django.contrib import messages
                 messages.success(request, f'Añadido al carrito: {quantity_int} unidad(es) de {product.name}')
                 success_message = f'Añadido al carrito: {quantity_int} unidad(es)'
                 # Redirect to prevent resubmission on refresh
-                return redirect('product_page', category_slug=category_slug, product_slug=product_slug)
+                return redirect('product_page', category_slug=category_slug, product_slug=product.slug)
             else:
                 error_message = 'La cantidad debe ser mayor que 0'
         except (ValueError, TypeError):
             error_message = 'Por favor ingrese un número válido'
     
-    # Get all images for the product
-    images = product.get_images()
+    # Get all images for the product, with their resized copies where downloaded
+    prefetch_product_images([product])
+    images = product.get_gallery()
     
     context = {
         'product': product,
@@ -213,13 +200,82 @@ def product_page(request, category_slug, product_slug):
     return render(request, 'pages/product.html', context)
 
 
+# Blob file names are <sha256><ext>, or <sha256>-<width>w<ext> for resized copies,
+# so a name always refers to the same bytes
+BLOB_NAME_RE = re.compile(r'^[0-9a-f]{64}(-[0-9]{2,4}w)?\.[a-z0-9]{2,5}$')
+
+
+def image_blob(request, name):
+    """Serve an image from the content-addressed store with immutable caching."""
+    if not BLOB_NAME_RE.match(name):
+        raise Http404("Image not found")
+    etag = f'"{name.rpartition(".")[0]}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        try:
+            image_file = default_storage.open(f'{BLOB_DIR}/{name[:2]}/{name}', 'rb')
+        except FileNotFoundError:
+            raise Http404("Image not found")
+        response = FileResponse(image_file, content_type=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        if name.endswith('.svg'):
+            # Stored before SVG was refused; scripts in it must not run on our origin
+            response['Content-Disposition'] = 'attachment'
+            response['Content-Security-Policy'] = "default-src 'none'"
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+PROXY_KEY_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def image_proxy(request, width, name):
+    """Serve a supplier image resized to one of the derivative widths, from the disk cache."""
+    key, _, extension = name.partition('.')
+    extension = extension or 'jpg'
+    if width not in DERIVATIVE_WIDTHS or extension not in DERIVATIVE_EXTENSIONS or not PROXY_KEY_RE.match(key):
+        raise Http404("Image not found")
+    try:
+        image_file = open_resized(key, width, extension)
+    except ProxyError:
+        # Better the supplier's image than none at all
+        return redirect(source_url(key))
+    if image_file is None:
+        raise Http404("Image not found")
+    response = FileResponse(image_file, content_type=CONTENT_TYPES[extension])
+    # The supplier may replace the image behind the URL, so this is not immutable
+    response['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+
+@never_cache
+def liveness(request):
+    """Answer as long as the process serves requests; touches nothing else."""
+    return JsonResponse({'status': 'alive'})
+
+
+@never_cache
+def readiness_check(request):
+    """Answer 200 once the database is reachable and migrated and a catalog is loaded, 503 until then."""
+    ready, checks = readiness()
+    return JsonResponse(
+        {'status': 'ready' if ready else 'starting', 'checks': checks, 'uptime': round(seconds_since_startup(), 1)},
+        status=200 if ready else 503,
+    )
+
+
 def cart_page(request):
     """Cart page view showing all cart items."""
     cart_context = get_cart_context(request)
+    # Only the cart page shows product images
+    prefetch_product_images([item['product'] for item in cart_context['cart_items']])
     context = {
         'cart_items': cart_context['cart_items'],
         'grand_total': cart_context['grand_total'],
         'cart_count': cart_context['cart_count'],
+        'max_quantity': MAX_ITEM_QUANTITY,
     }
     return render(request, 'pages/cart.html', context)
 
@@ -228,19 +284,14 @@ def add_to_cart(request):
     """AJAX endpoint to add item to cart."""
     if request.method == 'POST':
         product_code = request.POST.get('product_code')
-        quantity = int(request.POST.get('quantity', 1))
+        quantity, error = parse_quantity(request.POST.get('quantity', 1))
+        if error:
+            return JsonResponse({'success': False, 'error': error}, status=400)
         
         try:
             product = Product.objects.get(product_code=product_code)
-            cart = get_cart(request)
-            
-            if product_code in cart:
-                cart[product_code]['quantity'] += quantity
-            else:
-                cart[product_code] = {'quantity': quantity}
-            
-            request.session.modified = True
-            cart_count = get_cart_count(request)
+            add_item(request, product, quantity)
+            cart_count = count_items(request)
             
             return JsonResponse({
                 'success': True,
@@ -258,38 +309,140 @@ def add_to_cart(request):
 def update_cart_item(request, product_code):
     """Update quantity of a cart item."""
     if request.method == 'POST':
-        quantity = int(request.POST.get('quantity', 1))
-        cart = get_cart(request)
-        
-        if product_code in cart:
-            if quantity > 0:
-                cart[product_code]['quantity'] = quantity
-                request.session.modified = True
-                return redirect('cart_page')
-            else:
-                # Remove item if quantity is 0
-                del cart[product_code]
-                request.session.modified = True
-                return redirect('cart_page')
+        try:
+            quantity = int(request.POST.get('quantity', 1))
+        except ValueError:
+            messages.error(request, 'Cantidad inválida')
+            return redirect('cart_page')
+        # A quantity of 0 removes the item
+        set_item_quantity(request, product_code, min(max(quantity, 0), MAX_ITEM_QUANTITY))
     
     return redirect('cart_page')
 
 
 def remove_cart_item(request, product_code):
     """Remove item from cart."""
-    cart = get_cart(request)
-    if product_code in cart:
-        del cart[product_code]
-        request.session.modified = True
+    remove_item(request, product_code)
     
     return redirect('cart_page')
 
 
+def cart_api(request):
+    """
+    JSON endpoint applying several cart changes at once.
+
+    POST {"ops": [{"op": "set", "code": ..., "quantity": n}, {"op": "remove", "code": ...}]}.
+    The operations are applied atomically (none of them if any is invalid)
+    and the response carries the new lines, totals and count, so the cart
+    page updates in place. GET returns the same state without changes.
+    """
+    if request.method == 'POST':
+        try:
+            payload = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'JSON inválido'}, status=400)
+        errors = apply_operations(request, payload.get('ops') if isinstance(payload, dict) else None)
+        if errors:
+            return JsonResponse({'success': False, 'errors': errors}, status=400)
+    elif request.method != 'GET':
+        return JsonResponse({'success': False, 'error': 'Método no permitido'}, status=405)
+    
+    cart_context = get_cart_context(request)
+    return JsonResponse({
+        'success': True,
+        'items': [
+            {
+                'code': item['product'].product_code,
+                'quantity': item['quantity'],
+                'unit_price': str(item['unit_price']),
+                'item_total': str(item['item_total']),
+                'currency': item['product'].currency,
+            }
+            for item in cart_context['cart_items']
+        ],
+        'grand_total': str(cart_context['grand_total']),
+        'cart_count': cart_context['cart_count'],
+    })
+
+
+def quick_order_page(request):
+    """Quick order page: paste "code;quantity" lines or upload a CSV file to add them all to the cart."""
+    text = ''
+    result = None
+    error_message = None
+    
+    if request.method == 'POST':
+        upload = request.FILES.get('file')
+        text = request.POST.get('lines', '')
+        try:
+            if upload:
+                text = read_upload(upload)
+            lines, errors = parse_lines(text)
+        except ValueError as e:
+            error_message = str(e)
+        else:
+            if not lines and not errors:
+                error_message = 'Introduzca al menos una línea código;cantidad'
+            else:
+                result = add_lines_to_cart(request, lines, errors)
+                if not result['errors']:
+                    messages.success(request, f'Añadidas al carrito {result["added"]} línea(s), {result["quantity"]} unidad(es)')
+                    return redirect('cart_page')
+                # Leave only the lines that failed in the form, to correct them
+                failed = {error['line'] for error in result['errors']}
+                text = '\n'.join(
+                    line for number, line in enumerate(text.splitlines(), start=1) if number in failed
+                )
+    
+    context = {
+        'lines': text,
+        'result': result,
+        'error_message': error_message,
+        'max_lines': MAX_LINES,
+        'cart_count': get_cart_count(request),
+    }
+    return render(request, 'pages/quick_order.html', context)
+
+
+def quick_order_api(request):
+    """
+    JSON endpoint for quick orders.
+
+    Accepts {"lines": "code;quantity\\n..."}, {"items": [{"code": ..., "quantity": ...}]}
+    or a CSV upload (file). Valid lines are added to the cart; the response
+    lists the errors of the others by line.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Método no permitido'}, status=405)
+    
+    try:
+        upload = request.FILES.get('file')
+        if upload:
+            lines, errors = parse_lines(read_upload(upload))
+        else:
+            try:
+                payload = json.loads(request.body or b'{}')
+            except ValueError:
+                raise ValueError('JSON inválido')
+            if not isinstance(payload, dict):
+                raise ValueError('Se esperaba un objeto JSON')
+            if 'items' in payload:
+                lines, errors = parse_items(payload['items'])
+            else:
+                lines, errors = parse_lines(str(payload.get('lines', '')))
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    if not lines and not errors:
+        return JsonResponse({'success': False, 'error': 'No hay líneas'}, status=400)
+    
+    result = add_lines_to_cart(request, lines, errors)
+    return JsonResponse({'success': True, **result, 'cart_count': count_items(request)})
+
+
 def checkout_page(request):
     """Checkout page with contact details form."""
     # Redirect to cart if cart is empty
-    cart = get_cart(request)
-    if not cart:
+    if not get_cart_context(request)['cart_items']:
         return redirect('cart_page')
     
     error_message = None
@@ -327,7 +480,7 @@ def checkout_page(request):
         'error_message': error_message,
         'cart_items': cart_context['cart_items'],
         'grand_total': cart_context['grand_total'],
-        'cart_count': get_cart_count(request),
+        'cart_count': cart_context['cart_count'],
     }
     return render(request, 'pages/checkout.html', context)
 
@@ -367,8 +520,7 @@ def send_order_email_placeholder(contact_details, cart_items, grand_total):
 def order_summary_page(request):
     """Order summary page showing cart items and contact details."""
     # Redirect to cart if cart is empty
-    cart = get_cart(request)
-    if not cart:
+    if not get_cart_context(request)['cart_items']:
         return redirect('cart_page')
     
     # Redirect to checkout if contact details are missing
@@ -393,8 +545,7 @@ def order_summary_page(request):
         request.session.modified = True
         
         # Clear cart and contact details after order submission
-        if 'cart' in request.session:
-            del request.session['cart']
+        clear_cart(request)
         if 'checkout_contact' in request.session:
             del request.session['checkout_contact']
         request.session.modified = True
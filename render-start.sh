@@ -8,28 +8,34 @@
 
 echo "=== Render Startup Script ==="
 
+# Startup timing: /readyz and the first request log count from here
+export STARTUP_STARTED_AT=$(date +%s.%N)
+
 # Wait for database connection (non-fatal)
 echo "Waiting for database..."
 python wait_for_db.py || echo "Database wait skipped, continuing..."
+echo "Database wait done at ${SECONDS}s"
 
 # Collect static files (optional - WhiteNoise can serve from STATICFILES_DIRS directly)
 # Run collectstatic in background after server starts for faster startup
 echo "Skipping static files collection (will run in background)..."
 # Background job will handle collectstatic if needed
 
-# Disable background jobs during migrations to prevent interference
-export DISABLE_BACKGROUND_JOBS=true
-
 # Run migrations only (fast)
 echo "Running migrations..."
 python manage.py migrate --noinput || echo "Migrations had issues, continuing..."
+echo "Migrations done at ${SECONDS}s"
 
-# Re-enable background jobs for server runtime
-export DISABLE_BACKGROUND_JOBS=false
+# Start the job worker next to the web server: one process per instance,
+# outside the Gunicorn workers. Jobs are queued in the database, so each
+# runs once even if several instances start a worker.
+if [ "$DISABLE_BACKGROUND_JOBS" != "true" ]; then
+    echo "Starting background job worker..."
+    python manage.py run_background_jobs --all &
+fi
 
 # Start the server (this should not return)
-# Background jobs will run automatically after server starts
-echo "Starting Gunicorn server..."
+echo "Starting Gunicorn server at ${SECONDS}s..."
 
 # Render provides PORT environment variable automatically
 # If PORT is not set, use default 8000
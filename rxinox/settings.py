@@ -35,9 +35,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'pages.middleware.HealthCheckMiddleware',  # Liveness / readiness probes, before host checks
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # For static files on Render
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'pages.middleware.CartCountCookieMiddleware',  # Signed cart count cookie, so pages don't load the session
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -159,6 +161,41 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedStaticFilesStorage'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Catalog caches
+# Each process re-reads the live catalog version at most once per interval (seconds);
+# cached menus and indexes are rebuilt when the version changes
+CATALOG_VERSION_CHECK_INTERVAL = config('CATALOG_VERSION_CHECK_INTERVAL', default=30, cast=int)
+# Number of recent catalog versions whose feed records are kept for load_catalog --rollback
+CATALOG_VERSIONS_KEPT = config('CATALOG_VERSIONS_KEPT', default=3, cast=int)
+# load_catalog refuses imports that cut the active products by more than this fraction
+CATALOG_MAX_SHRINK = config('CATALOG_MAX_SHRINK', default=0.5, cast=float)
+
+# Binary catalog snapshot written after each import and mapped by every web process;
+# category and product pages read it instead of the database (empty disables it)
+CATALOG_SNAPSHOT_PATH = config('CATALOG_SNAPSHOT_PATH', default=str(BASE_DIR / 'cache' / 'catalog.snapshot'))
+
+# Image resize proxy (/img/<width>/<key>) for supplier images that are not downloaded yet:
+# resized images are cached on local disk, least recently used first out above the budget
+IMAGE_PROXY_CACHE_DIR = config('IMAGE_PROXY_CACHE_DIR', default=str(BASE_DIR / 'cache' / 'images'))
+IMAGE_PROXY_CACHE_BYTES = config('IMAGE_PROXY_CACHE_MB', default=512, cast=int) * 1024 * 1024
+IMAGE_PROXY_TIMEOUT = config('IMAGE_PROXY_TIMEOUT', default=5, cast=float)
+
+# Background jobs: seconds a worker's claim on a job lasts without a heartbeat;
+# another worker takes the job over once it lapses (unless its worker is still alive on this host)
+JOB_LEASE_SECONDS = config('JOB_LEASE_SECONDS', default=300, cast=int)
+
+# Logging: warnings from Django, plus startup timing and job messages from the pages app
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'pages': {'handlers': ['console'], 'level': config('PAGES_LOG_LEVEL', default='INFO')},
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -2,26 +2,20 @@
 """Wait for database to be ready."""
 import os
 import sys
-import time
-from django.db import connection
-from django.db.utils import OperationalError
+
+# Give up after this many seconds
+TIMEOUT = int(os.environ.get('WAIT_FOR_DB_TIMEOUT', 30))
+
 
 def wait_for_db():
-    """Wait for database to be available."""
-    max_attempts = 30
-    attempt = 0
-    
-    while attempt < max_attempts:
-        try:
-            connection.ensure_connection()
-            print("Database is ready!")
-            return True
-        except OperationalError:
-            attempt += 1
-            print(f"Waiting for database... ({attempt}/{max_attempts})")
-            time.sleep(1)
-    
-    print("Database not available after 30 attempts!")
+    """Wait for database to be available, retrying quickly at first."""
+    from pages.health import check_database, wait_for
+
+    if wait_for(check_database, TIMEOUT, 'database'):
+        print("Database is ready!")
+        return True
+
+    print(f"Database not available after {TIMEOUT} seconds!")
     return False
 
 if __name__ == '__main__':
@@ -29,11 +23,10 @@ if __name__ == '__main__':
     try:
         import django
         django.setup()
-        
+
         if not wait_for_db():
             print("Warning: Database connection failed, but continuing...")
             sys.exit(0)  # Exit with 0 to not fail the startup script
     except Exception as e:
         print(f"Warning: Database check failed: {e}, but continuing...")
         sys.exit(0)  # Exit with 0 to not fail the startup script
-